@@ -5,49 +5,82 @@
 """
 import configparser
 import argparse
+import asyncio
 import logging
+from abc import ABC, abstractmethod
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
-from contextlib import closing
+from array import array
+from contextlib import closing, nullcontext
 from enum import Enum
+import base64
+import calendar
+import copy
+import ctypes
 import errno
+import gc
+import hashlib
+import hmac
+import io
 import re
 import itertools
+import json
 import locale
-from multiprocessing import Event, Process, Queue
-from multiprocessing.managers import BaseManager
+import math
+import mmap
+import multiprocessing
 import os
 from os.path import exists, expanduser
 import random
 import shlex
+import signal
+import shutil
 import socket
 import string
+import struct
 import sys
-from subprocess import call, Popen, PIPE
+from subprocess import call, Popen, DEVNULL, PIPE, TimeoutExpired
 import tempfile
-from threading import Timer
+from threading import Event, Lock, Thread, Timer, current_thread
 import time
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, Tuple
+from uuid import UUID, uuid4
 import re
 import webbrowser
+import weakref
+import zlib
+import argon2
 import construct
+from lxml import etree
 from pynput import keyboard
 from pykeepass import PyKeePass
+from pykeepass.entry import Entry, reserved_keys
+from pykeepass.exceptions import (CredentialsError, HeaderChecksumError,
+                                  PayloadChecksumError)
+from pykeepass.group import Group
+from pykeepass.kdbx_parsing import kdbx3, kdbx4
+from pykeepass.kdbx_parsing.common import (aes_kdf, AES256Payload, ChaCha20Payload,
+                                           Concatenated, Reparsed, TwoFishPayload)
+from pykeepass.kdbx_parsing.kdbx import KDBX
+from pykeepass.kdbx_parsing.kdbx4 import kdf_uuids
+from Cryptodome.Cipher import AES, ChaCha20, Salsa20
 
 LOG = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-try:
-    # secrets only available python 3.6+
-    from secrets import choice
-except ImportError:
-    def choice(seq):
-        """Provide `choice` function call for pw generation
-
-        """
-        return random.SystemRandom().choice(seq)
-
-
 AUTH_FILE = expanduser("~/.cache/.keepmenu-auth")
+AUTH_CHALLENGE_LEN = 32
+AUTH_DIGEST_LEN = hashlib.sha256().digest_size
+CLIENT_TIMEOUT_SEC = 10
+# The daemon may be waiting for the database passphrase before it answers
+CLIENT_WAIT_SEC = 300
+# Listening socket created by keepmenu.socket (systemd socket activation)
+SOCKET_FILE = os.path.join(os.environ['XDG_RUNTIME_DIR'], "keepmenu.sock") \
+    if os.environ.get('XDG_RUNTIME_DIR') else None
+SD_LISTEN_FDS_START = 3
 CONF_FILE = expanduser("~/.config/keepmenu/config.ini")
 
 class MenuOption(Enum):
@@ -60,6 +93,7 @@ class MenuOption(Enum):
     TypePassword = 6
     TypeEntry = 7
     TypeUsername = 8
+    Audit = 9
 
     def description(self):
         return {
@@ -72,10 +106,32 @@ class MenuOption(Enum):
             self.ReloadDB:'Reload database',
             self.KillDaemon:'Kill Keepmenu daemon',
             self.TypeEntry:'Select entry to autotype',
+            self.Audit:'Audit passwords',
         }.get(self)
 
+def listen_fds():
+    """Return the listening sockets passed by systemd socket activation
+    (`LISTEN_FDS`), if they are meant for this process. The variables are
+    removed from the environment so child processes don't pick them up.
+
+    """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()):
+        return []
+    try:
+        count = int(os.environ.get('LISTEN_FDS', 0))
+    except ValueError:
+        count = 0
+    for var in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(var, None)
+    socks = []
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count):
+        os.set_inheritable(fd, False)
+        socks.append(socket.socket(fileno=fd))
+    return socks
+
+
 def find_free_port():
-    """Find random free port to use for BaseManager server
+    """Find random free port to use for the daemon Server
 
     Returns: int Port
 
@@ -86,7 +142,7 @@ def find_free_port():
 
 
 def random_str():
-    """Generate random auth string for BaseManager
+    """Generate random auth string for the daemon Server
 
     Returns: string
 
@@ -95,6 +151,274 @@ def random_str():
     return ''.join(random.choice(letters) for i in range(15))
 
 
+class RandomPool:
+    """Buffered CSPRNG reading os.urandom in bulk instead of once per
+    character. The buffer is discarded after a fork so processes never share
+    random bytes.
+
+    Args: size - number of bytes to read from os.urandom at once
+
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.buf = b""
+        self.pos = 0
+        self.pid = os.getpid()
+
+    def read(self, num):
+        """Return num random bytes
+
+        """
+        if self.pid != os.getpid():
+            self.buf, self.pos, self.pid = b"", 0, os.getpid()
+        if self.pos + num > len(self.buf):
+            self.buf = self.buf[self.pos:] + os.urandom(max(self.size, num))
+            self.pos = 0
+        res = self.buf[self.pos:self.pos + num]
+        self.pos += num
+        return res
+
+    def randbelow(self, num):
+        """Return a uniform random int in [0, num) using rejection sampling
+
+        """
+        nbytes = max(1, ((num - 1).bit_length() + 7) // 8)
+        space = 256 ** nbytes
+        limit = space - space % num
+        while True:
+            val = int.from_bytes(self.read(nbytes), 'little')
+            if val < limit:
+                return val % num
+
+    def shuffle(self, seq):
+        """Fisher-Yates shuffle of a list in place
+
+        """
+        for i in range(len(seq) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            seq[i], seq[j] = seq[j], seq[i]
+
+
+RANDOM_POOL = RandomPool()
+
+
+class CharSampler:
+    """Draw characters uniformly from an alphabet (the union of the given
+    characters, duplicates removed).
+
+    For alphabets of up to 256 characters, random bytes are mapped to
+    characters with bytes.translate, deleting the bytes at or above the
+    largest multiple of the alphabet size so there is no modulo bias.
+
+    """
+    def __init__(self, alphabet):
+        self.alphabet = "".join(sorted(set(alphabet)))
+        num = len(self.alphabet)
+        self.ascii = all(ord(i) < 128 for i in self.alphabet)
+        if num <= 256:
+            self.limit = 256 - 256 % num
+            if self.ascii:
+                self.table = bytes(ord(self.alphabet[i % num]) for i in range(256))
+            else:
+                self.table = bytes(i % num for i in range(256))
+            self.delete = bytes(range(self.limit, 256))
+
+    def __len__(self):
+        return len(self.alphabet)
+
+    def sample(self, count, pool=RANDOM_POOL):
+        """Return a string of count random characters
+
+        """
+        num = len(self.alphabet)
+        if num > 256:
+            return "".join(self.alphabet[pool.randbelow(num)] for _ in range(count))
+        res = b""
+        while len(res) < count:
+            need = count - len(res)
+            res += pool.read(need * 256 // self.limit + 8).translate(self.table, self.delete)
+        if self.ascii:
+            return res[:count].decode('ascii')
+        return "".join(self.alphabet[i] for i in res[:count])
+
+
+class PasswordGenerator:
+    """Generate passwords containing at least one character of each distinct
+    character set.
+
+    Passwords are drawn uniformly from the union of all sets and redrawn
+    until every set is represented, so each valid password is equally likely
+    and `entropy` is exact. If that takes too many attempts (very short
+    passwords with many sets), one character per set is placed and the rest
+    filled randomly, then shuffled.
+
+    Args: chars - Dict {preset_name_1: {char_set_1: string, char_set_2: string},
+                        preset_name_2: ....}
+
+    """
+    max_attempts = 1000
+
+    def __init__(self, chars):
+        self.sets = sorted(set(j for i in chars.values() for j in i.values()))
+        self.sampler = CharSampler("".join(self.sets))
+        self.classes = [frozenset(i) for i in self.sets]
+
+    def generate(self, length=20, pool=RANDOM_POOL):
+        """Return a password string, or False if length is less than the
+        number of character sets
+
+        """
+        if length < len(self.sets) or not self.sets:
+            return False
+        for _ in range(self.max_attempts):
+            password = self.sampler.sample(length, pool)
+            if not any(i.isdisjoint(password) for i in self.classes):
+                return password
+        tpw = [CharSampler(i).sample(1, pool) for i in self.sets]
+        tpw += list(self.sampler.sample(length - len(self.sets), pool))
+        pool.shuffle(tpw)
+        return "".join(tpw)
+
+    def entropy(self, length=20):
+        """Return the entropy in bits of a password of the given length:
+        log2 of the number of strings containing every character set
+        (inclusion-exclusion over the sets).
+
+        """
+        alphabet = frozenset(self.sampler.alphabet)
+        if length < len(self.classes) or not alphabet:
+            return 0.0
+        if len(self.classes) > 12:
+            return length * math.log2(len(alphabet))
+        count = 0
+        for num in range(len(self.classes) + 1):
+            for subset in itertools.combinations(self.classes, num):
+                remaining = len(alphabet.difference(*subset))
+                count += (-1) ** num * remaining ** length
+        return math.log2(count) if count > 0 else 0.0
+
+
+PASSPHRASE_PRESET = "Passphrase"
+
+WORDLISTS = {}
+
+
+class WordList:
+    """Memory-mapped word list with an index of line offsets, so picking a
+    word reads one line instead of loading the whole file. Accepts one word
+    per line or the EFF format (dice digits, whitespace, word). Blank lines
+    are skipped.
+
+    Args: path - word list file
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fobj:
+            stat = os.fstat(fobj.fileno())
+            self.key = (stat.st_mtime_ns, stat.st_size)
+            if not stat.st_size:
+                raise ValueError("Word list {} is empty".format(path))
+            self.mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array('Q')
+        pos, size = 0, len(self.mmap)
+        while pos < size:
+            end = self.mmap.find(b"\n", pos)
+            if end == -1:
+                end = size
+            if end > pos and not self.mmap[pos:end].isspace():
+                self.offsets.append(pos)
+            pos = end + 1
+        if not self.offsets:
+            raise ValueError("Word list {} is empty".format(path))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        start = self.offsets[idx]
+        end = self.mmap.find(b"\n", start)
+        line = self.mmap[start:end if end != -1 else len(self.mmap)]
+        return line.decode('utf-8').split()[-1]
+
+
+def get_wordlist(path):
+    """Return the WordList for path, reusing the index until the file
+    changes
+
+    """
+    path = expanduser(path)
+    stat = os.stat(path)
+    wordlist = WORDLISTS.get(path)
+    if wordlist is None or wordlist.key != (stat.st_mtime_ns, stat.st_size):
+        wordlist = WORDLISTS[path] = WordList(path)
+    return wordlist
+
+
+class PassphraseGenerator:
+    """Generate diceware style passphrases from a WordList.
+
+    Args: wordlist - WordList
+          separator - string placed between words
+          capitalize - 'none', 'first' (first letter of each word), 'all' or
+                       'random' (each word randomly lower or first letter
+                       upper case)
+          words - default number of words
+
+    """
+    def __init__(self, wordlist, separator=" ", capitalize="none", words=6):
+        self.wordlist = wordlist
+        self.separator = separator
+        self.capitalize = capitalize
+        self.words = words
+
+    def generate(self, words=None, pool=RANDOM_POOL):
+        """Return a passphrase string, or False if words < 1
+
+        """
+        words = self.words if words is None else words
+        if words < 1:
+            return False
+        res = []
+        for _ in range(words):
+            word = self.wordlist[pool.randbelow(len(self.wordlist))]
+            if self.capitalize == "all":
+                word = word.upper()
+            elif self.capitalize == "first" or \
+                    (self.capitalize == "random" and pool.randbelow(2)):
+                word = word[:1].upper() + word[1:]
+            res.append(word)
+        return self.separator.join(res)
+
+    def entropy(self, words=None):
+        """Return the entropy in bits of a passphrase of the given number of
+        words
+
+        """
+        words = self.words if words is None else words
+        bits = math.log2(len(self.wordlist))
+        return words * (bits + 1 if self.capitalize == "random" else bits)
+
+
+def get_passphrase_generator():
+    """Create a PassphraseGenerator from the [passphrase] section of
+    config.ini
+
+    Raises: OSError or ValueError if the word list can't be used
+
+    """
+    opts = {"wordlist": "/usr/share/dict/words",
+            "separator": " ",
+            "capitalize": "none",
+            "words": "6"}
+    if CONF.has_section('passphrase'):
+        opts.update(dict(CONF.items('passphrase')))
+    return PassphraseGenerator(get_wordlist(opts["wordlist"]),
+                               separator=opts["separator"],
+                               capitalize=opts["capitalize"],
+                               words=int(opts["words"]))
+
+
 def gen_passwd(chars, length=20):
     """Generate password (min = # of distinct character sets picked)
 
@@ -105,18 +429,190 @@ def gen_passwd(chars, length=20):
     Returns: password - string OR False
 
     """
-    sets = set()
-    if chars:
-        sets = set(j for i in chars.values() for j in i.values())
-    if length < len(sets) or not chars:
+    if not chars:
         return False
-    alphabet = "".join(set("".join(j for j in i.values()) for i in chars.values()))
-    # Ensure minimum of one char from each character set
-    password = "".join(choice(k) for k in sets)
-    password += "".join(choice(alphabet) for i in range(length - len(sets)))
-    tpw = list(password)
-    random.shuffle(tpw)
-    return "".join(tpw)
+    return PasswordGenerator(chars).generate(length)
+
+
+CACHE_PERIOD_DEFAULT_MIN = 360
+
+SEQUENCE = "{USERNAME}{TAB}{PASSWORD}{ENTER}"
+
+PASSWORD_CMD_TIMEOUT_SEC = 30
+
+ATTACHMENT_KEEP_DEFAULT_SEC = 60
+
+MEMORY_SHED_DEFAULT_MIN = 10
+
+JOURNAL_COMPACT_DEFAULT_RECORDS = 50
+
+TRACE_WINDOW = 1000
+
+SETTINGS = None
+
+BINARIES = {}
+
+
+def _conf_int(conf, section, option, default):
+    """Read an integer option, raising ValueError with a readable message"""
+    value = conf.get(section, option, fallback=str(default))
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("[{}] {} must be a number, not '{}'".format(section, option, value))
+
+
+def _conf_choice(conf, section, option, default, choices):
+    """Read an option which must be one of `choices`"""
+    value = conf.get(section, option, fallback=default)
+    if value not in choices:
+        raise ValueError("[{}] {} must be one of {}, not '{}'".format(
+            section, option, ", ".join(choices), value))
+    return value
+
+
+class Settings(NamedTuple):
+    """The config.ini values used while keepmenu runs, parsed and validated
+    once. Settings objects are immutable; reload_config() replaces SETTINGS
+    when config.ini changes.
+
+    Sections only read when a menu is opened (database list, password
+    characters, passphrase, audit, breach) are still read from CONF.
+
+    """
+    mtime_ns: int
+    dmenu_command: Tuple[str, ...]
+    dmenu_lines: Optional[int]
+    dmenu_options: Tuple[Tuple[str, str], ...]
+    passphrase_options: Tuple[Tuple[str, str], ...]
+    rofi_obscure: bool
+    pinentry: str
+    dmenu_len: int
+    cache_period_min: int
+    keyring_cache_min: int
+    listing_cache: bool
+    password_cmd_timeout: float
+    password_cmd_speculative: bool
+    autotype_default: str
+    type_library: str
+    type_record_file: str
+    hide_groups: Tuple[str, ...]
+    editor: Tuple[str, ...]
+    clipboard_cmd: str
+    clipboard_selection: str
+    clipboard_clear_sec: int
+    transfer_mode: str
+    transfer_modes: Mapping[str, str]
+    attachment_opener: Tuple[str, ...]
+    attachment_keep_sec: int
+    memory_shed_min: int
+    journal: bool
+    journal_compact_records: int
+    trace: bool
+
+    @classmethod
+    def from_config(cls, conf, mtime_ns=0):
+        """Build Settings from a ConfigParser
+
+        Raises: ValueError for invalid values
+
+        """
+        dmenu = dict(conf.items('dmenu')) if conf.has_section('dmenu') else {}
+        command = tuple(shlex.split(dmenu.pop('dmenu_command', 'dmenu')))
+        if not command:
+            raise ValueError("[dmenu] dmenu_command is empty")
+        lines = _conf_int(conf, 'dmenu', 'l', 0) if 'l' in dmenu else None
+        dmenu.pop('l', None)
+        pinentry = dmenu.pop('pinentry', '')
+        passphrase = dict(dmenu)
+        if conf.has_section('dmenu_passphrase'):
+            passphrase.update(conf.items('dmenu_passphrase'))
+        rofi_obscure = True
+        if conf.has_option('dmenu_passphrase', 'rofi_obscure'):
+            rofi_obscure = conf.getboolean('dmenu_passphrase', 'rofi_obscure')
+            del passphrase['rofi_obscure']
+        gui_editor = conf.get('database', 'gui_editor', fallback='')
+        if gui_editor:
+            editor = shlex.split(gui_editor)
+        else:
+            editor = shlex.split(conf.get('database', 'terminal', fallback='xterm')) + ["-e"] + \
+                shlex.split(conf.get('database', 'editor',
+                                     fallback=os.environ.get('EDITOR', 'vim')))
+        modes = {}
+        for option, value in (conf.items('database') if conf.has_section('database') else []):
+            if option.startswith('transfer_mode'):
+                modes[option[len('transfer_mode_'):]] = _conf_choice(
+                    conf, 'database', option, value, TRANSFER_MODES)
+        clipboard = "wl-copy" if os.environ.get('WAYLAND_DISPLAY') else "xclip"
+        return cls(
+            mtime_ns=mtime_ns,
+            dmenu_command=command,
+            dmenu_lines=lines,
+            dmenu_options=tuple(dmenu.items()),
+            passphrase_options=tuple(passphrase.items()),
+            rofi_obscure=rofi_obscure,
+            pinentry=pinentry,
+            dmenu_len=lines if lines is not None else 24,
+            cache_period_min=_conf_int(conf, 'database', 'pw_cache_period_min',
+                                       CACHE_PERIOD_DEFAULT_MIN),
+            keyring_cache_min=_conf_int(conf, 'database', 'keyring_cache_min', 0),
+            listing_cache=conf.getboolean('database', 'listing_cache', fallback=False),
+            password_cmd_timeout=_conf_int(conf, 'database', 'password_cmd_timeout_sec',
+                                           PASSWORD_CMD_TIMEOUT_SEC),
+            password_cmd_speculative=conf.getboolean('database', 'password_cmd_speculative',
+                                                     fallback=True),
+            autotype_default=conf.get('database', 'autotype_default', fallback=SEQUENCE),
+            type_library=conf.get('database', 'type_library', fallback='pynput'),
+            type_record_file=expanduser(conf.get('database', 'type_record_file', fallback='')),
+            hide_groups=tuple(filter(None, (i.strip() for i in re.split(
+                '[,\n]', conf.get('database', 'hide_groups', fallback=''))))),
+            editor=tuple(editor),
+            clipboard_cmd=_conf_choice(conf, 'database', 'clipboard_cmd', clipboard,
+                                       tuple(CLIPBOARD_TOOLS)),
+            clipboard_selection=_conf_choice(conf, 'database', 'clipboard_selection',
+                                             'clipboard', ('clipboard', 'primary')),
+            clipboard_clear_sec=_conf_int(conf, 'database', 'clipboard_clear_sec',
+                                          CLIPBOARD_CLEAR_DEFAULT_SEC),
+            transfer_mode=modes.pop('', 'type'),
+            transfer_modes=MappingProxyType(modes),
+            attachment_opener=tuple(shlex.split(
+                conf.get('database', 'attachment_opener', fallback='xdg-open'))),
+            attachment_keep_sec=_conf_int(conf, 'database', 'attachment_keep_sec',
+                                          ATTACHMENT_KEEP_DEFAULT_SEC),
+            memory_shed_min=_conf_int(conf, 'database', 'memory_shed_min',
+                                      MEMORY_SHED_DEFAULT_MIN),
+            journal=conf.getboolean('database', 'journal', fallback=False),
+            journal_compact_records=_conf_int(conf, 'database', 'journal_compact_records',
+                                              JOURNAL_COMPACT_DEFAULT_RECORDS),
+            trace=conf.getboolean('database', 'trace', fallback=False))
+
+
+def which(name):
+    """Look up a binary on $PATH the first time it is needed. The result is
+    kept until the config is reloaded.
+
+    Returns: path or None
+
+    """
+    if name not in BINARIES:
+        BINARIES[name] = shutil.which(name)
+    return BINARIES[name]
+
+
+def load_settings(mtime_ns=0):
+    """Build SETTINGS from CONF and reset the caches that depend on it
+
+    Raises: ValueError for invalid values
+
+    """
+    global SETTINGS  # pylint: disable=global-statement
+    if SETTINGS is None:
+        # Defaults, so errors can be shown with dmenu
+        SETTINGS = Settings.from_config(configparser.ConfigParser())
+    SETTINGS = Settings.from_config(CONF, mtime_ns)
+    BINARIES.clear()
+    TRACE.enabled = SETTINGS.trace
+    return SETTINGS
 
 
 def process_config():
@@ -125,19 +621,13 @@ def process_config():
 
     """
     # pragma pylint: disable=global-variable-undefined
-    global CACHE_PERIOD_MIN, \
-        CACHE_PERIOD_DEFAULT_MIN, \
-        CONF, \
-        DMENU_LEN, \
+    global CONF, \
         ENV, \
-        ENC, \
-        SEQUENCE
+        ENC
     # pragma pylint: enable=global-variable-undefined
     ENV = os.environ.copy()
     ENV['LC_ALL'] = 'C'
     ENC = locale.getpreferredencoding()
-    CACHE_PERIOD_DEFAULT_MIN = 360
-    SEQUENCE = "{USERNAME}{TAB}{PASSWORD}{ENTER}"
     CONF = configparser.ConfigParser()
     if not exists(CONF_FILE):
         try:
@@ -158,35 +648,38 @@ def process_config():
             CONF.set('database', 'autotype_default', SEQUENCE)
             CONF.write(conf_file)
     try:
+        mtime_ns = os.stat(CONF_FILE).st_mtime_ns
         CONF.read(CONF_FILE)
-    except configparser.ParsingError as err:
+        load_settings(mtime_ns)
+    except (configparser.Error, ValueError) as err:
         dmenu_err("Config file error: {}".format(err))
         sys.exit()
-    if CONF.has_option("database", "pw_cache_period_min"):
-        CACHE_PERIOD_MIN = int(CONF.get("database", "pw_cache_period_min"))
-    else:
-        CACHE_PERIOD_MIN = CACHE_PERIOD_DEFAULT_MIN
-    if CONF.has_option("dmenu", "l"):
-        DMENU_LEN = int(CONF.get("dmenu", "l"))
-    else:
-        DMENU_LEN = 24
-    if CONF.has_option('database', 'autotype_default'):
-        SEQUENCE = CONF.get("database", "autotype_default")
-    if CONF.has_option("database", "type_library"):
-        if CONF.get("database", "type_library") == "xdotool":
-            try:
-                call(['xdotool', 'version'])
-            except OSError:
-                dmenu_err("Xdotool not installed.\n"
-                          "Please install or remove that option from config.ini")
-                sys.exit()
-        elif CONF.get("database", "type_library") == "ydotool":
-            try:
-                call(['ydotool'])
-            except OSError:
-                dmenu_err("Ydotool not installed.\n"
-                          "Please install or remove that option from config.ini")
-                sys.exit()
+
+
+def reload_config():
+    """Re-read config.ini if it was modified since SETTINGS was built. On
+    errors the old settings are kept.
+
+    Returns: the previous Settings if the config was reloaded, else None
+
+    """
+    global CONF, SETTINGS  # pylint: disable=global-statement
+    try:
+        mtime_ns = os.stat(CONF_FILE).st_mtime_ns
+    except OSError:
+        return None
+    if mtime_ns == SETTINGS.mtime_ns:
+        return None
+    old_conf, old = CONF, SETTINGS
+    try:
+        CONF = configparser.ConfigParser()
+        CONF.read(CONF_FILE)
+        load_settings(mtime_ns)
+    except (configparser.Error, ValueError) as err:
+        CONF, SETTINGS = old_conf, old._replace(mtime_ns=mtime_ns)
+        dmenu_err("Config file error: {}".format(err))
+        return None
+    return old
 
 
 def get_auth():
@@ -215,7 +708,7 @@ def get_auth():
 
 
 def dmenu_cmd(num_lines, prompt):
-    """Parse config.ini for dmenu options
+    """Build the dmenu command from the dmenu settings
 
     Args: args - num_lines: number of lines to display
                  prompt: prompt to show
@@ -223,33 +716,19 @@ def dmenu_cmd(num_lines, prompt):
                 dmenu -l <num_lines> -p <prompt> -i ...
 
     """
-    args_dict = {"dmenu_command": "dmenu"}
-    if CONF.has_section('dmenu'):
-        args = CONF.items('dmenu')
-        args_dict.update(dict(args))
-    command = shlex.split(args_dict["dmenu_command"])
-    dmenu_command = command[0]
-    dmenu_args = command[1:]
-    del args_dict["dmenu_command"]
+    dmenu_command = SETTINGS.dmenu_command[0]
+    dmenu_args = list(SETTINGS.dmenu_command[1:])
     lines = "-i -dmenu -multi-select -lines" if "rofi" in dmenu_command else "-i -l"
-    if "l" in args_dict:
-        lines = "{} {}".format(lines, min(num_lines, int(args_dict['l'])))
-        del args_dict['l']
+    if SETTINGS.dmenu_lines is not None:
+        lines = "{} {}".format(lines, min(num_lines, SETTINGS.dmenu_lines))
     else:
         lines = "{} {}".format(lines, num_lines)
-    if "pinentry" in args_dict:
-        del args_dict["pinentry"]
+    options = SETTINGS.dmenu_options
     if prompt == "Passphrase":
-        if CONF.has_section('dmenu_passphrase'):
-            args = CONF.items('dmenu_passphrase')
-            args_dict.update(args)
-        rofi_obscure = True
-        if CONF.has_option('dmenu_passphrase', 'rofi_obscure'):
-            rofi_obscure = CONF.getboolean('dmenu_passphrase', 'rofi_obscure')
-            del args_dict["rofi_obscure"]
-        if rofi_obscure is True and "rofi" in dmenu_command:
+        options = SETTINGS.passphrase_options
+        if SETTINGS.rofi_obscure is True and "rofi" in dmenu_command:
             dmenu_args.extend(["-password"])
-    extras = (["-" + str(k), str(v)] for (k, v) in args_dict.items())
+    extras = (["-" + str(k), str(v)] for (k, v) in options)
     dmenu = [dmenu_command, "-p", str(prompt)]
     dmenu.extend(dmenu_args)
     dmenu += list(itertools.chain.from_iterable(extras))
@@ -258,6 +737,141 @@ def dmenu_cmd(num_lines, prompt):
     return dmenu
 
 
+class MenuCancelled(Exception):
+    """The menu was closed because a newer request arrived (see MenuTracker)"""
+
+
+class MenuTracker:
+    """Keep the running dmenu process, so the daemon can close a stale menu
+    when a newer request arrives. After cancel() the menu of the current
+    request raises MenuCancelled, which unwinds the action, until reset().
+
+    Only the menus of the thread serving the requests (see track()) are
+    tracked. Other menus, e.g. an error of the background unlock, are
+    neither closed nor cancelled.
+
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.thread = None
+        self.proc = None
+        self.cancelled = False
+
+    def track(self):
+        """Track the menus of the calling thread"""
+        self.thread = current_thread()
+
+    def popen(self, cmd, **kwds):
+        """Start dmenu. Raises MenuCancelled if the request was cancelled"""
+        if current_thread() is not self.thread:
+            return Popen(cmd, **kwds)
+        with self.lock:
+            if self.cancelled:
+                raise MenuCancelled()
+            self.proc = Popen(cmd, **kwds)
+            return self.proc
+
+    def finish(self):
+        """Forget the finished dmenu. Raises MenuCancelled if it was closed"""
+        if current_thread() is not self.thread:
+            return
+        with self.lock:
+            self.proc = None
+            if self.cancelled:
+                raise MenuCancelled()
+
+    def cancel(self):
+        """Close the open menu, and any later menu of the same request"""
+        with self.lock:
+            self.cancelled = True
+            if self.proc is not None and self.proc.poll() is None:
+                self.proc.kill()
+
+    def reset(self):
+        """Allow menus again, for the next request"""
+        with self.lock:
+            self.cancelled = False
+
+
+MENUS = MenuTracker()
+
+
+class Span:
+    """Time a block and add it to the Tracer"""
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, time.perf_counter() - self.start)
+
+
+class Tracer:
+    """Latency spans and cache hit counters of the daemon, reported by
+    `keepmenu --stats`
+
+    Spans are only recorded with `trace = True`, otherwise span() returns a
+    shared no-op context manager. The last TRACE_WINDOW durations of each
+    span are kept for the percentiles. Cache hits are always counted.
+
+    """
+    NULL_SPAN = nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self.lock = Lock()
+        self.spans = {}
+        self.caches = {}
+
+    def span(self, name):
+        """Context manager timing the span `name`"""
+        return Span(self, name) if self.enabled else self.NULL_SPAN
+
+    def add(self, name, seconds):
+        """Record a duration of the span `name`"""
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = deque(maxlen=TRACE_WINDOW)
+            self.spans[name].append(seconds)
+
+    def cache(self, name, hit):
+        """Count a hit or miss of the cache `name`"""
+        counts = self.caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+    def stats(self):
+        """Return {'spans': {name: {count, p50_ms, p95_ms, p99_ms}},
+        'caches': {name: {hits, misses, hit_rate}}, 'uptime_sec'}
+
+        """
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.spans.items()}
+        spans = {}
+        for name, values in samples.items():
+            spans[name] = {'count': len(values)}
+            for pct in (50, 95, 99):
+                idx = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+                spans[name]['p{}_ms'.format(pct)] = round(values[idx] * 1000, 3)
+        caches = {name: {'hits': hits, 'misses': misses,
+                         'hit_rate': round(hits / (hits + misses), 3)}
+                  for name, (hits, misses) in self.caches.items()}
+        return {'uptime_sec': round(time.time() - self.started, 1),
+                'spans': spans, 'caches': caches}
+
+
+TRACE = Tracer()
+
+
 def dmenu_select(num_lines, prompt="Entries", inp=""):
     """Call dmenu and return the selected entry
 
@@ -266,14 +880,15 @@ def dmenu_select(num_lines, prompt="Entries", inp=""):
           inp - bytes string to pass to dmenu via STDIN
 
     Returns: sel - string
+    Raises: MenuCancelled if the menu was closed by MENUS.cancel()
 
     """
     cmd = dmenu_cmd(num_lines, prompt)
-    sel, err = Popen(cmd,
-                     stdin=PIPE,
-                     stdout=PIPE,
-                     stderr=PIPE,
-                     env=ENV).communicate(input=inp)
+    with TRACE.span('menu_spawn'):
+        proc = MENUS.popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, env=ENV)
+    with TRACE.span('menu_user'):
+        sel, err = proc.communicate(input=inp)
+    MENUS.finish()
     if err:
         cmd = [cmd[0]] + ["-dmenu"] if "rofi" in cmd[0] else [""]
         Popen(cmd[0], stdin=PIPE, stdout=PIPE, env=ENV).communicate(input=err)
@@ -290,9 +905,8 @@ def dmenu_err(prompt):
     return dmenu_select(1, prompt)
 
 
-def get_password_chars():
-    """Get characters to use for password generation from defaults, config file
-    and user input.
+def get_password_presets():
+    """Get the password character presets from defaults and the config file
 
     Returns: Dict {preset_name_1: {char_set_1: string, char_set_2: string},
                    preset_name_2: ....}
@@ -320,16 +934,69 @@ def get_password_chars():
             except KeyError:
                 print("Error: Unknown value in preset {}. Ignoring.".format(name))
                 continue
+    return presets
+
+
+def get_password_chars():
+    """Get characters to use for password generation from defaults, config file
+    and user input.
+
+    Returns: Dict {preset_name_1: {char_set_1: string, char_set_2: string},
+                   preset_name_2: ....}
+    """
+    presets = get_password_presets()
+    presets[PASSPHRASE_PRESET] = {}
     input_b = "\n".join(presets).encode(ENC)
     char_sel = dmenu_select(len(presets),
                             "Pick character set(s) to use", inp=input_b)
     # This dictionary return also handles Rofi multiple select
-    return {k: presets[k] for k in char_sel.split('\n')} if char_sel else False
+    return {k: presets[k] for k in char_sel.split('\n') if k in presets} \
+        if char_sel else False
+
+
+class PasswordCommand:
+    """A `password_cmd_<n>` running in the background
+
+    Args: cmd - command line (string)
+
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        # Own process group, so cancel() also kills children holding the pipes
+        self.proc = Popen(shlex.split(cmd), stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                          start_new_session=True)
+
+    def result(self, timeout=None):
+        """Wait for the command to finish
+
+        Returns: (stdout, stderr) as bytes
+        Raises: TimeoutExpired (the command is killed)
+
+        """
+        try:
+            return self.proc.communicate(timeout=timeout)
+        except TimeoutExpired:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        """Kill the command if it is still running"""
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.communicate()
 
 
 def get_database():
     """Read databases from config or ask for user input.
 
+    A `password_cmd_<n>` only runs for the selected database. With multiple
+    databases the commands are started while the selection menu is open
+    (unless `password_cmd_speculative = False`) and the unused ones are
+    killed. Commands running longer than `password_cmd_timeout_sec` are
+    killed and the passphrase is asked for instead.
+
     Returns: (database name, keyfile, passphrase)
              Returns (None, None, None) on error selecting database
 
@@ -338,6 +1005,7 @@ def get_database():
     args_dict = dict(args)
     dbases = [i for i in args_dict if i.startswith('database')]
     dbs = []
+    cmds = {}
     for dbase in dbases:
         dbn = expanduser(args_dict[dbase])
         idx = dbase.rsplit('_', 1)[-1]
@@ -349,35 +1017,48 @@ def get_database():
             passw = args_dict['password_{}'.format(idx)]
         except KeyError:
             passw = ''
-        try:
-            cmd = args_dict['password_cmd_{}'.format(idx)]
-            res = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE).communicate()
-            if res[1]:
-                dmenu_err("Password command error: {}".format(res[1]))
-                sys.exit()
-            else:
-                passw = res[0].decode().rstrip('\n') if res[0] else passw
-        except KeyError:
-            pass
         if dbn:
             dbs.append((dbn, keyfile, passw))
+            if 'password_cmd_{}'.format(idx) in args_dict:
+                cmds[dbn] = args_dict['password_cmd_{}'.format(idx)]
     if not dbs:
         res = get_initial_db()
         if res is True:
             dbs = [get_database()]
         else:
             return (None, None, None)
+    running = {}
     if len(dbs) > 1:
+        if SETTINGS.password_cmd_speculative:
+            running = {dbn: PasswordCommand(cmd) for dbn, cmd in cmds.items()}
         inp_bytes = "\n".join(i[0] for i in dbs).encode(ENC)
-        sel = dmenu_select(len(dbs), "Select Database", inp=inp_bytes)
+        try:
+            sel = dmenu_select(len(dbs), "Select Database", inp=inp_bytes)
+        finally:
+            for dbn, cmd in running.items():
+                if dbn != sel:
+                    cmd.cancel()
         dbs = [i for i in dbs if i[0] == sel]
         if not sel or not dbs:
             return (None, None, None)
-    if not dbs[0][-1]:
-        db_l = list(dbs[0])
-        db_l[-1] = get_passphrase()
-        dbs[0] = db_l
-    return dbs[0]
+    db_l = list(dbs[0])
+    DB_LOADERS[tuple(db_l[:2])] = DatabaseLoader(*db_l[:2])
+    if db_l[0] in cmds:
+        cmd = running.get(db_l[0]) or PasswordCommand(cmds[db_l[0]])
+        try:
+            res = cmd.result(SETTINGS.password_cmd_timeout or None)
+        except TimeoutExpired:
+            dmenu_err("Password command timed out after {} seconds".format(
+                SETTINGS.password_cmd_timeout))
+            res = (b"", b"")
+        if res[1]:
+            dmenu_err("Password command error: {}".format(res[1]))
+            sys.exit()
+        else:
+            db_l[-1] = res[0].decode().rstrip('\n') if res[0] else db_l[-1]
+    if not db_l[-1]:
+        db_l[-1] = load_cached_key(*db_l[:2]) or get_passphrase()
+    return tuple(db_l)
 
 
 def get_initial_db():
@@ -398,93 +1079,1543 @@ def get_initial_db():
     return True
 
 
-def get_entries(dbo):
-    """Open keepass database and return the PyKeePass object
+DB_LOADERS = {}
 
-        Args: dbo: tuple (db path, keyfile path, password)
-        Returns: PyKeePass object
+
+def keyfile_composite(keyfile):
+    """Return the keyfile part of the composite key, like pykeepass: the key
+    from an XML keyfile, a 32 byte key, a 64 character hex key or the SHA-256
+    hash of any other file
 
     """
-    dbf, keyfile, password = dbo
-    if dbf is None:
-        return None
+    with open(keyfile, 'rb') as kfile:
+        key = kfile.read()
     try:
-        kpo = PyKeePass(dbf, password, keyfile=keyfile)
-    except (FileNotFoundError, construct.core.ChecksumError) as err:
-        if str(err.args[0]).startswith("wrong checksum"):
-            dmenu_err("Invalid Password or keyfile")
-            return None
+        data = etree.fromstring(key).find('Key/Data')
+        if data is not None:
+            return base64.b64decode(data.text)
+    except etree.XMLSyntaxError:
+        pass
+    if len(key) == 32:
+        return key
+    if len(key) == 64:
         try:
-            if err.errno == errno.ENOENT:
-                if not os.path.isfile(dbf):
-                    dmenu_err("Database does not exist. Edit ~/.config/keepmenu/config.ini")
-                elif not os.path.isfile(keyfile):
-                    dmenu_err("Keyfile does not exist. Edit ~/.config/keepmenu/config.ini")
-        except AttributeError:
+            return bytes.fromhex(key.decode('ascii'))
+        except ValueError:
             pass
-        return None
-    except Exception as err:
-        dmenu_err("Error: {}".format(err))
-        return None
-    return kpo
+    return hashlib.sha256(key).digest()
 
 
-def get_passphrase():
-    """Get a database password from dmenu or pinentry
+KEYRING_KEY_PREFIX = "keepmenu:key:"
 
-    Returns: string
 
-    """
-    pinentry = None
-    if CONF.has_option("dmenu", "pinentry"):
-        pinentry = CONF.get("dmenu", "pinentry")
-    if pinentry:
-        password = ""
-        out = Popen(pinentry,
-                    stdout=PIPE,
-                    stdin=PIPE).communicate(
-                        input=b'setdesc Enter database password\ngetpin\n')[0]
-        if out:
-            res = out.decode(ENC).split("\n")[2]
-            if res.startswith("D "):
-                password = res.split("D ")[1]
-    else:
-        password = dmenu_select(0, "Passphrase")
-        if not password:
-            sys.exit()
-    return password
+class CompositeKey(bytes):
+    """The composite key of a database (the hashed passphrase and keyfile,
+    see DatabaseLoader.transformed_key), used instead of the passphrase when
+    it was read from the kernel keyring
 
+    """
 
-def tokenize_autotype(autotype):
-    """Process the autotype sequence
 
-    Args: autotype - string
-    Returns: tokens - generator ((token, if_special_char T/F), ...)
+def keyctl_search(name):
+    """Return the id (bytes) of the user key `name` in the kernel user
+    keyring, or None if it doesn't exist or keyctl isn't installed
 
     """
-    while autotype:
-        opening_idx = -1
-        for char in "{+^%~@":
-            idx = autotype.find(char)
-            if idx != -1 and (opening_idx == -1 or idx < opening_idx):
-                opening_idx = idx
+    keyctl = which('keyctl')
+    if not keyctl:
+        return None
+    return Popen([keyctl, 'search', '@u', 'user', name],
+                 stdout=PIPE, stderr=DEVNULL).communicate()[0].strip() or None
 
-        if opening_idx == -1:
-            # found the end of the string without further opening braces or
-            # other characters
-            yield autotype, False
-            return
 
-        if opening_idx > 0:
-            yield autotype[:opening_idx], False
+def keyctl_read(name):
+    """Return the payload of the user key `name`, or None"""
+    key_id = keyctl_search(name)
+    if key_id is None:
+        return None
+    return Popen([which('keyctl'), 'pipe', key_id], stdout=PIPE,
+                 stderr=DEVNULL).communicate()[0]
 
-        if autotype[opening_idx] in "+^%~@":
-            yield autotype[opening_idx], True
-            autotype = autotype[opening_idx + 1:]
-            continue
 
-        closing_idx = autotype.find('}')
-        if closing_idx == -1:
+def keyring_key_name(dbf, keyfile):
+    """Keyring description of the cached composite key of a database"""
+    return KEYRING_KEY_PREFIX + hashlib.sha256(
+        "{}\0{}".format(dbf, keyfile).encode()).hexdigest()[:16]
+
+
+def load_cached_key(dbf, keyfile):
+    """Return the composite key stored by cache_key(), or None if
+    `keyring_cache_min` is 0, keyctl isn't installed or the key timed out
+
+    Returns: CompositeKey or None
+
+    """
+    if not SETTINGS.keyring_cache_min:
+        return None
+    key = keyctl_read(keyring_key_name(dbf, keyfile))
+    return CompositeKey(key) if key and len(key) == 32 else None
+
+
+def cache_key(dbf, keyfile, composite):
+    """Keep the composite key in the kernel user keyring, so a restarted
+    daemon can unlock the database without asking for the passphrase. The
+    kernel removes the key after `keyring_cache_min` minutes. It is never
+    written to disk.
+
+    Returns: True if the key was stored
+
+    """
+    keyctl = which('keyctl')
+    if not SETTINGS.keyring_cache_min or not keyctl:
+        return False
+    proc = Popen([keyctl, 'padd', 'user', keyring_key_name(dbf, keyfile), '@u'],
+                 stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+    key_id = proc.communicate(input=composite)[0].strip()
+    if proc.returncode != 0 or not key_id:
+        return False
+    if call([keyctl, 'timeout', key_id, str(SETTINGS.keyring_cache_min * 60)],
+            stdout=DEVNULL, stderr=DEVNULL) != 0:
+        # Don't keep a key that wouldn't expire
+        call([keyctl, 'unlink', key_id, '@u'], stdout=DEVNULL, stderr=DEVNULL)
+        return False
+    return True
+
+
+def forget_cached_key(dbf, keyfile):
+    """Remove the cached composite key, e.g. after the passphrase changed"""
+    key_id = keyctl_search(keyring_key_name(dbf, keyfile))
+    if key_id is not None:
+        call([which('keyctl'), 'unlink', key_id, '@u'], stdout=DEVNULL, stderr=DEVNULL)
+
+
+class PrefetchedKeePass(PyKeePass):
+    """PyKeePass object parsed from database contents already read into
+    memory (see DatabaseLoader) instead of reading the file again. Saving
+    and reading again use the filename like PyKeePass.
+
+    Args: filename - database path
+          data - database file contents
+
+    """
+    def __init__(self, filename, data, password=None, keyfile=None,
+                 transformed_key=None):
+        # pylint: disable=super-init-not-called
+        self.read(filename, password, keyfile, transformed_key, io.BytesIO(data))
+
+    def read(self, filename=None, password=None, keyfile=None,
+             transformed_key=None, stream=None):
+        """Like PyKeePass.read, but parse `stream` if given
+
+        """
+        if stream is None:
+            return super().read(filename, password, keyfile, transformed_key)
+        self.password = password
+        self.keyfile = keyfile
+        self.filename = filename or self.filename
+        try:
+            self.kdbx = KDBX.parse_stream(stream, password=password, keyfile=keyfile,
+                                          transformed_key=transformed_key)
+        except construct.core.ChecksumError as err:
+            # Same mapping as PyKeePass.read
+            if err.path in ('(parsing) -> body -> cred_check',
+                            '(parsing) -> cred_check'):
+                raise CredentialsError from err
+            if err.path == '(parsing) -> body -> sha256':
+                raise HeaderChecksumError from err
+            if err.path in ('(parsing) -> body -> payload -> hmac_hash',
+                            '(parsing) -> xml -> block_hash'):
+                raise PayloadChecksumError from err
+            raise
+        return None
+
+
+class DatabaseLoader:
+    """Open a database in two steps so the slow parts overlap with the
+    passphrase prompt: the constructor starts a thread that reads the
+    database file, parses the outer header and reads the keyfile; open()
+    runs the KDF as soon as the password is known and decrypts the already
+    loaded data, into a DatabaseView or a PrefetchedKeePass object.
+
+    An opened loader is kept in DB_LOADERS with the last transformed key, so
+    reopening the database (after an edit or shed_memory()) only re-reads
+    the file. The KDF runs again if its parameters in the header changed.
+    The password can be a CompositeKey from the kernel keyring instead.
+
+    Args: dbf - database path
+          keyfile - keyfile path or ''
+
+    """
+    def __init__(self, dbf, keyfile):
+        self.dbf = dbf
+        self.keyfile = keyfile
+        self.data = self.header = self.header_data = self.mtime = None
+        self.keyfile_key = b''
+        self.error = None
+        self.key = (None, None)
+        self.key_cached = False
+        self.thread = Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _prefetch(self):
+        try:
+            with open(self.dbf, 'rb') as dbfile:
+                self.mtime = os.fstat(dbfile.fileno()).st_mtime_ns
+                self.data = dbfile.read()
+            header = KDBX.subcons[0].parse(self.data)
+            self.header, self.header_data = header.value, header.data
+            if self.keyfile:
+                self.keyfile_key = keyfile_composite(self.keyfile)
+        except Exception as err:  # pylint: disable=broad-except
+            self.error = err
+
+    def transformed_key(self, password, header=None):
+        """Run the KDF from the header parameters
+
+        Args: header - parsed outer header, default the one of the database
+        Returns: transformed key (bytes) or None if the KDF isn't supported
+                 here (pykeepass is left to handle or reject it)
+
+        """
+        header = header or self.header
+        if isinstance(password, CompositeKey):
+            composite = bytes(password)
+        else:
+            composite = hashlib.sha256(
+                (hashlib.sha256(password.encode('utf-8')).digest() if password else b'') +
+                self.keyfile_key).digest()
+        dyn = header.dynamic_header
+        if header.major_version == 3:
+            kdf_params = (dyn.transform_seed.data, dyn.transform_rounds.data)
+        else:
+            kdf_params = tuple(sorted((k, v.value) for k, v in
+                                      dyn.kdf_parameters.data.dict.items()))
+        if self.key[0] == (composite, kdf_params):
+            TRACE.cache('kdf', True)
+            return self.key[1]
+        TRACE.cache('kdf', False)
+        key = self._kdf(header, composite)
+        self.key = ((composite, kdf_params), key)
+        return key
+
+    @staticmethod
+    def _kdf(header, composite):
+        dyn = header.dynamic_header
+        if header.major_version == 3:
+            return aes_kdf(dyn.transform_seed.data, dyn.transform_rounds.data, composite)
+        params = dyn.kdf_parameters.data.dict
+        if params['$UUID'].value == kdf_uuids['aeskdf']:
+            return aes_kdf(params['S'].value, params['R'].value, composite)
+        if params['$UUID'].value == kdf_uuids['argon2']:
+            return argon2.low_level.hash_secret_raw(
+                secret=composite, salt=params['S'].value, hash_len=32,
+                type=argon2.low_level.Type.D, time_cost=params['I'].value,
+                memory_cost=params['M'].value // 1024,
+                parallelism=params['P'].value, version=params['V'].value)
+        return None
+
+    def open(self, password, readonly=False):
+        """Wait for the prefetch, derive the key and decrypt the database
+
+        Args: readonly - stream the database into a DatabaseView instead of
+                         building the full PyKeePass object. If the KDF isn't
+                         supported here, pykeepass opens the database and the
+                         view is built from it.
+        Returns: PyKeePass object or DatabaseView, with the `file_mtime`
+                 (st_mtime_ns) of the file read, see sync_database()
+        Raises: the errors PyKeePass raises for the same database
+
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.data is None or os.stat(self.dbf).st_mtime_ns != self.mtime:
+            self._prefetch()
+            if self.error is not None:
+                raise self.error
+        key = self.transformed_key(password)
+        if readonly and key is not None:
+            kpo = read_database(self.data, key, self.dbf)
+        else:
+            kpo = PrefetchedKeePass(self.dbf, self.data, password, keyfile=self.keyfile,
+                                    transformed_key=key)
+        kpo.file_mtime = self.mtime
+        if readonly and key is None:
+            kpo = database_view(kpo)
+        self.data = None
+        return kpo
+
+
+# The KDBX structure with the payload decrypted but not decoded: the
+# (compressed) XML for KDBX 3 and the (compressed) inner header and XML for
+# KDBX 4. Credentials and block hashes are checked like in pykeepass.
+RAW_PAYLOAD_KDBX = construct.Struct(
+    KDBX.subcons[0],
+    "body" / construct.Switch(
+        construct.this.header.value.major_version,
+        {3: construct.Struct(
+            *kdbx3.Body.subcons[:2],
+            "payload" / Reparsed(construct.Struct(
+                "cred_check" / construct.Checksum(
+                    construct.Bytes(32),
+                    lambda this: this._._.header.value.dynamic_header.stream_start_bytes.data,
+                    construct.this
+                ),
+                "xml" / Concatenated(kdbx3.PayloadBlocks)
+            ))(construct.Switch(
+                construct.this._.header.value.dynamic_header.cipher_id.data,
+                {'aes256': AES256Payload(construct.GreedyBytes),
+                 'chacha20': ChaCha20Payload(construct.GreedyBytes),
+                 'twofish': TwoFishPayload(construct.GreedyBytes)}
+            ))
+         ),
+         4: construct.Struct(*kdbx4.Body.subcons[:4], "payload" / kdbx4.DecryptedPayload)}
+    )
+)
+
+# Inner header stream ids (KDBX 4)
+PROTECTED_STREAMS = {2: 'salsa20', 3: 'chacha20'}
+
+INVALID_XML_CHARS_RE = re.compile(
+    '[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+')
+
+
+SALSA20_NONCE = b'\xE8\x30\x09\x4B\x97\x20\x5D\x2A'
+
+SALSA20_CONSTANTS = (0x61707865, 0x3320646e, 0x79622d32, 0x6b206574)
+
+# Column round then row round
+SALSA20_QUARTER_ROUNDS = ((0, 4, 8, 12), (5, 9, 13, 1), (10, 14, 2, 6), (15, 3, 7, 11),
+                          (0, 1, 2, 3), (5, 6, 7, 4), (10, 11, 8, 9), (15, 12, 13, 14))
+
+
+def salsa20_block(key, nonce, counter):
+    """Return the 64 byte Salsa20/20 keystream block number `counter`.
+    Cryptodome's Salsa20 can't seek, this is only used for the few blocks
+    of a protected value.
+
+    Args: key - 32 bytes
+          nonce - 8 bytes
+
+    """
+    k = struct.unpack('<8I', key)
+    const = SALSA20_CONSTANTS
+    state = (const[0], *k[:4], const[1], *struct.unpack('<2I', nonce),
+             counter & 0xffffffff, counter >> 32, const[2], *k[4:], const[3])
+    x = list(state)
+    for _ in range(10):
+        for a, b, c, d in SALSA20_QUARTER_ROUNDS:
+            t = (x[a] + x[d]) & 0xffffffff
+            x[b] ^= ((t << 7) | (t >> 25)) & 0xffffffff
+            t = (x[b] + x[a]) & 0xffffffff
+            x[c] ^= ((t << 9) | (t >> 23)) & 0xffffffff
+            t = (x[c] + x[b]) & 0xffffffff
+            x[d] ^= ((t << 13) | (t >> 19)) & 0xffffffff
+            t = (x[d] + x[c]) & 0xffffffff
+            x[a] ^= ((t << 18) | (t >> 14)) & 0xffffffff
+    return struct.pack('<16I', *((i + j) & 0xffffffff for i, j in zip(x, state)))
+
+
+class ProtectedStream:
+    """The inner stream cipher of a database. Decrypts a protected value at
+    its position in the keystream, so values can be decrypted one at a time
+    and in any order.
+
+    Args: stream_id - 'salsa20' or 'chacha20'
+          key - protected stream key from the header
+
+    """
+    def __init__(self, stream_id, key):
+        if stream_id == 'salsa20':
+            self.key, self.nonce = hashlib.sha256(key).digest(), SALSA20_NONCE
+        elif stream_id == 'chacha20':
+            key_hash = hashlib.sha512(key).digest()
+            self.key, self.nonce = key_hash[:32], key_hash[32:44]
+        else:
+            raise ValueError("Unsupported protected stream: {}".format(stream_id))
+        self.stream_id = stream_id
+
+    def decrypt(self, position, data):
+        """Decrypt data which starts `position` bytes into the keystream"""
+        if self.stream_id == 'chacha20':
+            cipher = ChaCha20.new(key=self.key, nonce=self.nonce)
+            cipher.seek(position)
+            return cipher.decrypt(data)
+        block, skip = divmod(position, 64)
+        keystream = b''.join(salsa20_block(self.key, self.nonce, block + i)
+                             for i in range((skip + len(data) + 63) // 64))
+        return (int.from_bytes(data, 'little') ^
+                int.from_bytes(keystream[skip:skip + len(data)], 'little')
+                ).to_bytes(len(data), 'little')
+
+
+class ProtectedValue:
+    """A protected string field kept encrypted until it is needed
+
+    Args: stream - ProtectedStream
+          position - offset of the value in the keystream
+          data - encrypted value
+
+    """
+    __slots__ = ('stream', 'position', 'data')
+
+    def __init__(self, stream, position, data):
+        self.stream = stream
+        self.position = position
+        self.data = data
+
+    def __bool__(self):
+        return bool(self.data)
+
+    def reveal(self):
+        """Return the decrypted value"""
+        return INVALID_XML_CHARS_RE.sub(
+            '', self.stream.decrypt(self.position, self.data).decode('utf-8'))
+
+
+def read_chunks(stream, size):
+    """Yield `size` bytes from a file object in chunks"""
+    while size > 0:
+        chunk = stream.read(min(size, InflatingReader.chunk_size))
+        if not chunk:
+            return
+        size -= len(chunk)
+        yield chunk
+
+
+def gzip_chunks(chunks):
+    """Gzip compress an iterable of bytes
+
+    Returns: bytes
+
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    data = [compressor.compress(i) for i in chunks]
+    data.append(compressor.flush())
+    return b''.join(data)
+
+
+def read_inner_header(stream):
+    """Read the KDBX 4 inner header from the payload stream. Attachments are
+    gzip compressed while they are read (see StoredBinary).
+
+    Returns: (protected stream id, protected stream key, list of StoredBinary)
+
+    """
+    stream_id = key = None
+    binaries = []
+    while True:
+        field, size = struct.unpack('<BI', stream.read(5))
+        if field == 0:
+            stream.read(size)
+            return stream_id, key, binaries
+        if field == 3:
+            stream.read(1)  # Memory protection flag
+            binaries.append(StoredBinary(gzip_chunks(read_chunks(stream, size - 1)), True))
+            continue
+        data = stream.read(size)
+        if field == 1:
+            stream_id = PROTECTED_STREAMS.get(struct.unpack('<I', data)[0])
+        elif field == 2:
+            key = data
+
+
+class InflatingReader:
+    """Read-only file object which decompresses a gzip (or zlib) payload as
+    it is read, so the decompressed data is never held in memory at once.
+    Data after the end of the compressed stream (cipher padding) is ignored.
+
+    Args: data - compressed bytes
+
+    """
+    chunk_size = 1 << 16
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.inflater = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        have = len(self.buffer)
+        while size < 0 or have < size:
+            if self.inflater.eof:
+                break
+            if self.inflater.unconsumed_tail:
+                data = self.inflater.unconsumed_tail
+            elif self.pos < len(self.data):
+                data = self.data[self.pos:self.pos + self.chunk_size]
+                self.pos += self.chunk_size
+            else:
+                break
+            chunks.append(self.inflater.decompress(data, self.chunk_size))
+            have += len(chunks[-1])
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def seek(self, offset, whence=io.SEEK_CUR):
+        """Skip forward `offset` bytes (only relative seeks are supported)"""
+        if whence != io.SEEK_CUR or offset < 0:
+            raise io.UnsupportedOperation("Only forward relative seeks are supported")
+        while offset > 0:
+            skipped = len(self.read(min(offset, self.chunk_size)))
+            if not skipped:
+                break
+            offset -= skipped
+
+
+class CompactEntry:
+    """Read-only entry from read_database(). Has the Entry attributes used
+    to list, type and view entries, but no XML element. Protected fields
+    are kept as ProtectedValue and decrypted each time they are read.
+
+    """
+    __slots__ = ('uuid', 'path', 'strings', 'autotype_enabled', 'autotype_sequence',
+                 'attachments', '_kp', '__weakref__')
+
+    def __init__(self, kp, uuid, strings, autotype_enabled, autotype_sequence, group_path,
+                 attachments=()):
+        self._kp = kp
+        self.uuid = uuid
+        self.strings = strings
+        self.autotype_enabled = autotype_enabled
+        self.autotype_sequence = autotype_sequence
+        self.attachments = attachments
+        self.path = '{}{}'.format(group_path, self.title)
+
+    def _field(self, key):
+        value = self.strings.get(key)
+        return value.reveal() if isinstance(value, ProtectedValue) else value
+
+    @property
+    def title(self):
+        return self._field('Title')
+
+    @property
+    def username(self):
+        return self._field('UserName')
+
+    @property
+    def password(self):
+        return self._field('Password')
+
+    @property
+    def url(self):
+        return self._field('URL')
+
+    @property
+    def notes(self):
+        return self._field('Notes')
+
+    @property
+    def custom_properties(self):
+        return {k: self._field(k) for k in self.strings if k not in reserved_keys}
+
+    def get_custom_property(self, key):
+        return self._field(key) if key not in reserved_keys else None
+
+
+# An attachment of a CompactEntry. `id` is the key in DatabaseView.binaries
+AttachmentRef = namedtuple('AttachmentRef', 'filename id')
+
+# An attachment payload. `data` is bytes, or a ProtectedValue for protected
+# KDBX 3 binaries; `compressed` is True for gzip data.
+StoredBinary = namedtuple('StoredBinary', 'data compressed')
+
+
+class DatabaseView:
+    """Read-only copy of the entries of a database (see read_database)
+
+    Attributes: filename - database path
+                entries - list of CompactEntry, in the order of kpo.entries
+                group_names - set of all group names
+                binaries - dict of StoredBinary by id, kept compressed
+                file_mtime - st_mtime_ns of the database file when it was read
+
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.file_mtime = None
+        self.entries = []
+        self.group_names = set()
+        self.binaries = {}
+
+    def attachment_reader(self, attachment):
+        """Return a file object which decompresses the attachment as it is
+        read
+
+        Args: attachment - AttachmentRef
+        Raises: KeyError if the binary doesn't exist
+
+        """
+        binary = self.binaries[attachment.id]
+        data = binary.data
+        if isinstance(data, ProtectedValue):
+            data = data.stream.decrypt(data.position, data.data)
+        return InflatingReader(data) if binary.compressed else io.BytesIO(data)
+
+
+def read_database(data, transformed_key, filename=None):
+    """Decrypt a database and stream its XML into a DatabaseView. Neither the
+    decompressed XML nor the element tree is kept in memory as a whole:
+    elements are cleared as soon as they are read and entry history is
+    skipped. Attachments are kept compressed. Protected values aren't
+    decrypted, only their keystream positions are recorded (see
+    ProtectedValue).
+
+    Args: data - database file contents
+          transformed_key - key from DatabaseLoader.transformed_key
+          filename - database path
+
+    Returns: DatabaseView
+    Raises: construct.core.ChecksumError for invalid credentials
+
+    """
+    kdbx = RAW_PAYLOAD_KDBX.parse(data, password=None, keyfile=None,
+                                  transformed_key=transformed_key)
+    header = kdbx.header.value
+    payload = kdbx.body.payload
+    payload = payload.xml if header.major_version == 3 else payload
+    if header.dynamic_header.compression_flags.data.compression:
+        stream = InflatingReader(payload)
+    else:
+        stream = io.BytesIO(payload)
+    del kdbx, payload
+    view = DatabaseView(filename)
+    if header.major_version == 3:
+        protected = ProtectedStream(header.dynamic_header.protected_stream_id.data,
+                                    header.dynamic_header.protected_stream_key.data)
+    else:
+        stream_id, key, binaries = read_inner_header(stream)
+        protected = ProtectedStream(stream_id, key)
+        view.binaries = dict(enumerate(binaries))
+    position = 0  # Keystream position of the next protected value
+    paths = {}  # Group element: path of its entries
+    for _, elem in etree.iterparse(stream, tag=('Entry', 'Group', 'Binary', 'Meta')):
+        tag = elem.tag
+        if tag == 'Entry':
+            if elem.getparent().tag == 'History':
+                continue
+            # Keystream positions follow the document order, history included
+            strings = {}
+            attachments = []
+            for child in elem:
+                if child.tag == 'String':
+                    value = child.find('Value')
+                    text = value.text
+                    if text and value.get('Protected') == 'True':
+                        text = ProtectedValue(protected, position, base64.b64decode(text))
+                        position += len(text.data)
+                    strings[child.findtext('Key')] = text
+                elif child.tag == 'Binary':
+                    attachments.append(AttachmentRef(child.findtext('Key'),
+                                                     int(child.find('Value').get('Ref'))))
+                elif child.tag == 'History':
+                    # Only the length of the history values is needed
+                    text = ''.join(child.xpath(".//Value[@Protected='True']/text()"))
+                    position += len(text) // 4 * 3 - text.count('=')
+            group = elem.getparent()
+            if group not in paths:
+                # The root group isn't part of the path
+                names = [i.findtext('Name') for i in elem.iterancestors('Group')][-2::-1]
+                paths[group] = ''.join('{}/'.format(i) for i in names if i is not None)
+            enabled = elem.findtext('AutoType/Enabled') or None
+            view.entries.append(CompactEntry(
+                view,
+                UUID(bytes=base64.b64decode(elem.findtext('UUID'))),
+                strings,
+                None if enabled is None else enabled == 'True',
+                elem.findtext('AutoType/DefaultSequence') or None,
+                paths[group],
+                tuple(attachments)))
+        elif tag == 'Group':
+            view.group_names.add(elem.findtext('Name'))
+            paths.pop(elem, None)
+        elif tag == 'Binary':
+            if elem.getparent().tag != 'Binaries':
+                continue
+            # KDBX 3 attachments, in Meta before the entries
+            data = base64.b64decode(elem.text or '')
+            compressed = elem.get('Compressed') == 'True'
+            if elem.get('Protected') == 'True':
+                data = ProtectedValue(protected, position, data)
+                position += len(data.data)
+            elif not compressed:
+                data, compressed = gzip_chunks((data,)), True
+            view.binaries[int(elem.get('ID'))] = StoredBinary(data, compressed)
+        elem.clear()
+    return view
+
+
+LISTING_CACHE_DIR = expanduser("~/.cache/keepmenu")
+
+LISTING_KEY_NAME = "keepmenu:listing"
+
+ListingRecord = namedtuple('ListingRecord', 'uuid title path username url')
+
+
+def listing_records(kpo):
+    """The entry listing of a database, without any secrets
+
+    Args: kpo - PyKeePass object or DatabaseView
+    Returns: list of ListingRecord
+
+    """
+    return [ListingRecord(e.uuid.hex, e.title, e.path, e.username, e.url) for e in kpo.entries]
+
+
+def database_header_data(dbf):
+    """The outer header of a database file (bytes). Only the header is read."""
+    with open(dbf, 'rb') as dbfile:
+        return KDBX.subcons[0].parse_stream(dbfile).data
+
+
+def database_header_hash(dbf):
+    """SHA-256 hex digest of the outer header of a database file"""
+    return hashlib.sha256(database_header_data(dbf)).hexdigest()
+
+
+def listing_cache_key(create=False):
+    """Return the key for the listing cache: a random key kept in the kernel
+    user keyring (`keyctl`), or in a 0600 file in $XDG_RUNTIME_DIR if keyctl
+    isn't installed. Both are gone after a reboot, which invalidates the
+    cache.
+
+    Args: create - create the key if it doesn't exist
+    Returns: 32 byte key, or None
+
+    """
+    keyctl = which('keyctl')
+    if keyctl:
+        key = keyctl_read(LISTING_KEY_NAME)
+        if key and len(key) == 32:
+            return key
+        if not create:
+            return None
+        key = os.urandom(32)
+        proc = Popen([keyctl, 'padd', 'user', LISTING_KEY_NAME, '@u'],
+                     stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+        proc.communicate(input=key)
+        return key if proc.returncode == 0 else None
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        return None
+    key_file = os.path.join(runtime_dir, "keepmenu-listing.key")
+    try:
+        with open(key_file, 'rb') as kfile:
+            key = kfile.read()
+        if len(key) == 32:
+            return key
+    except OSError:
+        pass
+    if not create:
+        return None
+    key = os.urandom(32)
+    with open(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as kfile:
+        kfile.write(key)
+    return key
+
+
+def listing_cache_file(dbf):
+    """Cache file for a database, named after a hash of its path"""
+    name = hashlib.sha256(os.path.abspath(dbf).encode()).hexdigest()[:16]
+    return os.path.join(LISTING_CACHE_DIR, "listing-{}.cache".format(name))
+
+
+def save_listing_cache(dbf, kpo):
+    """Write the encrypted listing (UUID, title, path, username and URL of
+    each entry, no secrets) of a database with its header hash
+
+    """
+    key = listing_cache_key(create=True)
+    if key is None:
+        return
+    data = json.dumps({
+        "header": database_header_hash(dbf),
+        "entries": listing_records(kpo),
+    }).encode('utf-8')
+    cipher = AES.new(key, AES.MODE_GCM)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    os.makedirs(LISTING_CACHE_DIR, mode=0o700, exist_ok=True)
+    cache_file = listing_cache_file(dbf)
+    with open(os.open(cache_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+              'wb') as cfile:
+        cfile.write(cipher.nonce + tag + ciphertext)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+def load_listing_cache(dbf):
+    """Read the listing cache of a database. A cache that can't be
+    decrypted or whose header hash doesn't match the database is deleted.
+
+    Returns: list of ListingRecord, or None
+
+    """
+    cache_file = listing_cache_file(dbf)
+    if not exists(cache_file):
+        return None
+    key = listing_cache_key()
+    try:
+        with open(cache_file, 'rb') as cfile:
+            raw = cfile.read()
+        if key is None:
+            raise ValueError("No listing cache key")
+        cipher = AES.new(key, AES.MODE_GCM, nonce=raw[:16])
+        data = json.loads(cipher.decrypt_and_verify(raw[32:], raw[16:32]).decode('utf-8'))
+        if data["header"] != database_header_hash(dbf):
+            raise ValueError("Database header changed")
+    except (OSError, ValueError, KeyError, construct.ConstructError) as err:
+        LOG.info("Discarding listing cache: %s", err)
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+        return None
+    return [ListingRecord(*i) for i in data["entries"]]
+
+
+JOURNAL_MAGIC = b"KMJ1"
+
+JOURNAL_SUFFIX = ".journal"
+
+JOURNALS = {}
+
+
+def fsync_dir(path):
+    """fsync the directory containing path, so a rename is durable"""
+    fdesc = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fdesc)
+    finally:
+        os.close(fdesc)
+
+
+class EditJournal:
+    """Encrypted append-only log of edits, kept next to the database as
+    <database>.journal when `journal = True`. Edits are appended and
+    fsynced instead of saving the whole database, replayed when the
+    database is opened and written into it by compact_journal().
+
+    The file starts with a random salt and the outer header of the database
+    the journal was started for; the key is derived from the transformed key
+    for that header, so the journal stays readable if the database is saved
+    with other KDF parameters meanwhile. Each record is a JSON edit (see
+    apply_edit) encrypted with AES-GCM, authenticated with its record number.
+
+    A torn or corrupt record ends the journal and is cut off when the journal
+    is read. A journal whose first record can't be decrypted (e.g. the master
+    password changed) is moved aside to <journal>.unreadable instead.
+
+    Args: path - journal file
+    Attributes: transformed_key - function(header) returning the transformed
+                                  key, set when the database is opened
+                header_data - outer header of the database, used to start a
+                              new journal
+                count - number of records
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.transformed_key = None
+        self.header_data = None
+        self.lock = Lock()
+        self.key = None
+        self.count = 0
+
+    def _key(self, salt, header_data):
+        header = KDBX.subcons[0].parse(header_data).value
+        return hmac.new(self.transformed_key(header), b"keepmenu journal" + salt,
+                        hashlib.sha256).digest()
+
+    def _encrypt(self, record, idx):
+        cipher = AES.new(self.key, AES.MODE_GCM)
+        cipher.update(struct.pack('<Q', idx))
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(record).encode('utf-8'))
+        return struct.pack('<I', 32 + len(ciphertext)) + cipher.nonce + tag + ciphertext
+
+    def _load(self):
+        """Read and decrypt the records, cutting off a torn tail
+
+        Returns: list of records
+
+        """
+        try:
+            with open(self.path, 'rb') as jfile:
+                data = jfile.read()
+        except FileNotFoundError:
+            self.key, self.count = None, 0
+            return []
+        records = []
+        pos = 22
+        if data[:4] == JOURNAL_MAGIC and len(data) >= pos:
+            pos += struct.unpack('<H', data[20:22])[0]
+            self.key = self._key(data[4:20], data[22:pos])
+            while pos + 4 <= len(data):
+                size = struct.unpack('<I', data[pos:pos + 4])[0]
+                record = data[pos + 4:pos + 4 + size]
+                if len(record) != size or size < 32:
+                    break
+                cipher = AES.new(self.key, AES.MODE_GCM, nonce=record[:16])
+                cipher.update(struct.pack('<Q', len(records)))
+                try:
+                    records.append(json.loads(cipher.decrypt_and_verify(record[32:],
+                                                                         record[16:32])))
+                except ValueError:
+                    if not records:
+                        LOG.warning("Can't decrypt edit journal, moved to %s.unreadable",
+                                    self.path)
+                        os.replace(self.path, self.path + ".unreadable")
+                        self.key, self.count = None, 0
+                        return []
+                    break
+                pos += 4 + size
+        if pos < len(data):
+            LOG.warning("Edit journal: discarding %d bytes of a torn record", len(data) - pos)
+            with open(self.path, 'r+b') as jfile:
+                jfile.truncate(pos if self.key is not None else 0)
+                os.fsync(jfile.fileno())
+        if self.key is None:
+            os.remove(self.path)
+        self.count = len(records)
+        return records
+
+    def _write(self, records):
+        """Start a new journal for `header_data` holding records"""
+        salt = os.urandom(16)
+        self.key = self._key(salt, self.header_data)
+        data = [JOURNAL_MAGIC, salt, struct.pack('<H', len(self.header_data)), self.header_data]
+        data.extend(self._encrypt(record, idx) for idx, record in enumerate(records))
+        tmp = self.path + ".tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as jfile:
+            jfile.write(b''.join(data))
+            os.fsync(jfile.fileno())
+        os.replace(tmp, self.path)
+        fsync_dir(self.path)
+        self.count = len(records)
+
+    def read(self):
+        """Returns: list of records"""
+        with self.lock:
+            return self._load()
+
+    def append(self, record):
+        """Encrypt a record, append it and fsync the journal"""
+        with self.lock:
+            if self.key is None:
+                self._write([record])
+                return
+            data = self._encrypt(record, self.count)
+            with open(self.path, 'ab') as jfile:
+                jfile.write(data)
+                jfile.flush()
+                os.fsync(jfile.fileno())
+            self.count += 1
+
+    def discard(self, count):
+        """Remove the first `count` records, after they were written into the
+        database. Set `header_data` to the header of the written database
+        first, the remaining records are moved to a new journal for it.
+
+        """
+        with self.lock:
+            records = self._load()[count:]
+            if records:
+                self._write(records)
+            elif self.key is not None:
+                os.remove(self.path)
+                fsync_dir(self.path)
+                self.key, self.count = None, 0
+
+
+def open_journal(dbf, loader, password):
+    """Return the EditJournal of a database, with the key and header of the
+    opened database
+
+    """
+    journal = JOURNALS.setdefault(dbf, EditJournal(dbf + JOURNAL_SUFFIX))
+    journal.transformed_key = partial(loader.transformed_key, password)
+    journal.header_data = loader.header_data
+    return journal
+
+
+KDBX4_EPOCH = 62135596800  # Seconds from 0001-01-01 to 1970-01-01
+
+# Times which are not timestamps
+TIMES_NOT_TIMESTAMPS = ('Expires', 'UsageCount')
+
+
+def kdbx_time(text):
+    """Seconds since the epoch of a KDBX4 (base64) or KDBX3 (ISO 8601) time
+
+    """
+    if text[4:5] == '-' and text[10:11] == 'T':
+        return calendar.timegm((int(text[:4]), int(text[5:7]), int(text[8:10]),
+                                int(text[11:13]), int(text[14:16]), int(text[17:19])))
+    return struct.unpack('<Q', base64.b64decode(text))[0] - KDBX4_EPOCH
+
+
+def kdbx_time_text(seconds, kdbx4):
+    """Encode seconds since the epoch as a KDBX4 or KDBX3 time"""
+    if kdbx4:
+        return base64.b64encode(struct.pack('<Q', seconds + KDBX4_EPOCH)).decode('utf-8')
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def element_time(elem, name='LastModificationTime'):
+    """Return a time of an entry or group element, 0 if it isn't set"""
+    text = elem.findtext('Times/' + name)
+    return kdbx_time(text) if text else 0
+
+
+def set_element_time(kpo, elem, name, seconds):
+    """Set a time of an entry or group element of a Keepass object"""
+    times = elem.find('Times')
+    if times is None:
+        times = etree.SubElement(elem, 'Times')
+    node = times.find(name)
+    if node is None:
+        node = etree.SubElement(times, name)
+    node.text = kdbx_time_text(seconds, kpo.version >= (4, 0))
+
+
+def deleted_objects(kpo):
+    """Return the DeletedObjects element of a Keepass object, added if missing"""
+    root = kpo.tree.find('Root')
+    deleted = root.find('DeletedObjects')
+    if deleted is None:
+        deleted = etree.SubElement(root, 'DeletedObjects')
+    return deleted
+
+
+def record_deletion(kpo, elem, seconds):
+    """Add an entry or group and the entries and groups in it to the
+    DeletedObjects of a Keepass object, so merge_database() deletes them from
+    other copies of the database
+
+    """
+    deleted = deleted_objects(kpo)
+    for item in elem.iter('Entry', 'Group'):
+        if item.getparent().tag != 'History':
+            obj = etree.SubElement(deleted, 'DeletedObject')
+            etree.SubElement(obj, 'UUID').text = item.findtext('UUID')
+            etree.SubElement(obj, 'DeletionTime').text = \
+                kdbx_time_text(seconds, kpo.version >= (4, 0))
+
+
+def uuid_elements(kpo):
+    """Index the entries (without history items) and groups of a Keepass
+    object for apply_edit()
+
+    Returns: dict of UUID hex: Entry or Group
+
+    """
+    elements = {}
+    for elem in kpo.tree.iter('Entry', 'Group'):
+        if elem.getparent().tag != 'History':
+            cls = Entry if elem.tag == 'Entry' else Group
+            elements[UUID(bytes=base64.b64decode(elem.findtext('UUID'))).hex] = \
+                cls(element=elem, kp=kpo)
+    return elements
+
+
+def apply_edit(kpo, record, elements):
+    """Apply an edit to a Keepass object. Edits are recorded by UUID:
+
+        {'op': 'set', 'uuid': entry, 'field': name, 'value': value}
+        {'op': 'add_entry', 'uuid': new entry, 'group': group, 'title': title,
+         'username': username, 'password': password}
+        {'op': 'add_group', 'uuid': new group, 'group': parent, 'name': name}
+        {'op': 'rename_group', 'uuid': group, 'name': name}
+        {'op': 'move_entry' or 'move_group', 'uuid': entry or group, 'group': dest}
+        {'op': 'delete_entry' or 'delete_group', 'uuid': entry or group}
+
+    The 'time' of an edit (seconds since the epoch, default now) is set as
+    the modification, location or deletion time, for merge_database().
+
+    Applying an edit again has no effect, so a journal can be replayed over a
+    database which already has some of its edits. Edits of entries or groups
+    which no longer exist are skipped.
+
+    Args: elements - see uuid_elements(). Added entries and groups are added.
+    Returns: the edited or added Entry or Group, or None if skipped
+
+    """
+    op = record['op']
+    element = elements.get(record['uuid'])
+    group = elements.get(record.get('group'))
+    now = record.get('time') or int(time.time())
+    if op in ('add_entry', 'add_group'):
+        if element is not None or group is None:
+            return element
+        if op == 'add_entry':
+            element = kpo.add_entry(group, record['title'], record['username'],
+                                    record['password'])
+        else:
+            element = kpo.add_group(group, record['name'])
+        element.uuid = UUID(record['uuid'])
+        for name in ('CreationTime', 'LastModificationTime', 'LocationChanged'):
+            set_element_time(kpo, element._element, name, now)
+        elements[record['uuid']] = element
+        return element
+    if element is None or ('group' in record and group is None):
+        LOG.info("Skipping edit %s of a deleted entry or group", op)
+        return None
+    if op == 'set':
+        setattr(element, record['field'], record['value'])
+    elif op in ('move_entry', 'move_group'):
+        group.append(element)
+    elif op == 'rename_group':
+        element.name = record['name']
+    elif op in ('delete_entry', 'delete_group'):
+        record_deletion(kpo, element._element, now)
+        element.delete()
+        return element
+    set_element_time(kpo, element._element,
+                     'LocationChanged' if op.startswith('move') else 'LastModificationTime', now)
+    return element
+
+
+def record_edit(kpo, op, element=None, **args):
+    """Apply an edit (see apply_edit) and append it to the edit journal when
+    `journal = True`. Sets `kpo.edited` until DmenuRunner.save_db().
+
+    Args: element - the edited Entry or Group, None to add one
+          args - edit arguments. Groups are recorded by UUID.
+    Returns: the edited or added Entry or Group
+
+    """
+    record = {'op': op, 'uuid': (element.uuid if element is not None else uuid4()).hex,
+              'time': int(time.time())}
+    record.update({k: v.uuid.hex if isinstance(v, Group) else v for k, v in args.items()})
+    elements = {i.uuid.hex: i for i in [element, *args.values()] if isinstance(i, (Entry, Group))}
+    element = apply_edit(kpo, record, elements)
+    ENTRY_INDEXES.pop(kpo, None)
+    kpo.edited = True
+    journal = getattr(kpo, 'journal', None)
+    if journal is not None and SETTINGS.journal:
+        journal.append(record)
+    return element
+
+
+def save_database(kpo):
+    """Save a database. With `journal = True` the edits are already in the
+    edit journal and the database file is written by compact_journal().
+    pykeepass keeps the KDF parameters, so the transformed key is reused.
+
+    If another program changed the database file it is merged first (see
+    sync_database). If it can't be opened the edits are saved to
+    <database>.conflict instead of overwriting it.
+
+    Returns: True if the database file was written
+
+    """
+    journal = getattr(kpo, 'journal', None)
+    if journal is not None and SETTINGS.journal:
+        return False
+    try:
+        sync_database(kpo)
+    except Exception as err:  # pylint: disable=broad-except
+        conflict = kpo.filename + ".conflict"
+        LOG.warning("Can't merge the database changed by another program: %s", err)
+        kpo.save(conflict, transformed_key=kpo.transformed_key)
+        dmenu_err("The database was changed by another program and can't be merged. "
+                  "Edits saved to {}".format(conflict))
+        return True
+    kpo.save(transformed_key=kpo.transformed_key)
+    kpo.file_mtime = os.stat(kpo.filename).st_mtime_ns
+    if journal is not None:
+        # The edits of a journal left from `journal = True` are saved now
+        journal.discard(journal.count)
+    return True
+
+
+def compact_journal(dbf, keyfile, password):
+    """Write the edits of the edit journal into the database file, then
+    remove them from the journal. The database is written to a temporary file
+    which replaces it, so a crash leaves the old or the new database with
+    the journal, which can be replayed over either.
+
+    Returns: number of edits written
+
+    """
+    journal = JOURNALS.get(dbf)
+    if journal is None or not journal.count:
+        return 0
+    loader = DB_LOADERS.pop((dbf, keyfile), None) or DatabaseLoader(dbf, keyfile)
+    kpo = loader.open(password)
+    DB_LOADERS[(dbf, keyfile)] = loader
+    journal = open_journal(dbf, loader, password)
+    records = journal.read()
+    if not records:
+        return 0
+    elements = uuid_elements(kpo)
+    for record in records:
+        apply_edit(kpo, record, elements)
+    sync_database(kpo)
+    tmp = dbf + ".tmp"
+    kpo.save(tmp, transformed_key=kpo.transformed_key)
+    with open(tmp, 'rb') as dbfile:
+        os.fsync(dbfile.fileno())
+    os.replace(tmp, dbf)
+    fsync_dir(dbf)
+    journal.header_data = database_header_data(dbf)
+    journal.discard(len(records))
+    return len(records)
+
+
+def element_index(kpo):
+    """Index the entry (without history items) and group elements of a
+    Keepass object by their (base64) UUID
+
+    """
+    return {elem.findtext('UUID'): elem for elem in kpo.tree.find('Root').iter('Entry', 'Group')
+            if elem.getparent().tag != 'History'}
+
+
+class ElementImporter:  # pylint: disable=too-few-public-methods
+    """Copy entry and group elements from another Keepass object, converting
+    the times if the database versions differ and adding the attachment
+    binaries which aren't in the Keepass object yet
+
+    """
+    def __init__(self, kpo, other):
+        self.kpo = kpo
+        self.other = other
+        self.kdbx4 = kpo.version >= (4, 0)
+        self.convert = self.kdbx4 != (other.version >= (4, 0))
+        self.refs = {}
+        self.binaries = None
+
+    def __call__(self, elem, children=True):
+        """Return a copy of elem. Without `children` the entries and groups
+        in a group are left out.
+
+        """
+        if children:
+            elem = copy.deepcopy(elem)
+        else:
+            new = etree.Element(elem.tag)
+            new.extend(copy.deepcopy(i) for i in elem if i.tag not in ('Entry', 'Group'))
+            elem = new
+        if self.convert:
+            for times in elem.iter('Times'):
+                for node in times:
+                    if node.tag not in TIMES_NOT_TIMESTAMPS and node.text:
+                        node.text = kdbx_time_text(kdbx_time(node.text), self.kdbx4)
+        for value in elem.iterfind('.//Binary/Value[@Ref]'):
+            value.set('Ref', str(self._binary(int(value.get('Ref')))))
+        return elem
+
+    def _binary(self, ref):
+        if ref not in self.refs:
+            if self.binaries is None:
+                self.binaries = {data: idx for idx, data in enumerate(self.kpo.binaries)}
+            data = self.other.binaries[ref]
+            if data not in self.binaries:
+                self.binaries[data] = self.kpo.add_binary(data)
+            self.refs[ref] = self.binaries[data]
+        return self.refs[ref]
+
+
+def merge_entry(mine, theirs, importer):
+    """Merge another version of an entry into an entry element: the newer
+    version is kept and the older one added to the merged history
+
+    Returns: True if the entry changed
+
+    """
+    def without_history(elem):
+        node = elem.find('History')
+        if node is not None:
+            elem.remove(node)
+        return elem
+
+    mine_text = mine.findtext('Times/LastModificationTime')
+    if mine_text == theirs.findtext('Times/LastModificationTime'):
+        texts = {i.findtext('Times/LastModificationTime') for i in mine.iterfind('History/Entry')}
+        if all(i.findtext('Times/LastModificationTime') in texts
+               for i in theirs.iterfind('History/Entry')):
+            return False
+    mine_time, their_time = element_time(mine), element_time(theirs)
+    history = [(element_time(i), i) for i in mine.iterfind('History/Entry')]
+    known = {i[0] for i in history} | {mine_time}
+    added = 0
+    for item in theirs.iterfind('History/Entry'):
+        if element_time(item) not in known:
+            known.add(element_time(item))
+            history.append((element_time(item), importer(item)))
+            added += 1
+    if their_time > mine_time:
+        history.append((mine_time, without_history(copy.deepcopy(mine))))
+        for child in list(mine):
+            if child.tag != 'History':
+                mine.remove(child)
+        for idx, child in enumerate(without_history(importer(theirs))):
+            mine.insert(idx, child)
+    elif their_time not in known:
+        history.append((their_time, without_history(importer(theirs))))
+    elif not added:
+        return False
+    merged = etree.SubElement(without_history(mine), 'History')
+    merged.extend(i[1] for i in sorted(history, key=lambda i: i[0]))
+    return True
+
+
+def merge_database(kpo, other):
+    """Merge another copy of the database (e.g. changed by Syncthing or
+    KeePassXC on another computer) into a Keepass object, like the KeePass
+    synchronisation:
+
+    - Entries and groups are matched by UUID. The newer version of an entry
+      (by LastModificationTime) is kept and the older one added to its
+      history, the histories are merged. The fields of a group are taken
+      from the newer version.
+    - An entry or group moved in one copy is moved if that is newer than
+      its location in the other copy (LocationChanged).
+    - Entries and groups added in one copy are added, unless they were
+      deleted in the other copy after they were last modified. Entries and
+      groups in DeletedObjects are deleted unless they were modified after
+      the deletion. The DeletedObjects of both copies are kept.
+
+    Both databases are indexed by UUID once, so the merge takes linear time.
+
+    Returns: number of entries and groups added, changed, moved or deleted
+
+    """
+    local = element_index(kpo)
+    root = kpo.tree.find('Root/Group')
+    their_root = other.tree.find('Root/Group')
+    local.setdefault(their_root.findtext('UUID'), root)
+    deleted = {}
+    for tree in (kpo.tree, other.tree):
+        for obj in tree.iterfind('Root/DeletedObjects/DeletedObject'):
+            deleted[obj.findtext('UUID')] = max(kdbx_time(obj.findtext('DeletionTime')),
+                                                deleted.get(obj.findtext('UUID'), 0))
+    importer = ElementImporter(kpo, other)
+    changed = 0
+    # lxml searches take time proportional to the number of children, so
+    # the UUID of each group is only looked up once
+    group_uuids = {}
+    # Document order, so the parent group of an element is merged before it
+    for theirs in other.tree.find('Root').iter('Entry', 'Group'):
+        their_parent = theirs.getparent()
+        if theirs is their_root or their_parent.tag == 'History':
+            continue
+        if their_parent not in group_uuids:
+            group_uuids[their_parent] = their_parent.findtext('UUID')
+        uuid = theirs.findtext('UUID')
+        mine = local.get(uuid)
+        parent = local.get(group_uuids[their_parent])
+        if mine is None:
+            if deleted.get(uuid, -1) >= element_time(theirs):
+                continue
+            mine = importer(theirs, children=theirs.tag == 'Entry')
+            (root if parent is None else parent).append(mine)
+            local[uuid] = mine
+            changed += 1
+            continue
+        location = mine.find('Times/LocationChanged')
+        location = (element_time(mine, 'LocationChanged'),
+                    None if location is None else location.text)
+        if theirs.tag == 'Entry':
+            changed += merge_entry(mine, theirs, importer)
+        elif element_time(theirs) > element_time(mine):
+            for child in list(mine):
+                if child.tag not in ('Entry', 'Group'):
+                    mine.remove(child)
+            for idx, child in enumerate(importer(theirs, children=False)):
+                mine.insert(idx, child)
+            changed += 1
+        if parent is not None and parent is not mine.getparent() and \
+                element_time(theirs, 'LocationChanged') > location[0] and \
+                parent is not mine and mine not in parent.iterancestors():
+            parent.append(mine)
+            set_element_time(kpo, mine, 'LocationChanged',
+                             element_time(theirs, 'LocationChanged'))
+            changed += 1
+        elif location[1] is not None:
+            mine.find('Times/LocationChanged').text = location[1]
+    for uuid, deletion in deleted.items():
+        mine = local.get(uuid)
+        if mine is not None and mine is not root and mine.getparent() is not None and \
+                element_time(mine) <= deletion:
+            mine.getparent().remove(mine)
+            changed += 1
+    objects = deleted_objects(kpo)
+    objects.clear()
+    for uuid, deletion in deleted.items():
+        obj = etree.SubElement(objects, 'DeletedObject')
+        etree.SubElement(obj, 'UUID').text = uuid
+        etree.SubElement(obj, 'DeletionTime').text = \
+            kdbx_time_text(deletion, kpo.version >= (4, 0))
+    ENTRY_INDEXES.pop(kpo, None)
+    return changed
+
+
+def sync_database(kpo):
+    """Merge the database file into a Keepass object if another program
+    changed it since it was read (see merge_database)
+
+    Returns: number of merged changes, None if the file didn't change
+    Raises: the errors of DatabaseLoader.open(), e.g. if the password was
+            changed
+
+    """
+    try:
+        mtime = os.stat(kpo.filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if mtime == getattr(kpo, 'file_mtime', mtime):
+        return None
+    key = (kpo.filename, kpo.keyfile)
+    loader = DB_LOADERS.pop(key, None) or DatabaseLoader(*key)
+    try:
+        other = loader.open(kpo.password)
+    finally:
+        DB_LOADERS[key] = loader
+    count = merge_database(kpo, other)
+    kpo.file_mtime = other.file_mtime
+    LOG.info("Merged the database changed by another program: %d changes", count)
+    return count
+
+
+def database_view(kpo):
+    """Build a DatabaseView from a Keepass object, e.g. after edits were
+    applied to it. Values are kept in plain text, like in the Keepass object.
+
+    """
+    view = DatabaseView(kpo.filename)
+    view.file_mtime = getattr(kpo, 'file_mtime', None)
+    view.binaries = {idx: StoredBinary(gzip_chunks((data,)), True)
+                     for idx, data in enumerate(kpo.binaries)}
+    view.group_names = {i.name for i in kpo.groups}
+    for entry in kpo.entries:
+        elem = entry._element
+        strings = {i.findtext('Key'): i.find('Value').text for i in elem.findall('String')}
+        group = entry.parentgroup
+        enabled = elem.findtext('AutoType/Enabled') or None
+        view.entries.append(CompactEntry(
+            view, entry.uuid, strings,
+            None if enabled is None else enabled == 'True',
+            elem.findtext('AutoType/DefaultSequence') or None,
+            '' if group.is_root_group else group.path,
+            tuple(AttachmentRef(i.filename, i.id) for i in entry.attachments)))
+    return view
+
+
+def get_entries(dbo, readonly=False):
+    """Open keepass database and return the PyKeePass object
+
+        Args: dbo: tuple (db path, keyfile path, password)
+              readonly: return a DatabaseView (see read_database) instead
+        Returns: PyKeePass object or DatabaseView
+
+    """
+    dbf, keyfile, password = dbo
+    if dbf is None:
+        return None
+    try:
+        loader = DB_LOADERS.pop((dbf, keyfile), None) or DatabaseLoader(dbf, keyfile)
+        with TRACE.span('unlock' if loader.key[0] is None else 'reload'):
+            kpo = loader.open(password, readonly)
+        if SETTINGS.journal or exists(dbf + JOURNAL_SUFFIX):
+            journal = open_journal(dbf, loader, password)
+            records = journal.read()
+            if records and readonly:
+                kpo = loader.open(password)
+            elements = uuid_elements(kpo) if records else {}
+            for record in records:
+                apply_edit(kpo, record, elements)
+            if records and readonly:
+                kpo = database_view(kpo)
+            elif not readonly:
+                kpo.journal = journal
+    except (FileNotFoundError, construct.core.ChecksumError, CredentialsError) as err:
+        if isinstance(err, CredentialsError) or "wrong checksum" in str(err.args[0]):
+            if isinstance(password, CompositeKey):
+                forget_cached_key(dbf, keyfile)
+                dmenu_err("The cached database key is no longer valid. Try again.")
+                return None
+            dmenu_err("Invalid Password or keyfile")
+            return None
+        try:
+            if err.errno == errno.ENOENT:
+                if not os.path.isfile(dbf):
+                    dmenu_err("Database does not exist. Edit ~/.config/keepmenu/config.ini")
+                elif not os.path.isfile(keyfile):
+                    dmenu_err("Keyfile does not exist. Edit ~/.config/keepmenu/config.ini")
+        except AttributeError:
+            pass
+        return None
+    except Exception as err:
+        dmenu_err("Error: {}".format(err))
+        return None
+    if not loader.key_cached and not isinstance(password, CompositeKey) \
+            and loader.key[1] is not None:
+        loader.key_cached = cache_key(dbf, keyfile, loader.key[0][0])
+    DB_LOADERS[(dbf, keyfile)] = loader
+    return kpo
+
+
+def get_passphrase():
+    """Get a database password from dmenu or pinentry
+
+    Returns: string
+
+    """
+    pinentry = SETTINGS.pinentry
+    if pinentry:
+        password = ""
+        out = Popen(pinentry,
+                    stdout=PIPE,
+                    stdin=PIPE).communicate(
+                        input=b'setdesc Enter database password\ngetpin\n')[0]
+        if out:
+            res = out.decode(ENC).split("\n")[2]
+            if res.startswith("D "):
+                password = res.split("D ")[1]
+    else:
+        password = dmenu_select(0, "Passphrase")
+        if not password:
+            sys.exit()
+    return password
+
+
+def tokenize_autotype(autotype):
+    """Process the autotype sequence
+
+    Args: autotype - string
+    Returns: tokens - generator ((token, if_special_char T/F), ...)
+
+    """
+    while autotype:
+        opening_idx = -1
+        for char in "{+^%~@":
+            idx = autotype.find(char)
+            if idx != -1 and (opening_idx == -1 or idx < opening_idx):
+                opening_idx = idx
+
+        if opening_idx == -1:
+            # found the end of the string without further opening braces or
+            # other characters
+            yield autotype, False
+            return
+
+        if opening_idx > 0:
+            yield autotype[:opening_idx], False
+
+        if autotype[opening_idx] in "+^%~@":
+            yield autotype[opening_idx], True
+            autotype = autotype[opening_idx + 1:]
+            continue
+
+        closing_idx = autotype.find('}')
+        if closing_idx == -1:
             dmenu_err("Unable to find matching right brace (}) while" +
                       "tokenizing auto-type string: %s\n" % (autotype))
             return
@@ -497,34 +2628,221 @@ def tokenize_autotype(autotype):
         autotype = autotype[closing_idx + 1:]
 
 
-def token_command(token):
-    """When token denotes a special command, this function provides a callable
-    implementing its behaviour.
+def token_command(token):
+    """When token denotes a special command, this function provides a callable
+    implementing its behaviour.
+
+    """
+    cmd = None
+
+    def _check_delay():
+        match = re.match(r'{DELAY (\d+)}', token)
+        if match:
+            delay = match.group(1)
+            nonlocal cmd
+            cmd = lambda t=delay: time.sleep(int(t) / 1000)
+            return True
+        return False
+
+    if _check_delay():  # {DELAY x}
+        return cmd
+    return None
+
+
+# Field references: {REF:<wanted field>@<search in>:<search text>}
+REF_RE = re.compile(r'{REF:([TUPANI])@([TUPANIO]):([^}]*)}', re.IGNORECASE)
+# Entry string fields: {S:<field name>}
+STRING_FIELD_RE = re.compile(r'{S:([^}]+)}', re.IGNORECASE)
+
+REF_FIELDS = {'T': 'Title', 'U': 'UserName', 'P': 'Password', 'A': 'URL', 'N': 'Notes'}
+
+STANDARD_STRING_FIELDS = {'Title': 'title', 'UserName': 'username',
+                          'Password': 'password', 'URL': 'url', 'Notes': 'notes'}
+
+ENTRY_INDEXES = weakref.WeakKeyDictionary()
+
+
+class EntryIndex:
+    """Hash indexes of the entries in a database, used to resolve field
+    references without scanning kpo.entries. Built from the XML tree (or
+    the entries of a DatabaseView) in one pass.
+
+    Args: kpo - Keepass object or DatabaseView
+
+    """
+    def __init__(self, kpo):
+        self.kpo = kpo
+        self.by_uuid = {}
+        self.by_field = {code: {} for code in 'TUPANO'}
+        self.protected = {}  # Encrypted values of a DatabaseView, searched last
+        if isinstance(kpo, DatabaseView):
+            items = ((e.uuid.hex.upper(), e.strings.items(), e) for e in kpo.entries)
+        else:
+            items = ((base64.b64decode(elem.findtext('UUID')).hex().upper(),
+                      ((i.findtext('Key'), i.findtext('Value')) for i in elem.iterfind('String')),
+                      elem)
+                     for elem in kpo.tree.xpath('//Entry[not(parent::History)]'))
+        for uuid, strings, elem in items:
+            self.by_uuid[uuid] = elem
+            for key, value in strings:
+                if not value:
+                    continue
+                code = next((k for k, v in REF_FIELDS.items() if v == key), 'O')
+                if isinstance(value, ProtectedValue):
+                    self.protected.setdefault(code, []).append((value, elem))
+                else:
+                    self.by_field[code].setdefault(value.lower(), elem)
+
+    def find(self, search_in, text):
+        """Find the entry referenced by a {REF:..@<search_in>:<text>}.
+
+        Exact (case-insensitive) matches are looked up in the hash index;
+        otherwise the first value containing the text is used, like KeePass.
+
+        Args: search_in - field code (T, U, P, A, N, I or O)
+              text - search text
+        Returns: Entry (CompactEntry for a DatabaseView) or None
+
+        """
+        if search_in == 'I':
+            elem = self.by_uuid.get(text.replace('-', '').upper())
+        else:
+            index = self.by_field[search_in]
+            text = text.lower()
+            elem = index.get(text)
+            if elem is None:
+                elem = next((v for k, v in index.items() if text in k), None)
+            if elem is None:
+                elem = next((e for v, e in self.protected.get(search_in, ())
+                             if text in v.reveal().lower()), None)
+        if elem is None or isinstance(elem, CompactEntry):
+            return elem
+        return Entry(element=elem, kp=self.kpo)
+
+
+def entry_index(kpo):
+    """Return the EntryIndex for a database, building it on first use. A
+    reloaded database (new Keepass object) gets a new index.
+
+    """
+    TRACE.cache('entry_index', kpo in ENTRY_INDEXES)
+    if kpo not in ENTRY_INDEXES:
+        ENTRY_INDEXES[kpo] = EntryIndex(kpo)
+    return ENTRY_INDEXES[kpo]
+
+
+class FieldResolver:
+    """Resolve field references ({REF:...}) and string fields ({S:...}) in
+    entry values. Resolved fields are memoized, so use one resolver per
+    typing session. Reference cycles are left unresolved.
+
+    Args: kpo - Keepass object or None (references are not resolved)
+
+    """
+    def __init__(self, kpo=None):
+        self.kpo = kpo
+        self.memo = {}
+        self.stack = set()
+
+    def raw_field(self, entry, field):
+        """Return the unresolved value of a field
+
+        Args: field - reference code (T, U, P, A, N or I) or 'S:<name>'
+
+        """
+        if field == 'I':
+            return entry.uuid.hex.upper()
+        if field in REF_FIELDS:
+            return getattr(entry, STANDARD_STRING_FIELDS[REF_FIELDS[field]])
+        name = field[2:]
+        if name in STANDARD_STRING_FIELDS:
+            return getattr(entry, STANDARD_STRING_FIELDS[name])
+        return entry.get_custom_property(name) if name not in reserved_keys else None
+
+    def field(self, entry, field):
+        """Return the resolved value of a field, or None if it doesn't exist
+        or is part of a reference cycle
+
+        """
+        key = (getattr(entry, 'uuid', None) or id(entry), field)
+        if key in self.memo:
+            return self.memo[key]
+        if key in self.stack:
+            LOG.warning("Field reference cycle in %s of entry %s", field, key[0])
+            return None
+        self.stack.add(key)
+        try:
+            value = self.resolve(entry, self.raw_field(entry, field))
+        finally:
+            self.stack.discard(key)
+        self.memo[key] = value
+        return value
+
+    def resolve(self, entry, value):
+        """Replace the references in value. Unresolvable references are kept
+        as is.
+
+        """
+        if not value or '{' not in value:
+            return value
+
+        def _ref(match):
+            if self.kpo is None:
+                return match.group(0)
+            wanted, search_in, text = match.groups()
+            target = entry_index(self.kpo).find(search_in.upper(), text)
+            res = self.field(target, wanted.upper()) if target is not None else None
+            return match.group(0) if res is None else res
+
+        def _string(match):
+            res = self.field(entry, 'S:' + match.group(1))
+            return match.group(0) if res is None else res
+
+        return STRING_FIELD_RE.sub(_string, REF_RE.sub(_ref, value))
+
+
+def field_resolver(entry):
+    """Return a new FieldResolver for the database the entry belongs to
 
     """
-    cmd = None
+    return FieldResolver(getattr(entry, '_kp', None))
 
-    def _check_delay():
-        match = re.match(r'{DELAY (\d+)}', token)
-        if match:
-            delay = match.group(1)
-            nonlocal cmd
-            cmd = lambda t=delay: time.sleep(int(t) / 1000)
-            return True
-        return False
 
-    if _check_delay():  # {DELAY x}
-        return cmd
-    return None
+def resolve_field(entry, field):
+    """Return the value of an entry field with references resolved
 
+    Args: field - reference code (T, U, P, A, N or I) or 'S:<name>'
+
+    """
+    return field_resolver(entry).field(entry, field)
+
+
+def custom_field_names(entry):
+    """Return the names of the custom string fields of an entry without
+    reading their values
+
+    """
+    if isinstance(entry, CompactEntry):
+        return [key for key in entry.strings if key not in reserved_keys]
+    return entry._get_string_field_keys(exclude_reserved=True)
 
-def type_entry(entry):
-    """Pick which library to use to type strings
 
-    Defaults to pynput
+def has_value(entry, name):
+    """True if the string field `name` of an entry isn't empty. Protected
+    values of a CompactEntry aren't decrypted to check.
 
     """
-    sequence = SEQUENCE
+    if isinstance(entry, CompactEntry):
+        return bool(entry.strings.get(name))
+    return bool(entry._get_string_field(name))
+
+
+def type_entry(entry):
+    """Auto-type an entry using its autotype sequence (or the default one)
+    with the daemon's typing backend
+
+    """
+    sequence = SETTINGS.autotype_default
     if hasattr(entry, 'autotype_enabled') and entry.autotype_enabled is False:
         dmenu_err("Autotype disabled for this entry")
         return
@@ -532,25 +2850,18 @@ def type_entry(entry):
             entry.autotype_sequence is not None and \
             entry.autotype_sequence != 'None':
         sequence = entry.autotype_sequence
-    tokens = tokenize_autotype(sequence)
-
-    library = 'pynput'
-    if CONF.has_option('database', 'type_library'):
-        library = CONF.get('database', 'type_library')
-    if library == 'xdotool':
-        type_entry_xdotool(entry, tokens)
-    elif library == 'ydotool':
-        type_entry_ydotool(entry, tokens)
-    else:
-        type_entry_pynput(entry, tokens)
+    with TRACE.span('type.' + SETTINGS.type_library):
+        get_type_backend().type_entry(entry, tokenize_autotype(sequence),
+                                      field_resolver(entry))
 
 
+# Placeholder tokens and the field reference codes they type
 PLACEHOLDER_AUTOTYPE_TOKENS = {
-    "{TITLE}"   : lambda e: e.title,
-    "{USERNAME}": lambda e: e.username,
-    "{URL}"     : lambda e: e.url,
-    "{PASSWORD}": lambda e: e.password,
-    "{NOTES}"   : lambda e: e.notes,
+    "{TITLE}"   : 'T',
+    "{USERNAME}": 'U',
+    "{URL}"     : 'A',
+    "{PASSWORD}": 'P',
+    "{NOTES}"   : 'N',
 }
 
 STRING_AUTOTYPE_TOKENS = {
@@ -643,54 +2954,6 @@ PYNPUT_AUTOTYPE_TOKENS = {
 }
 
 
-def type_entry_pynput(entry, tokens):
-    """Use pynput to auto-type the selected entry
-
-    """
-    kbd = keyboard.Controller()
-    enter_idx = True
-    for token, special in tokens:
-        if special:
-            cmd = token_command(token)
-            if callable(cmd):
-                cmd()
-            elif token in PLACEHOLDER_AUTOTYPE_TOKENS:
-                to_type = PLACEHOLDER_AUTOTYPE_TOKENS[token](entry)
-                if to_type:
-                    try:
-                        kbd.type(to_type)
-                    except kbd.InvalidCharacterException:
-                        dmenu_err("Unable to type string...bad character.\n"
-                                  "Try setting `type_library = xdotool` in config.ini")
-                        return
-            elif token in STRING_AUTOTYPE_TOKENS:
-                to_type = STRING_AUTOTYPE_TOKENS[token]
-                try:
-                    kbd.type(to_type)
-                except kbd.InvalidCharacterException:
-                    dmenu_err("Unable to type string...bad character.\n"
-                              "Try setting `type_library = xdotool` in config.ini")
-                    return
-            elif token in PYNPUT_AUTOTYPE_TOKENS:
-                to_tap = PYNPUT_AUTOTYPE_TOKENS[token]
-                kbd.tap(to_tap)
-                # Add extra {ENTER} key tap for first instance of {ENTER}. It
-                # doesn't get recognized for some reason.
-                if enter_idx is True and token in ("{ENTER}", "~"):
-                    kbd.tap(to_tap)
-                    enter_idx = False
-            else:
-                dmenu_err("Unsupported auto-type token (pynput): \"%s\"" % (token))
-                return
-        else:
-            try:
-                kbd.type(token)
-            except kbd.InvalidCharacterException:
-                dmenu_err("Unable to type string...bad character.\n"
-                          "Try setting `type_library = xdotool` in config.ini")
-                return
-
-
 XDOTOOL_AUTOTYPE_TOKENS = {
     "{TAB}"       : ['key', 'Tab'],
     "{ENTER}"     : ['key', 'Return'],
@@ -759,39 +3022,6 @@ XDOTOOL_AUTOTYPE_TOKENS = {
 }
 
 
-def type_entry_xdotool(entry, tokens):
-    """Auto-type entry entry using xdotool
-
-    """
-    enter_idx = True
-    for token, special in tokens:
-        if special:
-            cmd = token_command(token)
-            if callable(cmd):
-                cmd()
-            elif token in PLACEHOLDER_AUTOTYPE_TOKENS:
-                to_type = PLACEHOLDER_AUTOTYPE_TOKENS[token](entry)
-                if to_type:
-                    call(['xdotool', 'type', to_type])
-            elif token in STRING_AUTOTYPE_TOKENS:
-                to_type = STRING_AUTOTYPE_TOKENS[token]
-                call(['xdotool', 'type', to_type])
-            elif token in XDOTOOL_AUTOTYPE_TOKENS:
-                cmd = ['xdotool'] + XDOTOOL_AUTOTYPE_TOKENS[token]
-                call(cmd)
-                # Add extra {ENTER} key tap for first instance of {ENTER}. It
-                # doesn't get recognized for some reason.
-                if enter_idx is True and token in ("{ENTER}", "~"):
-                    cmd = ['xdotool'] + XDOTOOL_AUTOTYPE_TOKENS[token]
-                    call(cmd)
-                    enter_idx = False
-            else:
-                dmenu_err("Unsupported auto-type token (xdotool): \"%s\"" % (token))
-                return
-        else:
-            call(['xdotool', 'type', token])
-
-
 YDOTOOL_AUTOTYPE_TOKENS = {
     "{TAB}"       : ['key', 'TAB'],
     "{ENTER}"     : ['key', 'ENTER'],
@@ -860,57 +3090,823 @@ YDOTOOL_AUTOTYPE_TOKENS = {
 }
 
 
-def type_entry_ydotool(entry, tokens):
-    """Auto-type entry entry using ydotool
-
-    """
-    enter_idx = True
-    for token, special in tokens:
-        if special:
-            cmd = token_command(token)
-            if callable(cmd):
-                cmd()
-            elif token in PLACEHOLDER_AUTOTYPE_TOKENS:
-                to_type = PLACEHOLDER_AUTOTYPE_TOKENS[token](entry)
-                if to_type:
-                    call(['ydotool', 'type', to_type])
-            elif token in STRING_AUTOTYPE_TOKENS:
-                to_type = STRING_AUTOTYPE_TOKENS[token]
-                call(['ydotool', 'type', to_type])
-            elif token in YDOTOOL_AUTOTYPE_TOKENS:
-                cmd = ['ydotool'] + YDOTOOL_AUTOTYPE_TOKENS[token]
-                call(cmd)
-                # Add extra {ENTER} key tap for first instance of {ENTER}. It
-                # doesn't get recognized for some reason.
-                if enter_idx is True and token in ("{ENTER}", "~"):
-                    cmd = ['ydotool'] + YDOTOOL_AUTOTYPE_TOKENS[token]
-                    call(cmd)
-                    enter_idx = False
-            else:
-                dmenu_err("Unsupported auto-type token (ydotool): \"%s\"" % (token))
-                return
+class TypeBackend(ABC):
+    """Base class for typing backends.
+
+    The daemon creates one instance of the configured backend at startup (see
+    init_type_backend) and reuses it for every action, so subclasses should
+    do their expensive setup (display connections, binary lookup) in
+    __init__. Subclasses set `name` and `keys` (the key token table) and
+    implement `type_string`, `key` and `paste`. Third-party backends can be
+    registered with register_type_backend or through the
+    `keepmenu.type_backends` entry point group.
+
+    """
+    name = None
+    keys = {}
+    # Add extra {ENTER} key tap for first instance of {ENTER}. It doesn't get
+    # recognized for some reason.
+    double_enter = True
+
+    @abstractmethod
+    def type_string(self, text):
+        """Type text. Return False if typing failed and should stop.
+
+        """
+
+    @abstractmethod
+    def key(self, token):
+        """Tap the key for a token in self.keys
+
+        """
+
+    @abstractmethod
+    def paste(self, primary=False):
+        """Send Ctrl+v, or Shift+Insert for the primary selection
+
+        """
+
+    def delay(self, token, cmd):  # pylint: disable=unused-argument
+        """Run a {DELAY x} command
+
+        """
+        cmd()
+
+    def type_entry(self, entry, tokens, resolver=None):
+        """Auto-type the entry using the tokens from tokenize_autotype
+
+        Args: entry - Keepass Entry
+              tokens - generator from tokenize_autotype
+              resolver - FieldResolver for this typing session
+
+        """
+        if resolver is None:
+            resolver = FieldResolver()
+        enter_idx = True
+        for token, special in tokens:
+            if special:
+                cmd = token_command(token)
+                if callable(cmd):
+                    self.delay(token, cmd)
+                elif token in PLACEHOLDER_AUTOTYPE_TOKENS:
+                    to_type = resolver.field(entry, PLACEHOLDER_AUTOTYPE_TOKENS[token])
+                    if to_type and self.type_string(to_type) is False:
+                        return
+                elif REF_RE.fullmatch(token) or STRING_FIELD_RE.fullmatch(token):
+                    to_type = resolver.resolve(entry, token)
+                    if to_type == token:
+                        dmenu_err("Unable to resolve auto-type field: \"%s\"" % (token))
+                        return
+                    if to_type and self.type_string(to_type) is False:
+                        return
+                elif token in STRING_AUTOTYPE_TOKENS:
+                    if self.type_string(STRING_AUTOTYPE_TOKENS[token]) is False:
+                        return
+                elif token in self.keys:
+                    self.key(token)
+                    if self.double_enter and enter_idx is True and token in ("{ENTER}", "~"):
+                        self.key(token)
+                        enter_idx = False
+                else:
+                    dmenu_err("Unsupported auto-type token (%s): \"%s\"" % (self.name, token))
+                    return
+            elif self.type_string(token) is False:
+                return
+
+
+class PynputBackend(TypeBackend):
+    """Type using pynput. The keyboard Controller (and its display
+    connection) is kept for the lifetime of the backend.
+
+    """
+    name = 'pynput'
+    keys = PYNPUT_AUTOTYPE_TOKENS
+
+    def __init__(self):
+        self.kbd = keyboard.Controller()
+
+    def type_string(self, text):
+        try:
+            self.kbd.type(text)
+        except self.kbd.InvalidCharacterException:
+            dmenu_err("Unable to type string...bad character.\n"
+                      "Try setting `type_library = xdotool` in config.ini")
+            return False
+        return True
+
+    def key(self, token):
+        self.kbd.tap(self.keys[token])
+
+    def paste(self, primary=False):
+        with self.kbd.pressed(keyboard.Key.shift if primary else keyboard.Key.ctrl):
+            self.kbd.tap(keyboard.Key.insert if primary else 'v')
+
+
+class CommandBackend(TypeBackend):
+    """Type by running an external command (xdotool or ydotool). The binary
+    is looked up on $PATH once and the key commands are prebuilt.
+
+    """
+    paste_keys = ('ctrl+v', 'shift+Insert')
+
+    def __init__(self):
+        self.binary = which(self.name)
+        if self.binary is None:
+            dmenu_err("{} not installed.\n"
+                      "Please install or remove that option from config.ini".format(
+                          self.name.capitalize()))
+            sys.exit()
+        self.key_cmds = {k: [self.binary] + v for k, v in self.keys.items()}
+
+    def type_string(self, text):
+        call([self.binary, 'type', text])
+        return True
+
+    def key(self, token):
+        call(self.key_cmds[token])
+
+    def paste(self, primary=False):
+        call([self.binary, 'key', self.paste_keys[primary]])
+
+
+class XdotoolBackend(CommandBackend):
+    """Type using xdotool
+
+    """
+    name = 'xdotool'
+    keys = XDOTOOL_AUTOTYPE_TOKENS
+
+
+class YdotoolBackend(CommandBackend):
+    """Type using ydotool (Wayland)
+
+    """
+    name = 'ydotool'
+    keys = YDOTOOL_AUTOTYPE_TOKENS
+    paste_keys = ('ctrl+v', 'shift+insert')
+
+
+# Operations captured by the 'recording' type_library: (timestamp, op, arg)
+RECORDED_OPS = []
+
+
+def record_op(op, arg):
+    """Record one typing operation for the 'recording' type_library.
+
+    Operations are kept in RECORDED_OPS and, if `type_record_file` is set in
+    config.ini, appended to that file as JSON lines.
+
+    Args: op - 'type', 'key' or 'delay'
+          arg - text to type, key token or delay token
+
+    """
+    rec = (time.time(), op, arg)
+    RECORDED_OPS.append(rec)
+    if SETTINGS.type_record_file:
+        with open(SETTINGS.type_record_file, 'a') as rec_file:
+            rec_file.write(json.dumps(rec) + "\n")
+
+
+class RecordingBackend(TypeBackend):
+    """Record each operation instead of typing it. Key tokens are validated
+    against the xdotool token table.
+
+    """
+    name = 'recording'
+    keys = XDOTOOL_AUTOTYPE_TOKENS
+    double_enter = False
+
+    def type_string(self, text):
+        record_op('type', text)
+        return True
+
+    def key(self, token):
+        record_op('key', token)
+
+    def paste(self, primary=False):
+        record_op('key', 'shift+Insert' if primary else 'ctrl+v')
+
+    def delay(self, token, cmd):
+        record_op('delay', token)
+        cmd()
+
+
+class NullBackend(TypeBackend):
+    """Dispatch the auto-type tokens without typing or waiting. Useful to
+    measure tokenizing and dispatch overhead.
+
+    """
+    name = 'null'
+    keys = XDOTOOL_AUTOTYPE_TOKENS
+    double_enter = False
+
+    def type_string(self, text):
+        return True
+
+    def key(self, token):
+        pass
+
+    def paste(self, primary=False):
+        pass
+
+    def delay(self, token, cmd):
+        pass
+
+
+TYPE_BACKENDS = {i.name: i for i in (PynputBackend, XdotoolBackend, YdotoolBackend,
+                                     RecordingBackend, NullBackend)}
+
+TYPE_BACKEND = None
+
+
+def register_type_backend(cls):
+    """Register a TypeBackend subclass under its `name`
+
+    """
+    TYPE_BACKENDS[cls.name] = cls
+    return cls
+
+
+def type_backend_class(name):
+    """Find the TypeBackend class for a type_library name, searching the
+    `keepmenu.type_backends` entry points for unknown names.
+
+    Returns: TypeBackend subclass or None
+
+    """
+    if name not in TYPE_BACKENDS:
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            return None
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group='keepmenu.type_backends')
+        else:
+            eps = eps.get('keepmenu.type_backends', [])
+        for ep in eps:
+            if ep.name == name:
+                TYPE_BACKENDS[name] = ep.load()
+                break
+    return TYPE_BACKENDS.get(name)
+
+
+def init_type_backend():
+    """Create the typing backend set by `type_library` in config.ini
+    (default pynput). Called once when the daemon starts.
+
+    Returns: TypeBackend object
+
+    """
+    global TYPE_BACKEND  # pylint: disable=global-statement
+    library = SETTINGS.type_library
+    cls = type_backend_class(library)
+    if cls is None:
+        dmenu_err("Unknown type_library '{}'.\n"
+                  "Please update that option in config.ini".format(library))
+        sys.exit()
+    missing = getattr(cls, '__abstractmethods__', ())
+    if missing:
+        dmenu_err("type_library '{}' doesn't implement {}".format(
+            library, ", ".join(sorted(missing))))
+        sys.exit()
+    TYPE_BACKEND = cls()
+    return TYPE_BACKEND
+
+
+def get_type_backend():
+    """Return the typing backend, creating it on first use
+
+    """
+    return TYPE_BACKEND if TYPE_BACKEND is not None else init_type_backend()
+
+
+def type_text(data):
+    """Type the given text data
+
+    """
+    with TRACE.span('type.' + SETTINGS.type_library):
+        get_type_backend().type_string(data)
+
+
+# Clipboard tools used by the 'clipboard' and 'paste' transfer modes. The
+# 'selection' arguments are appended to each command.
+CLIPBOARD_TOOLS = {
+    "xclip"  : {"copy"     : ['xclip', '-in'],
+                "paste"    : ['xclip', '-out'],
+                "clear"    : ['xclip', '-in'],
+                "selection": {"clipboard": ['-selection', 'clipboard'],
+                              "primary"  : ['-selection', 'primary']}},
+    "xsel"   : {"copy"     : ['xsel', '--input'],
+                "paste"    : ['xsel', '--output'],
+                "clear"    : ['xsel', '--clear'],
+                "selection": {"clipboard": ['--clipboard'],
+                              "primary"  : ['--primary']}},
+    "wl-copy": {"copy"     : ['wl-copy'],
+                "paste"    : ['wl-paste', '--no-newline'],
+                "clear"    : ['wl-copy', '--clear'],
+                "selection": {"clipboard": [],
+                              "primary"  : ['--primary']}},
+}
+
+TRANSFER_MODES = ("type", "clipboard", "paste")
+
+CLIPBOARD_CLEAR_DEFAULT_SEC = 45
+
+CLIPBOARD_TIMER = None
+
+
+def clipboard_tool():
+    """Return the clipboard tool from config.ini, or the autodetected one
+    (wl-copy on Wayland, otherwise xclip)
+
+    Returns: tool name - string
+
+    """
+    return SETTINGS.clipboard_cmd
+
+
+def clipboard_selection():
+    """Return the configured selection: 'clipboard' (default) or 'primary'
+
+    """
+    return SETTINGS.clipboard_selection
+
+
+def clipboard_cmd(action):
+    """Build the command line for a clipboard action
+
+    Args: action - 'copy', 'paste' or 'clear'
+    Returns: command - list of strings
+
+    """
+    tool = CLIPBOARD_TOOLS[clipboard_tool()]
+    return tool[action] + tool["selection"][clipboard_selection()]
+
+
+def read_clipboard():
+    """Return the current clipboard contents as bytes, or None if unavailable
+
+    """
+    try:
+        res = Popen(clipboard_cmd('paste'), stdout=PIPE, stderr=DEVNULL).communicate()
+    except OSError:
+        return None
+    return res[0]
+
+
+def clear_clipboard(digest):
+    """Clear the clipboard, but only if it still holds the value we put there.
+
+    Args: digest - sha256 digest (bytes) of the value that was copied
+
+    """
+    current = read_clipboard()
+    if current is None or hashlib.sha256(current).digest() != digest:
+        return
+    try:
+        Popen(clipboard_cmd('clear'), stdin=PIPE, stdout=DEVNULL,
+              stderr=DEVNULL).communicate(input=b"")
+    except OSError:
+        pass
+
+
+def copy_to_clipboard(data):
+    """Copy data to the clipboard and schedule clearing it after
+    `clipboard_clear_sec` seconds (0 disables clearing)
+
+    Args: data - string
+    Returns: True on success, False if the clipboard tool isn't available
+
+    """
+    global CLIPBOARD_TIMER  # pylint: disable=global-statement
+    data_b = data.encode(ENC)
+    try:
+        # stdout is not captured because xclip keeps serving the selection in
+        # the background and would hold the pipe open.
+        Popen(clipboard_cmd('copy'), stdin=PIPE, stdout=DEVNULL,
+              stderr=DEVNULL).communicate(input=data_b)
+    except OSError:
+        dmenu_err("Clipboard tool '{}' not installed.\n"
+                  "Please install or update `clipboard_cmd` in config.ini".format(clipboard_tool()))
+        return False
+    clear_sec = SETTINGS.clipboard_clear_sec
+    if CLIPBOARD_TIMER is not None:
+        CLIPBOARD_TIMER.cancel()
+    if clear_sec > 0:
+        CLIPBOARD_TIMER = Timer(clear_sec, clear_clipboard,
+                                args=(hashlib.sha256(data_b).digest(),))
+        CLIPBOARD_TIMER.daemon = True
+        CLIPBOARD_TIMER.start()
+    return True
+
+
+def paste_keystroke():
+    """Send the paste keystroke for the configured selection: Ctrl+v for the
+    clipboard, Shift+Insert for the primary selection
+
+    """
+    get_type_backend().paste(clipboard_selection() == 'primary')
+
+
+def transfer_mode(action=None, entry=None):
+    """Pick how a value is transferred to the active window.
+
+    The entry's `keepmenu_transfer` custom property has priority, then
+    `transfer_mode_<action>` and finally `transfer_mode` from config.ini.
+
+    Args: action - string (e.g. 'type_password') or None
+          entry - Keepass Entry or None
+    Returns: 'type' (default), 'clipboard' or 'paste'
+
+    """
+    mode = None
+    if entry is not None and hasattr(entry, 'get_custom_property'):
+        mode = entry.get_custom_property('keepmenu_transfer')
+    if not mode:
+        mode = SETTINGS.transfer_modes.get(action, SETTINGS.transfer_mode)
+    return mode if mode in TRANSFER_MODES else "type"
+
+
+def transfer_text(data, action=None, entry=None):
+    """Type the given text data, or place it on the clipboard (and optionally
+    paste it) depending on the transfer mode
+
+    """
+    if not data:
+        return
+    mode = transfer_mode(action, entry)
+    if mode == "type":
+        type_text(data)
+    elif copy_to_clipboard(data) and mode == "paste":
+        paste_keystroke()
+
+
+BREACH_INDEX_MAGIC = b"KMPWIDX1"
+
+BREACH_PREFIX_BITS = 16
+
+BREACH_CORPORA = {}
+
+
+class BreachCorpus:
+    """Memory-mapped "Pwned Passwords" SHA-1 file, ordered by hash (one
+    `HASH:COUNT` line per password). Lookups are binary searches over the
+    mapping, so only the touched pages are read.
+
+    An optional prefix index (see build_index()) holds the offset of the
+    first line for each 16 bit hash prefix, which narrows each search to a
+    small part of the file. It is memory-mapped as well.
+
+    Args: path - corpus file
+          index_path - prefix index file (ignored if missing or stale)
+
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        with open(path, 'rb') as fobj:
+            stat = os.fstat(fobj.fileno())
+            self.key = (stat.st_mtime_ns, stat.st_size)
+            if not stat.st_size:
+                raise ValueError("Breach corpus {} is empty".format(path))
+            self.mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = None
+        if index_path and exists(index_path):
+            with open(index_path, 'rb') as fobj:
+                idx = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            header = len(BREACH_INDEX_MAGIC) + 8
+            if idx[:header] == BREACH_INDEX_MAGIC + struct.pack('<Q', len(self.mmap)) and \
+                    len(idx) == header + 8 * ((1 << BREACH_PREFIX_BITS) + 1):
+                self.index = memoryview(idx)[header:].cast('Q')
+            else:
+                LOG.warning("Ignoring stale breach index %s", index_path)
+
+    def _bounds(self, key):
+        """Byte range of the file that can contain key"""
+        if self.index is None:
+            return 0, len(self.mmap)
+        prefix = int(key[:BREACH_PREFIX_BITS // 4], 16)
+        return self.index[prefix], self.index[prefix + 1]
+
+    def _lower_bound(self, key, low, high):
+        """Offset of the first line >= key between line starts low and high"""
+        mm = self.mmap
+        while low < high:
+            start = mm.rfind(b"\n", low, (low + high) // 2) + 1 or low
+            if mm[start:start + len(key)].upper() < key:
+                low = mm.find(b"\n", start, high) + 1 or high
+            else:
+                high = start
+        return low
+
+    def _count_at(self, pos, key):
+        """Breach count of the line at pos if it is for key, else 0"""
+        end = self.mmap.find(b"\n", pos)
+        line = self.mmap[pos:end if end != -1 else len(self.mmap)].strip()
+        digest, _, count = line.partition(b":")
+        if digest.upper() != key:
+            return 0
+        return int(count) if count else 1
+
+    def lookup(self, digests):
+        """Breach counts of SHA-1 digests, looked up in hash order so each
+        search starts where the previous one ended
+
+        Args: digests - iterable of 40 character uppercase hex digests
+        Returns: dict {digest: count}
+
+        """
+        counts = {}
+        low = 0
+        for digest in sorted(set(digests)):
+            key = digest.encode('ascii')
+            start, high = self._bounds(key)
+            low = self._lower_bound(key, max(low, start), high)
+            counts[digest] = self._count_at(low, key) if low < high else 0
+        return counts
+
+    def count(self, password):
+        """Number of times password appears in the corpus (0 if never)"""
+        digest = hashlib.sha1(password.encode('utf-8')).hexdigest().upper()
+        return self.lookup([digest])[digest]
+
+    def build_index(self, index_path):
+        """Write the prefix index for this corpus to index_path. Takes one
+        binary search per prefix, not a scan of the file.
+
+        """
+        offsets = array('Q')
+        low, size = 0, len(self.mmap)
+        for prefix in range(1 << BREACH_PREFIX_BITS):
+            key = "{:0{}X}".format(prefix, BREACH_PREFIX_BITS // 4).encode('ascii')
+            low = self._lower_bound(key, low, size)
+            offsets.append(low)
+        offsets.append(size)
+        with open(index_path, 'wb') as fobj:
+            fobj.write(BREACH_INDEX_MAGIC + struct.pack('<Q', size))
+            offsets.tofile(fobj)
+
+
+def get_breach_options():
+    """Read the [breach] section of config.ini
+
+    Returns: (corpus path, index path) or (None, None) if not configured
+
+    """
+    if not CONF.has_option('breach', 'corpus'):
+        return None, None
+    corpus = expanduser(CONF.get('breach', 'corpus'))
+    index = CONF.get('breach', 'index', fallback=corpus + ".idx")
+    return corpus, expanduser(index)
+
+
+def breach_corpus():
+    """Return the configured BreachCorpus, reusing the mapping until the file
+    changes. None if no corpus is configured or it can't be opened.
+
+    """
+    path, index = get_breach_options()
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+        corpus = BREACH_CORPORA.get(path)
+        if corpus is None or corpus.key != (stat.st_mtime_ns, stat.st_size):
+            corpus = BREACH_CORPORA[path] = BreachCorpus(path, index)
+    except (OSError, ValueError) as err:
+        LOG.warning("Breach corpus not available: %s", err)
+        return None
+    return corpus
+
+
+def breach_count(password):
+    """Number of times password appears in the configured breach corpus,
+    or None if there is no corpus
+
+    """
+    corpus = breach_corpus()
+    return corpus.count(password) if corpus is not None else None
+
+
+def build_breach_index():
+    """Write the prefix index for the configured corpus (`keepmenu
+    breach-index`)
+
+    """
+    path, index = get_breach_options()
+    if path is None:
+        sys.exit("Set `corpus` in the [breach] section of config.ini")
+    try:
+        BreachCorpus(path).build_index(index)
+    except (OSError, ValueError) as err:
+        sys.exit("Breach corpus error: {}".format(err))
+    print("Wrote {}".format(index), file=sys.stderr)
+
+
+COMMON_PASSWORDS = frozenset((
+    "password", "password1", "passw0rd", "123456", "1234567", "12345678",
+    "123456789", "1234567890", "qwerty", "qwertyuiop", "abc123", "111111",
+    "letmein", "monkey", "dragon", "iloveyou", "admin", "welcome", "login",
+    "master", "football", "baseball", "sunshine", "trustno1", "changeme"))
+
+KEYBOARD_ROWS = ("`1234567890-=", "qwertyuiop[]\\", "asdfghjkl;'", "zxcvbnm,./")
+
+KEYBOARD_PAIRS = frozenset(itertools.chain.from_iterable(
+    itertools.chain(zip(row, row[1:]), zip(row[1:], row)) for row in KEYBOARD_ROWS))
+
+# Default `[audit] pool_min`. In-process scoring takes ~15 us per password and
+# a warm pool adds ~10 ms per audit, so with 2-4 workers the pool is faster
+# from ~1000-2000 passwords. Starting the pool takes ~1 s more, paid by the
+# first audit after the daemon started or shed its memory.
+AUDIT_POOL_MIN = 5000
+# The daemon runs the menus in threads, so the pool processes are started by a
+# forkserver instead of forking the daemon
+AUDIT_POOL_START = 'forkserver'
+AUDIT_POOLS = {}
+
+AuditResult = namedtuple('AuditResult',
+                         'idx path breached reuse_group reuse_count bits weak age_days old')
+
+
+def password_strength(password):
+    """Quick estimate of the strength of a password in bits.
+
+    Each character adds log2 of the size of the character pools used in the
+    password, except that repeated characters and runs of sequential or
+    adjacent keyboard characters add one bit. Common passwords score 0.
+
+    """
+    if not password or password.lower() in COMMON_PASSWORDS:
+        return 0.0
+    pool = sum(size for chars, size in ((string.ascii_lowercase, 26),
+                                        (string.ascii_uppercase, 26),
+                                        (string.digits, 10),
+                                        (string.punctuation, 33))
+               if any(c in chars for c in password))
+    if any(not c.isascii() or c.isspace() for c in password):
+        pool += 100
+    per_char = math.log2(pool)
+    bits = per_char
+    lower = password.lower()
+    for prev, char in zip(lower, lower[1:]):
+        if abs(ord(char) - ord(prev)) <= 1 or (prev, char) in KEYBOARD_PAIRS:
+            bits += 1
         else:
-            call(['ydotool', 'type', token])
+            bits += per_char
+    return bits
 
 
-def type_text(data):
-    """Type the given text data
+def audit_pool(workers):
+    """Return the process pool for score_passwords, started on first use and
+    kept for the next audit
 
     """
-    library = 'pynput'
-    if CONF.has_option('database', 'type_library'):
-        library = CONF.get('database', 'type_library')
-    if library == 'xdotool':
-        call(['xdotool', 'type', data])
-    elif library == 'ydotool':
-        call(['ydotool', 'type', data])
-    else:
-        kbd = keyboard.Controller()
-        try:
-            kbd.type(data)
-        except kbd.InvalidCharacterException:
-            dmenu_err("Unable to type string...bad character.\n"
-                      "Try setting `type_library = xdotool` in config.ini")
+    if workers not in AUDIT_POOLS:
+        AUDIT_POOLS[workers] = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context(AUDIT_POOL_START))
+    return AUDIT_POOLS[workers]
+
+
+def shutdown_audit_pools():
+    """Stop the processes of the audit pools"""
+    for pool in AUDIT_POOLS.values():
+        pool.shutdown()
+    AUDIT_POOLS.clear()
+
+
+def score_passwords(passwords, workers=None, pool_min=None):
+    """Return password_strength() of each password. Large lists are scored in
+    a process pool (see audit_pool), unless `workers` is less than 2.
+
+    Args: passwords - list of strings
+          workers - number of processes (default: number of CPUs)
+          pool_min - smallest list scored in the pool (default: AUDIT_POOL_MIN)
+
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    pool_min = AUDIT_POOL_MIN if pool_min is None else pool_min
+    if workers < 2 or len(passwords) < pool_min:
+        return [password_strength(i) for i in passwords]
+    return list(audit_pool(workers).map(password_strength, passwords,
+                                         chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def get_audit_options():
+    """Read the [audit] section of config.ini
+
+    Returns: dict of audit_entries() keyword arguments
+
+    """
+    opts = {"max_age_days": "365",
+            "weak_bits": "50",
+            "workers": "",
+            "pool_min": ""}
+    if CONF.has_section('audit'):
+        opts.update(dict(CONF.items('audit')))
+    return {"max_age_days": int(opts["max_age_days"]),
+            "weak_bits": int(opts["weak_bits"]),
+            "workers": int(opts["workers"]) if opts["workers"] else None,
+            "pool_min": int(opts["pool_min"]) if opts["pool_min"] else None}
+
+
+def audit_entries(kpo, max_age_days=365, weak_bits=50, hidden_groups=(), workers=None,
+                  corpus=None, pool_min=None):
+    """Find breached, reused, weak and old passwords in one pass over the XML
+    tree.
+
+    Passwords are grouped by their SHA-256 hash, so each distinct password is
+    scored and looked up in the breach corpus once. The age is the time since
+    the entry was last modified. Passwords that are field references
+    ({REF:...}) are skipped.
+
+    Args: kpo - Keepass object
+          max_age_days - flag older passwords (0 to disable)
+          weak_bits - flag passwords with a lower password_strength()
+          hidden_groups - list of group names to skip
+          workers - see score_passwords()
+          corpus - BreachCorpus or None
+          pool_min - see score_passwords()
+    Returns: list of AuditResult for flagged entries, breached passwords
+             first, then reused, then from weakest to strongest. `idx` is the
+             index in kpo.entries.
+
+    """
+    paths = {}
+
+    def group_path(group):
+        parent = group.getparent()
+        if parent is None or parent.tag != 'Group':
+            return ''
+        if group not in paths:
+            paths[group] = "{}{}/".format(group_path(parent), group.findtext('Name') or '')
+        return paths[group]
+
+    now = time.time()
+    passwords = {}
+    counts = {}
+    rows = []
+    for idx, elem in enumerate(kpo.tree.xpath('//Entry[not(parent::History)]')):
+        fields = {i.findtext('Key'): i.findtext('Value') for i in elem.iterfind('String')}
+        password = fields.get('Password')
+        if not password or REF_RE.search(password):
+            continue
+        group = group_path(elem.getparent())
+        if any(hg in group for hg in hidden_groups):
+            continue
+        digest = hashlib.sha256(password.encode()).digest()
+        passwords.setdefault(digest, password)
+        counts[digest] = counts.get(digest, 0) + 1
+        mtime = elem.findtext('Times/LastModificationTime')
+        age = (now - kdbx_time(mtime)) / 86400 if mtime else 0.0
+        rows.append((idx, group + (fields.get('Title') or ''), digest, age))
+    bits = dict(zip(passwords, score_passwords(list(passwords.values()), workers,
+                                                  pool_min)))
+    breached = {}
+    if corpus is not None:
+        sha1 = {k: hashlib.sha1(v.encode()).hexdigest().upper() for k, v in passwords.items()}
+        counts_sha1 = corpus.lookup(sha1.values())
+        breached = {k: counts_sha1[v] for k, v in sha1.items()}
+    reused = sorted((i for i in counts if counts[i] > 1), key=lambda i: (-counts[i], bits[i]))
+    groups = {digest: num for num, digest in enumerate(reused, 1)}
+    results = []
+    for idx, path, digest, age in rows:
+        res = AuditResult(idx, path, breached.get(digest, 0), groups.get(digest, 0),
+                          counts[digest], bits[digest], bits[digest] < weak_bits, age,
+                          0 < max_age_days < age)
+        if res.breached or res.reuse_group or res.weak or res.old:
+            results.append(res)
+    results.sort(key=lambda i: (not i.breached, i.reuse_group or len(groups) + 1, i.bits,
+                                -i.age_days))
+    return results
+
+
+def audit_description(res, idx_align):
+    "return text describing an audit result (used to select entry from menu)"
+    issues = []
+    if res.breached:
+        issues.append("breached ({} times)".format(res.breached))
+    if res.reuse_group:
+        issues.append("reused #{} ({} entries)".format(res.reuse_group, res.reuse_count))
+    if res.weak:
+        issues.append("weak ({:.0f} bits)".format(res.bits))
+    if res.old:
+        issues.append("{:.0f} days old".format(res.age_days))
+    return f'{res.idx:>{idx_align}} - {res.path} - {", ".join(issues)}'
+
+
+def audit_passwords():
+    """Print the password audit report (`keepmenu audit`)
+
+    """
+    kpo = get_entries(get_database())
+    if not kpo:
+        sys.exit(1)
+    results = audit_entries(kpo, hidden_groups=SETTINGS.hide_groups,
+                            corpus=breach_corpus(), **get_audit_options())
+    idx_align = len(str(max((i.idx for i in results), default=0)))
+    for res in results:
+        print(audit_description(res, idx_align))
+    print("{} of {} entries flagged".format(len(results), len(kpo.entries)), file=sys.stderr)
 
 
 def view_all_entries(options, entries_descriptions, prompt='Entries'):
@@ -926,7 +3922,7 @@ def view_all_entries(options, entries_descriptions, prompt='Entries'):
         entries_b = options_b + kp_entries_b
     else:
         entries_b = kp_entries_b
-    return dmenu_select(min(DMENU_LEN, len(options) + len(entries_descriptions)), prompt, inp=entries_b)
+    return dmenu_select(min(SETTINGS.dmenu_len, len(options) + len(entries_descriptions)), prompt, inp=entries_b)
 
 
 def select_group(kpo, prompt="Groups"):
@@ -944,7 +3940,7 @@ def select_group(kpo, prompt="Groups"):
     pattern = str("{:>{na}} - {}")
     input_b = str("\n").join([pattern.format(j, i.path, na=num_align)
                               for j, i in enumerate(groups)]).encode(ENC)
-    sel = dmenu_select(min(DMENU_LEN, len(groups)), prompt, inp=input_b)
+    sel = dmenu_select(min(SETTINGS.dmenu_len, len(groups)), prompt, inp=input_b)
     if not sel:
         return False
     try:
@@ -998,8 +3994,8 @@ def create_group(kpo):
     name = dmenu_select(1, "Group name")
     if not name:
         return False
-    group = kpo.add_group(parentgroup, name)
-    kpo.save()
+    group = record_edit(kpo, 'add_group', group=parentgroup, name=name)
+    save_database(kpo)
     return group
 
 
@@ -1017,8 +4013,8 @@ def delete_group(kpo):
     delete = dmenu_select(2, "Confirm delete", inp=input_b)
     if delete != "Yes - confirm delete":
         return True
-    kpo.delete_group(group)
-    kpo.save()
+    record_edit(kpo, 'delete_group', group)
+    save_database(kpo)
     return group
 
 
@@ -1035,8 +4031,8 @@ def move_group(kpo):
     destgroup = select_group(kpo, prompt="Select destination group")
     if not destgroup:
         return False
-    group = kpo.move_group(group, destgroup)
-    kpo.save()
+    group = record_edit(kpo, 'move_group', group, group=destgroup)
+    save_database(kpo)
     return group
 
 
@@ -1053,8 +4049,8 @@ def rename_group(kpo):
     name = dmenu_select(1, "New group name", inp=group.name.encode(ENC))
     if not name:
         return False
-    group.name = name
-    kpo.save()
+    group = record_edit(kpo, 'rename_group', group, name=name)
+    save_database(kpo)
     return group
 
 
@@ -1069,7 +4065,7 @@ def add_entry(kpo):
     group = select_group(kpo)
     if group is False:
         return False
-    entry = kpo.add_entry(destination_group=group, title="", username="", password="")
+    entry = record_edit(kpo, 'add_entry', group=group, title="", username="", password="")
     edit = True
     while edit is True:
         edit = edit_entry(kpo, entry)
@@ -1089,46 +4085,133 @@ def delete_entry(kpo, kp_entry):
     delete = dmenu_select(2, "Confirm delete", inp=input_b)
     if delete != "Yes - confirm delete":
         return True
-    kpo.delete_entry(kp_entry)
-    kpo.save()
+    record_edit(kpo, 'delete_entry', kp_entry)
+    save_database(kpo)
     return False
 
 
 def view_entry(kp_entry):
-    """Show title, username, password, url and notes for an entry.
+    """Show title, username, password, url and notes for an entry. Field
+    references are resolved.
 
     Returns: dmenu selection
 
     """
+    resolver = field_resolver(kp_entry)
+    username = resolver.field(kp_entry, 'U')
+    url = resolver.field(kp_entry, 'A')
+    notes = resolver.field(kp_entry, 'N')
     fields = [kp_entry.path or "Title: None",
-              kp_entry.username or "Username: None",
-              '**********' if kp_entry.password else "Password: None",
-              kp_entry.url or "URL: None",
-              "Notes: <Enter to view>" if kp_entry.notes else "Notes: None"]
+              username or "Username: None",
+              '**********' if has_value(kp_entry, 'Password') else "Password: None",
+              url or "URL: None",
+              "Notes: <Enter to view>" if notes else "Notes: None"]
 
     def show_prop(key):
-        val = kp_entry.custom_properties[key]
-        return '*********' if key.startswith('#') else val
+        return '*********' if key.startswith('#') else resolver.field(kp_entry, 'S:' + key)
 
-    fields += [f'@({key}): {show_prop(key)}' for key in kp_entry.custom_properties]
+    fields += [f'@({key}): {show_prop(key)}' for key in custom_field_names(kp_entry)]
+    attachments = getattr(kp_entry, 'attachments', None)
+    if attachments:
+        fields.append(f"Attachments: {len(attachments)} <Enter to view>")
 
     kp_entries_b = "\n".join(fields).encode(ENC)
     sel = dmenu_select(len(fields), inp=kp_entries_b)
     if sel == "Notes: <Enter to view>":
-        sel = view_notes(kp_entry.notes)
+        sel = view_notes(notes)
     elif sel == "Notes: None":
         sel = ""
     elif sel == '**********':
-        sel = kp_entry.password
+        sel = resolver.field(kp_entry, 'P')
     elif sel == fields[3]:
         if sel != "URL: None":
             webbrowser.open(sel)
         sel = ""
     elif re.search('^@', str(sel)):
-        return kp_entry.custom_properties[re.search(r'@\((.+)(?=\):)', str(sel)).group(1)]
+        return resolver.field(kp_entry, 'S:' + re.search(r'@\((.+)(?=\):)', str(sel)).group(1))
+    elif attachments and sel == fields[-1]:
+        view_attachments(kp_entry)
+        sel = ""
     return sel
 
 
+def view_attachments(kp_entry):
+    """Select one of the attachments of an entry and open it. Only the
+    selected attachment is decompressed.
+
+    """
+    names = [i.filename for i in kp_entry.attachments]
+    sel = dmenu_select(min(SETTINGS.dmenu_len, len(names)), "Attachments",
+                       inp="\n".join(names).encode(ENC))
+    attachment = next((i for i in kp_entry.attachments if i.filename == sel), None)
+    if attachment is None:
+        return
+    try:
+        if isinstance(kp_entry, CompactEntry):
+            reader = kp_entry._kp.attachment_reader(attachment)
+        else:
+            reader = io.BytesIO(attachment.data)
+    except (KeyError, IndexError):
+        dmenu_err("Attachment data not found in the database")
+        return
+    open_attachment(attachment.filename, reader)
+
+
+def attachment_file(name, reader):
+    """Stream an attachment into a 0600 file in $XDG_RUNTIME_DIR (or
+    /dev/shm), so nothing is written to a persistent disk. The file keeps the
+    attachment's name, which the opener uses to detect the file type.
+
+    Args: name - attachment file name
+          reader - file object, e.g. from DatabaseView.attachment_reader
+    Returns: (path other processes can open, function which removes the file)
+    Raises: OSError
+
+    """
+    tmpdir = tempfile.mkdtemp(prefix="keepmenu-",
+                              dir=os.environ.get('XDG_RUNTIME_DIR') or "/dev/shm")
+    path = os.path.join(tmpdir, os.path.basename(name) or "attachment")
+    cleanup = partial(shutil.rmtree, tmpdir, True)
+    try:
+        fdesc = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fdesc, 'wb') as out:
+            shutil.copyfileobj(reader, out, InflatingReader.chunk_size)
+    except (OSError, zlib.error):
+        cleanup()
+        raise
+    return path, cleanup
+
+
+def open_attachment(name, reader):
+    """Open an attachment with `attachment_opener` from config.ini. The file
+    is removed `attachment_keep_sec` seconds after the opener exits.
+
+    Returns: the Thread which removes the file, or None on error
+
+    """
+    try:
+        path, cleanup = attachment_file(name, reader)
+    except (OSError, zlib.error) as err:
+        dmenu_err("Unable to extract attachment: {}".format(err))
+        return None
+    try:
+        proc = Popen(SETTINGS.attachment_opener + (path,), stdin=DEVNULL, stdout=DEVNULL,
+                     stderr=DEVNULL, start_new_session=True)
+    except OSError as err:
+        cleanup()
+        dmenu_err("Unable to run attachment_opener: {}".format(err))
+        return None
+
+    def _remove():
+        proc.wait()
+        time.sleep(SETTINGS.attachment_keep_sec)
+        cleanup()
+
+    thread = Thread(target=_remove, daemon=True)
+    thread.start()
+    return thread
+
+
 def edit_entry(kpo, kp_entry):  # pylint: disable=too-many-return-statements, too-many-branches
     """Edit title, username, password, url and autotype sequence for an entry.
 
@@ -1165,7 +4248,7 @@ def edit_entry(kpo, kp_entry):  # pylint: disable=too-many-return-statements, to
         group = select_group(kpo)
         if not group:
             return True
-        kpo.move_entry(kp_entry, group)
+        record_edit(kpo, 'move_entry', kp_entry, group=group)
         return True
     pw_choice = ""
     if field == 'password':
@@ -1179,27 +4262,43 @@ def edit_entry(kpo, kp_entry):  # pylint: disable=too-many-return-statements, to
         if pw_choice == "Manually enter password":
             pass
         elif pw_choice == "Type existing password":
-            type_text(kp_entry.password)
+            transfer_text(resolve_field(kp_entry, 'P'), 'edit_entry', kp_entry)
             return False
         elif not pw_choice:
             return True
         else:
             pw_choice = ''
-            input_b = b"20\n"
-            length = dmenu_select(1, "Password Length?", inp=input_b)
+            chars = get_password_chars()
+            if not chars:
+                return True
+            if PASSPHRASE_PRESET in chars:
+                try:
+                    generator = get_passphrase_generator()
+                except (OSError, ValueError) as err:
+                    dmenu_err("Passphrase word list error: {}".format(err))
+                    return True
+                prompt, default = "Number of words?", generator.words
+            else:
+                generator = PasswordGenerator(chars)
+                prompt, default = "Password Length?", 20
+            length = dmenu_select(1, prompt, inp="{}\n".format(default).encode(ENC))
             if not length:
                 return True
             try:
                 length = int(length)
             except ValueError:
-                length = 20
-            chars = get_password_chars()
-            if chars is False:
-                return True
-            sel = gen_passwd(chars, length)
+                length = default
+            sel = generator.generate(length)
             if sel is False:
                 dmenu_err("Number of char groups desired is more than requested pw length")
                 return True
+            prompt = "Entropy: {:.0f} bits".format(generator.entropy(length))
+            breaches = breach_count(sel)
+            if breaches:
+                prompt += ", found in {} breaches".format(breaches)
+            accept = dmenu_select(2, prompt, inp=b"Accept\nCancel\n")
+            if accept != "Accept":
+                return True
 
     if field == 'autotype_enabled':
         input_b = b"True\nFalse\n"
@@ -1216,9 +4315,15 @@ def edit_entry(kpo, kp_entry):  # pylint: disable=too-many-return-statements, to
             if not sel_check or sel_check != sel:
                 dmenu_err("Passwords do not match. No changes made.")
                 return True
+            breaches = breach_count(sel)
+            if breaches:
+                use = dmenu_select(2, "Password found in {} breaches. Use it?".format(breaches),
+                                   inp=b"No\nYes\n")
+                if use != "Yes":
+                    return True
     elif field == 'notes':
         sel = edit_notes(kp_entry.notes)
-    setattr(kp_entry, field, sel)
+    record_edit(kpo, 'set', kp_entry, field=field, value=sel)
     return True
 
 
@@ -1234,21 +4339,7 @@ def edit_notes(note):
     Returns: note - string
 
     """
-    if CONF.has_option("database", "gui_editor"):
-        editor = CONF.get("database", "gui_editor")
-        editor = shlex.split(editor)
-    else:
-        if CONF.has_option("database", "editor"):
-            editor = CONF.get("database", "editor")
-        else:
-            editor = os.environ.get('EDITOR', 'vim')
-        if CONF.has_option("database", "terminal"):
-            terminal = CONF.get("database", "terminal")
-        else:
-            terminal = "xterm"
-        terminal = shlex.split(terminal)
-        editor = shlex.split(editor)
-        editor = terminal + ["-e"] + editor
+    editor = list(SETTINGS.editor)
     note = b'' if note is None else note.encode(ENC)
     with tempfile.NamedTemporaryFile(suffix=".tmp") as fname:
         fname.write(note)
@@ -1274,7 +4365,7 @@ def view_notes(notes):
     """
     notes_l = notes.split('\n')
     notes_b = "\n".join(notes_l).encode(ENC)
-    sel = dmenu_select(min(DMENU_LEN, len(notes_l)), inp=notes_b)
+    sel = dmenu_select(min(SETTINGS.dmenu_len, len(notes_l)), inp=notes_b)
     return sel
 
 
@@ -1290,20 +4381,71 @@ def _description_idx(description):
     return int(description.split('-', 1)[0])
 
 
-class DmenuRunner(Process):
+def rss_bytes():
+    """Resident set size of this process, or 0 if /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def release_memory():
+    """Collect garbage and return free heap memory to the operating system
+    (glibc malloc_trim, where available)
+
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class DmenuRunner:
     """Listen for dmenu calling event and run keepmenu
 
+    The menus, typing and viewing use a read-only DatabaseView. The full
+    Keepass object is only loaded to edit the database.
+
+    After `memory_shed_min` idle minutes both are dropped and only the entry
+    listing is kept (see shed_memory()). The next request shows the listing
+    while the database is read again.
+
+    Requests from client() are received and scheduled on an event loop (see
+    schedule()), which also runs the Server and the inactivity timers. The
+    menus run in a worker thread.
+
     Args: server - Server object
-          kpo - Keepass object
     """
     def __init__(self, server):
-        Process.__init__(self)
         self.server = server
         self.database = get_database()
-        self.kpo = get_entries(self.database)
-        if not self.kpo:
-            self.server.kill_flag.set()
-            sys.exit()
+        self.unlock_thread = None
+        self.busy = Lock()
+        self.compacting = Lock()
+        self.cache_timer = self.shed_timer = None
+        self.loop = self.wakeup = self.worker = self.running = None
+        self.pending = []
+        self.queued = {}
+        # Every received request is merged into an identical queued one,
+        # served, cancelled by a newer request or dropped (database closed)
+        self.requests = {'received': 0, 'merged': 0, 'served': 0, 'cancelled': 0,
+                         'dropped': 0}
+        self.listing = None
+        self.listing_shown = False
+        if SETTINGS.listing_cache and self.database[0]:
+            self.listing = load_listing_cache(self.database[0])
+        if self.listing is not None:
+            # Unlock in the background while the cached listing is shown
+            self._view = None
+            self.hidden_groups = None
+        else:
+            self.view = get_entries(self.database, readonly=True)
+            if not self.view:
+                self.server.kill_flag.set()
+                sys.exit()
+        self._kpo = None
 
         self.actions = {
             MenuOption.TypePassword:self.type_password,
@@ -1313,40 +4455,221 @@ class DmenuRunner(Process):
             MenuOption.Edit:self.edit_entry,
             MenuOption.Add:self.add_entry,
             MenuOption.ManageGroups:self.manage_groups,
+            MenuOption.Audit:self.audit,
             MenuOption.ReloadDB:self.reload_db,
             MenuOption.KillDaemon:self.kill_daemon
         }
 
     def _set_timer(self):
-        """Set inactivity timer
+        """Set (or restart) the inactivity timers on the event loop
+
+        """
+        for timer in (self.cache_timer, self.shed_timer):
+            if timer is not None:
+                timer.cancel()
+        self.cache_timer = self.loop.call_later(SETTINGS.cache_period_min * 60,
+                                                self.cache_time)
+        if SETTINGS.memory_shed_min > 0:
+            self.shed_timer = self.loop.call_later(SETTINGS.memory_shed_min * 60,
+                                                   self.shed_idle)
+
+    def shed_idle(self):
+        """Shed timer callback: run shed_memory in the worker thread
+
+        Returns: the future of shed_memory
+
+        """
+        future = self.loop.run_in_executor(self.worker, self.shed_memory)
+        future.add_done_callback(self._shed_done)
+        return future
+
+    def _shed_done(self, future):
+        """Log a failed shed_memory and try again after another idle period
 
         """
-        self.cache_timer = Timer(CACHE_PERIOD_MIN * 60, self.cache_time)
-        self.cache_timer.daemon = True
-        self.cache_timer.start()
+        if future.cancelled() or future.exception() is None:
+            return
+        LOG.warning("Can't release memory: %s", future.exception())
+        self.shed_timer = self.loop.call_later(SETTINGS.memory_shed_min * 60,
+                                               self.shed_idle)
 
     def run(self):
-        while True:
-            option = self.server.start_q.get()
-            if self.server.kill_flag.is_set():
-                break
-            if not self.kpo:
-                pass
-            else:
+        init_type_backend()
+        asyncio.run(self.schedule())
+        self.compact_journal()
+
+    async def schedule(self):
+        """Serve the requests received by the Server one at a time. A new
+        request closes the open menu, which is stale now, and identical
+        queued requests are merged (see request()).
+
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        if self.pending:
+            self.wakeup.set()
+        self.worker = ThreadPoolExecutor(1)
+        await self.server.start({'show': self.show, 'stats': self.stats})
+        try:
+            while not self.server.kill_flag.is_set():
+                self.start_unlock()
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.pending and not self.server.kill_flag.is_set():
+                    option = self.pending.pop(0)
+                    queued = self.queued.pop(option, None)
+                    if queued is not None:
+                        TRACE.add('queue', time.monotonic() - queued)
+                    MENUS.reset()
+                    self._set_timer()
+                    self.running = self.loop.run_in_executor(self.worker, self.serve, option)
+                    try:
+                        await self.running
+                    finally:
+                        self.running = None
+                    self._set_timer()
+                    if self.server.cache_time_expired.is_set():
+                        self.server.kill_flag.set()
+        finally:
+            self.server.close()
+            for timer in (self.cache_timer, self.shed_timer):
+                if timer is not None:
+                    timer.cancel()
+            self.worker.shutdown()
+
+    def show(self, request):
+        """Handle a 'show' request of client(): {'option': MenuOption name or
+        None for the action menu}
+
+        """
+        if self.server.kill_flag.is_set():
+            return {'error': 'stopping'}
+        try:
+            option = None if request.get('option') is None else MenuOption[request['option']]
+        except KeyError:
+            return {'error': 'unknown option'}
+        self.request(option)
+        return {'ok': True}
+
+    def stats(self, request):  # pylint: disable=unused-argument
+        """Handle a 'stats' request of client(): the latency spans and cache
+        hit rates (see Tracer), entry count, RSS and request counts
+
+        """
+        stats = TRACE.stats()
+        if self._view is not None:
+            stats['entries'] = len(self._view.entries)
+        else:
+            stats['entries'] = len(self.listing) if self.listing is not None else 0
+        stats['rss_kb'] = rss_bytes() // 1024
+        stats['tracing'] = TRACE.enabled
+        stats['requests'] = dict(self.requests, pending=len(self.pending))
+        return stats
+
+    def request(self, option):
+        """Queue a request, unless the same one is already queued, and close
+        the menu of the running request
+
+        """
+        self.requests['received'] += 1
+        if option not in self.pending:
+            self.pending.append(option)
+            self.queued[option] = time.monotonic()
+        else:
+            self.requests['merged'] += 1
+        if self.running is not None:
+            MENUS.cancel()
+        self.wakeup.set()
+
+    def serve(self, option):
+        """Run a request (in the worker thread). Opens the database again if
+        the memory was shed, the listing is shown meanwhile.
+
+        """
+        MENUS.track()
+        self.start_unlock()
+        if not self.unlocking() and not self.view:
+            self.requests['dropped'] += 1
+            return
+        with self.busy:
+            self.reload_config()
+            self.reload_changed()
+            try:
                 self.dmenu_run(option)
-            if self.server.cache_time_expired.is_set():
-                self.server.kill_flag.set()
-            if self.server.kill_flag.is_set():
-                break
+            except MenuCancelled:
+                self.requests['cancelled'] += 1
+                LOG.info("Menu closed for a newer request")
+                if getattr(self._kpo, 'edited', False):
+                    self.save_db()
+            else:
+                self.requests['served'] += 1
+
+    def start_unlock(self):
+        """Start opening the database in the background if only the cached
+        listing is loaded
+
+        """
+        if self._view is None and self.listing is not None and not self.unlocking() \
+                and not self.server.kill_flag.is_set():
+            self.unlock_thread = Thread(target=self.unlock, daemon=True)
+            self.unlock_thread.start()
+
+    def unlock(self):
+        """Open the database in the background while the cached listing is
+        shown. Stop the daemon if it can't be opened.
+
+        """
+        try:
+            view = get_entries(self.database, readonly=True)
+        except MenuCancelled:
+            view = None
+        if not view:
+            self.server.kill_flag.set()
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+        self.view = view
+
+    def unlocking(self):
+        """True while the database is being opened in the background"""
+        return self.unlock_thread is not None and self.unlock_thread.is_alive()
+
+    def shed_memory(self):
+        """Drop the database objects, attachments, indexes and audit pool when
+        idle. The listing (no secrets) is kept to show while the database is
+        read again, and the derived key is kept in DB_LOADERS so the KDF
+        doesn't run again. Skipped while a menu is open.
+
+        Returns: (RSS before, RSS after) in bytes, or None if skipped
+
+        """
+        if self._view is None or self.unlocking() or not self.busy.acquire(blocking=False):
+            return None
+        try:
+            self.compact_journal()
+            before = rss_bytes()
+            self.listing = listing_records(self._view)
+            self._view = self._kpo = None
+            self.hidden_groups = None
+            ENTRY_INDEXES.clear()
+            WORDLISTS.clear()
+            BREACH_CORPORA.clear()
+            shutdown_audit_pools()
+            release_memory()
+            after = rss_bytes()
+        finally:
+            self.busy.release()
+        LOG.info("Idle, memory released: RSS %d kB -> %d kB", before // 1024, after // 1024)
+        return before, after
 
     def cache_time(self):
-        """Kill keepmenu daemon when cache timer expires
+        """Kill keepmenu daemon when cache timer expires, after the running
+        request
 
         """
         self.server.cache_time_expired.set()
-        if self.server.start_q.empty():
+        if self.running is None and not self.pending:
             self.server.kill_flag.set()
-            self.server.start_q.set()
+            self.wakeup.set()
 
     def dmenu_run(self, option):
         """Run dmenu with the given list of Keepass Entry objects
@@ -1354,32 +4677,26 @@ class DmenuRunner(Process):
         If 'hide_groups' is defined in config.ini, hide those from main and
         view/type all views.
 
-        Args: self.kpo - Keepass object
+        Args: self.view - DatabaseView
 
-        Note: I had to reload the kpo object after every save to prevent being
+        Note: I had to reload the database after every save to prevent being
         affected by the gibberish password bug in pykeepass:
         https://github.com/pschmitt/pykeepass/issues/43
 
-        Once this is fixed, the extra calls to self.kpo = get_entries... can be
-        deleted
-
-        """
-        try:
-            self.cache_timer.cancel()
-        except AttributeError:
-            pass
+        The reload also drops the full Keepass object until the next edit.
 
-        self._set_timer()
+        An unfinished action returns to the action menu.
 
-        if option is None:
-            option = self.dmenu_select_option()
+        """
+        while True:
+            self.listing_shown = False
 
-        if option:
-            action = self.actions[option]
-            finished = action(prompt=option.description())
+            if option is None:
+                option = self.dmenu_select_option()
 
-            if not finished:
-                self.dmenu_run(None)
+            if not option or self.actions[option](prompt=option.description()):
+                return
+            option = None
 
     def dmenu_select_option(self):
         selection = view_all_entries(
@@ -1396,68 +4713,138 @@ class DmenuRunner(Process):
     def type_entry(self, prompt=None):
         sel = self.dmenu_select(prompt)
 
-        if sel:
-            entry = self.get_selected_entry(sel)
+        entry = self.get_selected_entry(sel)
+
+        if entry:
             type_entry(entry)
             return True
 
     def type_password(self, prompt=None):
         sel = self.dmenu_select(prompt)
 
-        if sel:
-            entry = self.get_selected_entry(sel)
-            type_text(entry.password or '')
+        entry = self.get_selected_entry(sel)
+
+        if entry:
+            transfer_text(resolve_field(entry, 'P'), 'type_password', entry)
             return True
 
     def type_username(self, prompt=None):
         sel = self.dmenu_select(prompt)
 
-        if sel:
-            entry = self.get_selected_entry(sel)
-            type_text(entry.username or '')
+        entry = self.get_selected_entry(sel)
+
+        if entry:
+            transfer_text(resolve_field(entry, 'U'), 'type_username', entry)
             return True
 
     def view_entry(self, prompt=None):
         sel = self.dmenu_select(prompt)
 
-        if sel:
-            entry = self.get_selected_entry(sel)
+        entry = self.get_selected_entry(sel)
+
+        if entry:
             text = view_entry(entry)
-            type_text(text or '')
+            transfer_text(text, 'view_entry', entry)
             return True
 
     def edit_entry(self, prompt=None):
         sel = self.dmenu_select(prompt, include_hidden=True)
 
-        if sel:
-            entry = self.get_selected_entry(sel)
+        entry = self.full_entry(self.get_selected_entry(sel))
+
+        if entry:
             edit = True
 
             while edit is True:
                 edit = edit_entry(self.kpo, entry)
 
-            self.kpo.save()
-            self.kpo = get_entries(self.database)
+            self.save_db()
             return True
 
     def add_entry(self, **kwds):
+        if not self.kpo:
+            return True
         entry = add_entry(self.kpo)
 
         if entry:
-            self.kpo.save()
-            self.kpo = get_entries(self.database)
+            self.save_db()
             return True
 
     def manage_groups(self, **kwds):
+        if not self.kpo:
+            return True
         group = manage_groups(self.kpo)
 
         if group:
-            self.kpo.save()
-            self.kpo = get_entries(self.database)
+            self.save_db()
+            return True
+
+    def audit(self, prompt=None):
+        if not self.kpo:
+            return True
+        results = audit_entries(self.kpo, hidden_groups=self.get_hidden_groups(),
+                                corpus=breach_corpus(), **get_audit_options())
+        if not results:
+            dmenu_err("No breached, reused, weak or old passwords found")
+            return True
+        idx_align = len(str(max(i.idx for i in results)))
+        sel = view_all_entries([], [audit_description(i, idx_align) for i in results],
+                               prompt=prompt)
+
+        entry = self.full_entry(self.get_selected_entry(sel))
+
+        if entry:
+            edit = True
+
+            while edit is True:
+                edit = edit_entry(self.kpo, entry)
+
+            self.save_db()
             return True
 
+    def save_db(self):
+        """Save the edits and update the view. With the edit journal the
+        edited Keepass object is kept and the view built from it.
+
+        """
+        self._kpo.edited = False
+        if save_database(self._kpo):
+            self.reload_db()
+            return
+        self.view = database_view(self._kpo)
+        if self._kpo.journal.count >= SETTINGS.journal_compact_records:
+            Thread(target=self.compact_journal, daemon=True).start()
+
+    def compact_journal(self):
+        """Write the edit journal into the database file (see compact_journal)"""
+        with self.compacting:
+            try:
+                count = compact_journal(*self.database)
+            except Exception as err:  # pylint: disable=broad-except
+                LOG.warning("Can't write the edit journal into the database: %s", err)
+                return
+        if count:
+            LOG.info("Wrote %d journaled edits into the database", count)
+
     def reload_db(self, **kwds):
-        self.kpo = get_entries(self.database)
+        self._kpo = None
+        self.view = get_entries(self.database, readonly=True)
+
+    def reload_changed(self):
+        """Reload the database if another program (e.g. Syncthing) changed
+        the file. Journaled edits are replayed over it, saved edits are
+        merged by save_database().
+
+        """
+        if self._view is None:
+            return
+        try:
+            mtime = os.stat(self.database[0]).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._view.file_mtime:
+            LOG.info("Database changed by another program, reloading")
+            self.reload_db()
 
     def kill_daemon(self, **kwds):
         try:
@@ -1477,105 +4864,290 @@ class DmenuRunner(Process):
         )
 
     def get_entries_descriptions(self, *, include_hidden=False):
-        idx_align = len(str(len(self.kpo.entries)))
+        with TRACE.span('descriptions'):
+            return self._entries_descriptions(include_hidden)
+
+    def _entries_descriptions(self, include_hidden):
+        if self.unlocking():
+            # Show the cached listing, get_selected_entry() resolves the
+            # selection by UUID once the database is open.
+            self.listing_shown = True
+            idx_align = len(str(len(self.listing)))
+            return [
+                _entry_description(idx, idx_align, record)
+                for idx, record in enumerate(self.listing)
+                if include_hidden or not self.is_hidden(record)
+            ]
+        self.listing_shown = False
+        idx_align = len(str(len(self.view.entries)))
 
         return [
             _entry_description(idx, idx_align, entry)
-            for idx, entry in enumerate(self.kpo.entries)
+            for idx, entry in enumerate(self.view.entries)
             if include_hidden or not self.is_hidden(entry)
         ]
 
     def get_selected_entry(self, description):
-        if description:
-            return self.kpo.entries[_description_idx(description)]
+        with TRACE.span('entry_resolution'):
+            return self._selected_entry(description)
 
-        return None
+    def _selected_entry(self, description):
+        if not description:
+            return None
+        if self.listing_shown:
+            uuid = self.listing[_description_idx(description)].uuid
+            entry = entry_index(self.view).find('I', uuid) if self.view else None
+            if entry is None:
+                dmenu_err("Entry not found. The database changed since it was cached.")
+            return entry
+
+        return self.view.entries[_description_idx(description)]
+
+    def full_entry(self, entry):
+        """Return the pykeepass Entry for an entry of the view, loading the
+        full Keepass object if needed
+
+        """
+        if entry is None or not self.kpo:
+            return None
+        return entry_index(self.kpo).find('I', entry.uuid.hex)
 
     def is_hidden(self, entry):
         entry_group = entry.path.rstrip(entry.title)
         return any(group in entry_group for group in self.get_hidden_groups())
 
     def get_hidden_groups(self):
-        # Validate ignored group names in config.ini
+        """Return the `hide_groups` from config.ini which exist in the
+        database. Cached until the database or the config is reloaded.
 
-        if CONF.has_option("database", "hide_groups"):
-            return [
-                hg for hg in CONF.get("database", "hide_groups").split(",")
-                if hg in [
-                    g.name for g in self.kpo.groups
-                ]
-            ]
+        """
+        if self.unlocking():
+            return list(SETTINGS.hide_groups)
+        if self.hidden_groups is None:
+            self.hidden_groups = [hg for hg in SETTINGS.hide_groups
+                                  if hg in self.view.group_names]
+        return self.hidden_groups
+
+    @property
+    def view(self):
+        """The read-only DatabaseView. Waits for the background unlock, if any"""
+        if self.unlock_thread is not None and self.unlock_thread is not current_thread():
+            self.unlock_thread.join()
+        return self._view
+
+    @view.setter
+    def view(self, view):
+        self._view = view
+        self.hidden_groups = None
+        if view and SETTINGS.listing_cache:
+            try:
+                save_listing_cache(self.database[0], view)
+            except OSError as err:
+                LOG.warning("Can't write listing cache: %s", err)
 
-        return []
+    @property
+    def kpo(self):
+        """The full Keepass object, loaded on first use. Dropped again when
+        the database is reloaded.
+
+        """
+        TRACE.cache('kpo', self._kpo is not None)
+        if self._kpo is None and self.view:
+            self._kpo = get_entries(self.database)
+        return self._kpo
+
+    def reload_config(self):
+        """Reload config.ini if it changed and rebuild what depends on it
+
+        """
+        old = reload_config()
+        if old is None:
+            return
+        if old.hide_groups != SETTINGS.hide_groups:
+            self.hidden_groups = None
+        if old.type_library != SETTINGS.type_library:
+            init_type_backend()
+
+
+class Server:
+    """Listen for client() requests on 127.0.0.1:<port> (see get_auth) on
+    the event loop of the daemon
+
+    The server sends a random challenge, which the client answers with its
+    HMAC-SHA256 keyed with the authkey. The client then sends one request
+    as a JSON line and reads the JSON response line.
 
+    When started by keepmenu.socket the listening socket is inherited from
+    systemd (see listen_fds()) instead.
 
-class Server(Process):
-    """Run BaseManager server to listen for dmenu calling events
+    Attributes: kill_flag - set to stop the daemon
+                cache_time_expired - set when the passphrase cache period
+                                     expired
+                activated - the listening socket was inherited from systemd
 
     """
     def __init__(self):
-        Process.__init__(self)
         self.port, self.authkey = get_auth()
-        self.start_q = Queue()
         self.kill_flag = Event()
         self.cache_time_expired = Event()
+        self.handlers = {}
+        self.server = None
+        socks = listen_fds()
+        self.activated = bool(socks)
+        if socks:
+            self.sock = socks[0]
+            for sock in socks[1:]:
+                sock.close()
+        else:
+            # Listen right away, so requests made while the database is
+            # unlocked wait in the backlog instead of starting another daemon.
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('127.0.0.1', self.port))
+            self.sock.listen()
 
-    def run(self):
-        serv = self.server()  # pylint: disable=unused-variable
-        self.kill_flag.wait()
+    async def start(self, handlers):
+        """Start listening
 
-    def server(self):
-        """Set up BaseManager server
+        Args: handlers - dict of request 'cmd': callable(request) returning
+                         the response dict, called on the event loop
 
         """
-        mgr = BaseManager(address=('127.0.0.1', self.port),
-                          authkey=self.authkey)
-        mgr.register('show_dmenu', callable=self.show_dmenu)
-        mgr.start()
-        return mgr
-
-
-    def show_dmenu(self, args):
-        if args.type_password == True:
-            default_option = MenuOption.TypePassword
-        elif args.view_entry == True:
-            default_option = MenuOption.ViewEntry
-        elif args.type_username == True:
-            default_option = MenuOption.TypeUsername
-        elif args.type_entry == True:
-            default_option = MenuOption.TypeEntry
-        else:
-            default_option = None
-
-        self.start_q.put(default_option)
+        self.handlers = handlers
+        self.server = await asyncio.start_server(self.handle, sock=self.sock)
 
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.sock.close()
 
-def client():
-    """Define client connection to server BaseManager
+    async def handle(self, reader, writer):
+        """Authenticate a client and answer its request"""
+        challenge = os.urandom(AUTH_CHALLENGE_LEN)
+        try:
+            writer.write(challenge)
+            await writer.drain()
+            digest = await asyncio.wait_for(reader.readexactly(AUTH_DIGEST_LEN),
+                                            CLIENT_TIMEOUT_SEC)
+            if not hmac.compare_digest(digest, auth_digest(self.authkey, challenge)):
+                LOG.warning("Rejected a client with the wrong authkey")
+                return
+            request = json.loads(await asyncio.wait_for(reader.readline(), CLIENT_TIMEOUT_SEC))
+            if 'time' in request:
+                TRACE.add('connect', time.time() - request['time'])
+            handler = self.handlers.get(request.get('cmd'))
+            response = {'error': 'unknown request'} if handler is None else handler(request)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        except (OSError, ValueError, TypeError, AttributeError,
+                asyncio.IncompleteReadError, asyncio.TimeoutError) as err:
+            LOG.warning("Bad client request: %s", err)
+        finally:
+            writer.close()
+
+
+def auth_digest(authkey, challenge):
+    """Answer to an authentication challenge of the Server"""
+    return hmac.new(authkey, challenge, hashlib.sha256).digest()
+
+
+def client(request):
+    """Send a request to the daemon, through the keepmenu.socket socket if
+    it exists
+
+    Args: request - dict with the 'cmd' and its arguments
+    Returns: response dict
+    Raises: ConnectionRefusedError if no daemon is running, other OSError if
+            it doesn't answer, ValueError if it rejected the request
 
-    Returns: BaseManager object
     """
+    request = dict(request, time=time.time())
     port, auth = get_auth()
-    mgr = BaseManager(address=('', port), authkey=auth)
-    mgr.register('show_dmenu')
-    mgr.connect()
-    return mgr
+    sock = None
+    if SOCKET_FILE and exists(SOCKET_FILE):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CLIENT_TIMEOUT_SEC)
+        try:
+            sock.connect(SOCKET_FILE)
+        except ConnectionRefusedError:
+            # Left over from a stopped keepmenu.socket
+            sock.close()
+            sock = None
+    if sock is None:
+        sock = socket.create_connection(('127.0.0.1', port), CLIENT_TIMEOUT_SEC)
+    with sock, sock.makefile('rwb') as conn:
+        sock.settimeout(CLIENT_WAIT_SEC)
+        challenge = conn.read(AUTH_CHALLENGE_LEN)
+        sock.settimeout(CLIENT_TIMEOUT_SEC)
+        conn.write(auth_digest(auth, challenge) + json.dumps(request).encode() + b'\n')
+        conn.flush()
+        response = conn.readline()
+    if not response:
+        raise ValueError("Request rejected by the keepmenu daemon")
+    return json.loads(response)
+
+
+def request_option(args):
+    """Return the name of the MenuOption requested on the command line, or
+    None for the action menu
+
+    """
+    for option, arg in ((MenuOption.TypePassword, args.type_password),
+                        (MenuOption.ViewEntry, args.view_entry),
+                        (MenuOption.TypeUsername, args.type_username),
+                        (MenuOption.TypeEntry, args.type_entry)):
+        if arg is True:
+            return option.name
+    return None
 
 
 def start_server(args):
-    """Main entrypoint. Start the background Manager and Dmenu runner processes.
+    """Main entrypoint. Unlock the database and run the daemon in this
+    process: the Server and the menus run on one event loop (see
+    DmenuRunner.schedule()). `keepmenu daemon` only waits for requests.
 
     """
     server = Server()
     dmenu = DmenuRunner(server)
-    dmenu.daemon = True
-    server.start()
-    dmenu.start()
-    server.show_dmenu(args)
+    if args.command != 'daemon':
+        option = request_option(args)
+        dmenu.pending.append(None if option is None else MenuOption[option])
+    try:
+        dmenu.run()
+    finally:
+        # Clients started by keepmenu.socket may already use the auth file
+        if not server.activated and exists(expanduser(AUTH_FILE)):
+            os.remove(expanduser(AUTH_FILE))
+
 
-    server.join()
-    if exists(expanduser(AUTH_FILE)):
-        os.remove(expanduser(AUTH_FILE))
+def generate_passwords(args):
+    """Print `args.count` generated passwords, one per line, and their
+    entropy on stderr (`keepmenu generate`)
+
+    """
+    length = args.length
+    if args.preset.lower() == PASSPHRASE_PRESET.lower():
+        try:
+            generator = get_passphrase_generator()
+        except (OSError, ValueError) as err:
+            sys.exit("Passphrase word list error: {}".format(err))
+        length = args.words or generator.words
+    else:
+        presets = get_password_presets()
+        preset = next((v for k, v in presets.items() if k.lower() == args.preset.lower()), None)
+        if preset is None:
+            sys.exit("Unknown preset '{}'. Available presets: {}".format(
+                args.preset, ", ".join(list(presets) + [PASSPHRASE_PRESET])))
+        generator = PasswordGenerator({args.preset: preset})
+    if generator.generate(length) is False:
+        sys.exit("Number of char groups desired is more than requested pw length")
+    print("Entropy: {:.1f} bits".format(generator.entropy(length)), file=sys.stderr)
+    out = sys.stdout
+    batch = 1000
+    for start in range(0, args.count, batch):
+        out.write("\n".join(generator.generate(length)
+                             for _ in range(min(batch, args.count - start))) + "\n")
+    out.flush()
 
 
 def main():
@@ -1584,14 +5156,54 @@ def main():
     parser.add_argument('--view-entry', action='store_true', default='False', dest='view_entry')
     parser.add_argument('--type-username', action='store_true', default='False', dest='type_username')
     parser.add_argument('--type-entry', action='store_true', default='False', dest='type_entry')
+    parser.add_argument('--stats', action='store_true',
+                        help="Print the latency and cache statistics of the daemon")
+    subparsers = parser.add_subparsers(dest='command')
+    gen = subparsers.add_parser('generate', help="Print generated passwords")
+    gen.add_argument('--count', '-n', type=int, default=1)
+    gen.add_argument('--length', '-l', type=int, default=20)
+    gen.add_argument('--preset', '-p', default="Letters+Digits+Punctuation",
+                     help="Password character preset (see config.ini) or Passphrase")
+    gen.add_argument('--words', '-w', type=int, default=None,
+                     help="Number of words for the Passphrase preset")
+    subparsers.add_parser('audit', help="Print breached, reused, weak and old passwords")
+    subparsers.add_parser('breach-index', help="Build the breach corpus prefix index")
+    subparsers.add_parser('daemon', help="Run the daemon without opening a menu "
+                                         "(e.g. started by keepmenu.socket)")
     args = parser.parse_args()
 
+    if args.command == 'generate':
+        process_config()
+        generate_passwords(args)
+        return
+    if args.command == 'audit':
+        process_config()
+        audit_passwords()
+        return
+    if args.command == 'breach-index':
+        process_config()
+        build_breach_index()
+        return
+    if args.command == 'daemon':
+        process_config()
+        start_server(args)
+        return
+    if args.stats:
+        try:
+            print(json.dumps(client({'cmd': 'stats'}), indent=2))
+        except ConnectionRefusedError:
+            sys.exit("Keepmenu daemon is not running")
+        except (OSError, ValueError) as err:
+            sys.exit("Keepmenu daemon error: {}".format(err))
+        return
+
     try:
-        MANAGER = client()
-        MANAGER.show_dmenu(args)  # pylint: disable=no-member
-    except socket.error:
+        client({'cmd': 'show', 'option': request_option(args)})
+    except ConnectionRefusedError:
         process_config()
         start_server(args)
+    except (OSError, ValueError) as err:
+        sys.exit("Keepmenu daemon error: {}".format(err))
 
 if __name__ == '__main__':
     main()
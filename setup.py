@@ -12,7 +12,9 @@ setup(name="keepmenu",
       download_url="https://github.com/firecat53/keepmenu/tarball/0.6.1",
       scripts=['keepmenu'],
       data_files=[('share/doc/keepmenu', ['README.rst', 'LICENSE',
-                                          'config.ini.example']),
+                                          'config.ini.example',
+                                          'keepmenu.socket',
+                                          'keepmenu.service']),
                   ('share/man/man1', ['keepmenu.1'])],
       install_requires=["pynput", "pykeepass"],
       license="GPL3",
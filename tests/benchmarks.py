@@ -0,0 +1,858 @@
+"""Benchmarks for keepmenu
+
+Run from the repository root: `python tests/benchmarks.py`. The typing is
+stubbed, so `us/op` is the dispatch overhead per operation and `typing` the
+modelled typing time (`--call-us`, `--key-us`). Use `--load` to
+benchmark opening a database with entry history, `--daemon` to benchmark the
+daemon memory and request latency, `--suite` for the microbenchmarks on
+generated databases (see generate_database.py).
+
+`--e2e` drives the daemon like the hotkey: client() requests, a fake dmenu
+answering after `--delay` ms and a fake xdotool/ydotool logging the typing.
+It reports the hotkey to typed latency. `--stress CLIENTS` sends that many
+requests at once, `--rounds` times, and fails if one is lost.
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+from shutil import copyfile, rmtree
+import signal
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from generate_database import KM, PASSWORD, generate
+
+
+class FakeEntry:  # pylint: disable=too-few-public-methods
+    """Minimal stand-in for a pykeepass Entry
+
+    """
+    def __init__(self, notes=""):
+        self.title = "Benchmark title"
+        self.username = "benchmark-user"
+        self.password = "aB3$" * 16
+        self.url = "https://example.com/login"
+        self.notes = notes
+
+
+class IOTimer:
+    """Stand-in for the typing I/O (subprocess.call, pynput Controller and
+    time.sleep). The stubs return at once and count the operations. Each one
+    is charged a modelled cost as typing time: `call_us` per command (xdotool,
+    ydotool) and `key_us` per pynput Controller call.
+
+    """
+    def __init__(self, call_us=0.0, key_us=0.0):
+        self.call_us = call_us
+        self.key_us = key_us
+        self.reset()
+
+    def reset(self):
+        self.ops = 0
+        self.io_time = 0.0
+        self.delay_ms = 0.0
+
+    def call(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self.ops += 1
+        self.io_time += self.call_us / 1e6
+        return 0
+
+    def _key(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self.ops += 1
+        self.io_time += self.key_us / 1e6
+
+    def sleep(self, secs):
+        self.delay_ms += secs * 1000
+
+    def controller(self):
+        """Return an object with the pynput Controller interface
+
+        """
+        timer = self
+        ctrl = types.SimpleNamespace(type=timer._key, tap=timer._key,
+                                     InvalidCharacterException=ValueError)
+        ctrl.pressed = lambda *keys: timer
+        return ctrl
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+SEQUENCES = {
+    "default": ("{USERNAME}{TAB}{PASSWORD}{ENTER}", ""),
+    "notes_4k": ("{NOTES}", (string.ascii_letters * 80)[:4096]),
+    "modifiers": ("+{TAB}^a%b{HOME}+{END}{DEL}" * 50, ""),
+    "delays": ("{DELAY 1}x" * 100, ""),
+}
+
+BACKENDS = ("pynput", "xdotool", "ydotool", "recording", "null")
+
+
+def bench_tokenize(sequence, iterations):
+    """Time tokenize_autotype alone
+
+    Returns: (seconds per run, number of tokens)
+
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        tokens = list(KM.tokenize_autotype(sequence))
+    return (time.perf_counter() - start) / iterations, len(tokens)
+
+
+def command_cost_us(repeat=50):
+    """Return the median time of running a command (`true`), the typing cost
+    of one xdotool or ydotool operation apart from the tool itself
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.call(['true'])
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1e6
+
+
+def bench_backend(backend, sequence, entry, iterations, timer):
+    """Time tokenizing + dispatch of a sequence through one TypeBackend. The
+    stubbed typing takes no time, so all the measured time is overhead; the
+    typing time is modelled by the IOTimer.
+
+    Returns: dict of results
+
+    """
+    timer.reset()
+    KM.RECORDED_OPS.clear()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        backend.type_entry(entry, KM.tokenize_autotype(sequence))
+    total = time.perf_counter() - start
+    ops = (timer.ops + len(KM.RECORDED_OPS)) / iterations
+    overhead = total / iterations
+    return {"backend": backend.name,
+            "run_ms": (total + timer.io_time) / iterations * 1000,
+            "typing_ms": timer.io_time / iterations * 1000,
+            "delay_ms": timer.delay_ms / iterations,
+            "ops": ops,
+            "overhead_us_per_op": overhead / ops * 1e6 if ops else 0.0}
+
+
+def bench_load(entries, history, iterations):
+    """Time decrypting and parsing a database (the KDF excluded) with
+    PyKeePass and with the read-only streaming reader, and revealing one
+    protected value from the read-only view
+
+    Returns: list of dicts of results
+
+    """
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "load.kdbx")
+    generate(path, entries=entries, depth=0, history=history, kdbx=3)
+    loader = KM.DatabaseLoader(path, '')
+    loader.thread.join()
+    data, key = loader.data, loader.transformed_key("password")
+    rmtree(tmpdir)
+    results = []
+    for name, load in (("pykeepass", lambda: KM.KDBX.parse(data, password=None, keyfile=None,
+                                                            transformed_key=key)),
+                       ("readonly", lambda: KM.read_database(data, key))):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            res = load()
+        res = {"loader": name, "entries": entries, "history": entries * history,
+               "load_ms": (time.perf_counter() - start) / iterations * 1000}
+        if name == "pykeepass":
+            res["plaintext_values"] = len(load().body.payload.xml.xpath(
+                "//Value[@Protected='False']"))
+        else:
+            view = load()
+            res["plaintext_values"] = 0
+            start = time.perf_counter()
+            for entry in view.entries:
+                entry.password  # pylint: disable=pointless-statement
+            res["reveal_us"] = (time.perf_counter() - start) / len(view.entries) * 1e6
+        results.append(res)
+    return results
+
+
+DAEMON_DMENU = """#!/bin/sh
+cat > /dev/null
+date +%s.%N >> "{}"
+"""
+
+
+def write_script(path, text):
+    """Write an executable shell script"""
+    with open(path, 'w') as fout:
+        fout.write(text)
+    os.chmod(path, 0o700)
+
+
+def daemon_env(tmpdir, dmenu, config=""):
+    """Make a home directory in `tmpdir` with a copy of tests/test.kdbx and a
+    config.ini using the `dmenu` script
+
+    Args: tmpdir - directory for the home, database and scripts
+          dmenu - text of the fake dmenu script
+          config - more settings of the [database] section
+    Returns: environment for the daemon
+
+    """
+    home = os.path.join(tmpdir, "home")
+    os.makedirs(os.path.join(home, ".config", "keepmenu"))
+    os.makedirs(os.path.join(home, ".cache"))
+    copyfile("tests/test.kdbx", os.path.join(tmpdir, "test.kdbx"))
+    write_script(os.path.join(tmpdir, "dmenu"), dmenu)
+    with open(os.path.join(home, ".config", "keepmenu", "config.ini"), 'w') as fout:
+        fout.write("[dmenu]\ndmenu_command = {}\n[database]\ndatabase_1 = {}\n"
+                   "password_1 = password\n{}".format(os.path.join(tmpdir, "dmenu"),
+                                                     os.path.join(tmpdir, "test.kdbx"),
+                                                     config))
+    return dict(os.environ, HOME=home)
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants"""
+    children = {}
+    for stat in os.listdir('/proc'):
+        if stat.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(stat)) as fstat:
+                    ppid = int(fstat.read().rsplit(')', 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(ppid, []).append(int(stat))
+    pids = [pid]
+    for i in pids:
+        pids.extend(children.get(i, []))
+    return pids
+
+
+def memory_kb(pids):
+    """Return the summed (RSS, PSS) of processes in kB"""
+    rss = pss = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/smaps_rollup'.format(pid)) as smaps:
+                for line in smaps:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+        except OSError:
+            pass
+    return rss, pss
+
+
+def bench_daemon(keepmenu, iterations):
+    """Start the keepmenu daemon with a fake dmenu and send `--type-entry`
+    requests with the command line client. The request latency is the time
+    from starting the client until dmenu is started, so it includes the
+    start of the client.
+
+    Returns: dict of results
+
+    """
+    tmpdir = tempfile.mkdtemp()
+    calls = os.path.join(tmpdir, "calls")
+    env = daemon_env(tmpdir, DAEMON_DMENU.format(calls))
+
+    def menus(count):
+        """Wait until dmenu was started `count` times, return the start times"""
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if os.path.exists(calls):
+                with open(calls) as fcalls:
+                    times = [float(i) for i in fcalls.read().split()]
+                if len(times) >= count:
+                    return times
+            time.sleep(0.001)
+        raise TimeoutError("dmenu wasn't started")
+
+    daemon = subprocess.Popen([sys.executable, keepmenu], env=env, start_new_session=True)
+    # Startup: the action menu, closed without a selection
+    count = len(menus(1))
+    time.sleep(1)
+    latencies = []
+    clients = []
+    try:
+        for _ in range(iterations):
+            start = time.time()
+            subprocess.call([sys.executable, keepmenu, '--type-entry'], env=env)
+            clients.append(time.time() - start)
+            # The entry menu, then the action menu after no entry was selected
+            times = menus(count + 2)
+            latencies.append(times[count] - start)
+            count = len(times)
+        time.sleep(0.5)
+        pids = process_tree(daemon.pid)
+        rss, pss = memory_kb(pids)
+    finally:
+        os.killpg(daemon.pid, signal.SIGTERM)
+        daemon.wait()
+        rmtree(tmpdir)
+    latencies.sort()
+    return {"keepmenu": keepmenu, "processes": len(pids), "rss_kb": rss, "pss_kb": pss,
+            "client_ms": sum(clients) / len(clients) * 1000,
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000}
+
+
+# Answer a menu after a delay with the first line containing the pick text
+E2E_DMENU = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = -p ]; then prompt=$2; fi
+    shift
+done
+echo "$(date +%s.%N) $prompt" >> "{calls}"
+sleep {delay}
+grep -m 1 -F "{pick}"
+cat > /dev/null
+"""
+
+# Stand-in for xdotool and ydotool which logs what would have been typed
+E2E_TYPIST = """#!/bin/sh
+echo "$(date +%s.%N) $*" >> "{typed}"
+"""
+
+E2E_PICK = "Test Title 1"
+
+E2E_OPTIONS = ("TypeEntry", "TypePassword", "TypeUsername")
+
+
+def read_log(path):
+    """Return the complete (timestamp, text) lines of a fake dmenu or typing
+    log
+
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as flog:
+        lines = [i[:-1].split(" ", 1) for i in flog if i.endswith("\n")]
+    return [(float(i[0]), i[1] if len(i) > 1 else "") for i in lines]
+
+
+def wait_log(path, count, timeout=30):
+    """Wait until the log has `count` lines and return them"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        lines = read_log(path)
+        if len(lines) >= count:
+            return lines
+        time.sleep(0.001)
+    raise TimeoutError("{}: {} of {} lines".format(path, len(read_log(path)), count))
+
+
+class E2EDaemon:
+    """Daemon with the fake dmenu and typing commands, driven through
+    client() like the hotkey would be
+
+    """
+    def __init__(self, keepmenu, backend, delay):
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls = os.path.join(self.tmpdir, "calls")
+        self.typed = os.path.join(self.tmpdir, "typed")
+        bindir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(bindir)
+        write_script(os.path.join(bindir, backend), E2E_TYPIST.format(typed=self.typed))
+        env = daemon_env(self.tmpdir, E2E_DMENU.format(calls=self.calls, delay=delay,
+                                                       pick=E2E_PICK),
+                         "type_library = {}\ntrace = True\n".format(backend))
+        env['PATH'] = bindir + os.pathsep + env['PATH']
+        env.pop('XDG_RUNTIME_DIR', None)
+        KM.AUTH_FILE = os.path.join(env['HOME'], ".cache", ".keepmenu-auth")
+        KM.SOCKET_FILE = None
+        self.proc = subprocess.Popen([sys.executable, keepmenu, 'daemon'], env=env,
+                                     start_new_session=True)
+        deadline = time.time() + 30
+        while not os.path.exists(KM.AUTH_FILE):
+            if time.time() > deadline or self.proc.poll() is not None:
+                self.stop()
+                raise TimeoutError("The daemon didn't start")
+            time.sleep(0.01)
+        time.sleep(0.1)
+        keys = KM.TYPE_BACKENDS[backend].keys
+        # The first {ENTER} is typed twice (double_enter)
+        enter = [" ".join(keys['{ENTER}'])] * (1 + KM.TYPE_BACKENDS[backend].double_enter)
+        entry = KM.PyKeePass("tests/test.kdbx", PASSWORD).find_entries(title=E2E_PICK, first=True)
+        self.expected = {'TypeEntry': ["type " + entry.username, " ".join(keys['{TAB}']),
+                                       "type " + entry.password] + enter,
+                         'TypePassword': ["type " + entry.password],
+                         'TypeUsername': ["type " + entry.username]}
+
+    def stats(self):
+        return KM.client({'cmd': 'stats'})
+
+    def hotkey(self, option):
+        """Send a request and wait until it was typed
+
+        Returns: (start time, request time, [(menu start, prompt)], typed lines)
+
+        """
+        ncalls = len(read_log(self.calls))
+        ntyped = len(read_log(self.typed))
+        start = time.time()
+        if KM.client({'cmd': 'show', 'option': option}) != {'ok': True}:
+            raise ValueError("Request {} failed".format(option))
+        sent = time.time()
+        typed = wait_log(self.typed, ntyped + len(self.expected[option]))[ntyped:]
+        return start, sent, read_log(self.calls)[ncalls:], typed
+
+    def idle(self, timeout=10):
+        """Wait until every received request was merged, served, cancelled or
+        dropped, and return the stats
+
+        """
+        deadline = time.time() + timeout
+        while True:
+            stats = self.stats()
+            counts = stats['requests']
+            if counts['received'] == sum(v for k, v in counts.items() if k != 'received') \
+                    or time.time() > deadline:
+                return stats
+            time.sleep(0.01)
+
+    def settle(self, quiet):
+        """Wait until no request is queued and no menu was started or key
+        typed for `quiet` seconds
+
+        """
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if self.stats()['requests']['pending'] == 0:
+                last = max([i[0] for i in read_log(self.calls)[-1:] + read_log(self.typed)[-1:]],
+                           default=0)
+                if time.time() - last > quiet:
+                    return
+            time.sleep(0.05)
+        raise TimeoutError("The daemon is still busy")
+
+    def stop(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        rmtree(self.tmpdir)
+
+
+def bench_e2e(keepmenu, backend, delay, iterations):
+    """Drive the client -> daemon -> menu -> typing path: send `--type-entry`
+    requests with client(), answer the entry menu with a fake dmenu after
+    `delay` seconds and log the typing with a fake xdotool or ydotool. The
+    latency is the time from sending the request until the last key was
+    typed; `typing` is the part after the menu was answered.
+
+    Returns: dict of results
+
+    """
+    daemon = E2EDaemon(keepmenu, backend, delay)
+    tracer = KM.Tracer()
+    tracer.enabled = True
+    try:
+        # The first request waits for the database to be unlocked
+        start, _, _, typed = daemon.hotkey('TypeEntry')
+        first = typed[-1][0] - start
+        wrong = 0
+        for _ in range(iterations):
+            start, sent, menus, typed = daemon.hotkey('TypeEntry')
+            if [i[1] for i in typed] != daemon.expected['TypeEntry']:
+                wrong += 1
+            tracer.add('client', sent - start)
+            tracer.add('hotkey_to_menu', menus[0][0] - start)
+            tracer.add('typing', typed[-1][0] - menus[0][0] - delay)
+            tracer.add('hotkey_to_typed', typed[-1][0] - start)
+        stats = daemon.stats()
+    finally:
+        daemon.stop()
+    return {"keepmenu": keepmenu, "backend": backend, "delay_ms": delay * 1000,
+            "iterations": iterations, "first_ms": round(first * 1000, 3),
+            "wrongly_typed": wrong, "latency": tracer.stats()['spans'],
+            "daemon": stats['spans']}
+
+
+def stress_client(barrier, option, responses):
+    """Send a request as soon as all clients are ready"""
+    barrier.wait()
+    try:
+        responses.append(KM.client({'cmd': 'show', 'option': option}))
+    except (OSError, ValueError) as err:
+        responses.append({'error': repr(err)})
+
+
+def bench_stress(keepmenu, backend, delay, clients, rounds):
+    """Fire `clients` requests at the daemon at once, `rounds` times, and
+    check every request was answered and either served, merged into an
+    identical queued request or cancelled by a newer one. A last request
+    checks the daemon still types.
+
+    Returns: dict of results
+
+    """
+    daemon = E2EDaemon(keepmenu, backend, delay)
+    rand = random.Random(0)
+    errors = []
+    try:
+        daemon.hotkey('TypeEntry')
+        before = daemon.idle()['requests']
+        start = time.time()
+        for _ in range(rounds):
+            barrier = threading.Barrier(clients)
+            responses = []
+            threads = [threading.Thread(target=stress_client,
+                                        args=(barrier, rand.choice(E2E_OPTIONS), responses))
+                       for _ in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            errors.extend(i for i in responses if i != {'ok': True})
+        burst = time.time() - start
+        daemon.settle(2 * delay + 0.5)
+        _, _, _, typed = daemon.hotkey('TypeEntry')
+        if [i[1] for i in typed] != daemon.expected['TypeEntry']:
+            errors.append({'error': "wrongly typed after the burst"})
+        stats = daemon.idle()
+    finally:
+        daemon.stop()
+    counts = {k: v - before.get(k, 0) for k, v in stats['requests'].items()}
+    counts['pending'] = stats['requests']['pending']
+    sent = clients * rounds + 1
+    # Dropped requests, and any the daemon didn't account for, are lost
+    lost = sent - sum(counts[i] for i in ('merged', 'served', 'cancelled', 'pending'))
+    if counts['received'] != sent:
+        errors.append({'error': "{} of {} requests received".format(counts['received'], sent)})
+    return {"keepmenu": keepmenu, "clients": clients, "rounds": rounds, "sent": sent,
+            "burst_ms": round(burst * 1000, 3), "requests": counts, "lost": lost,
+            "errors": errors, "queue": stats['spans'].get('queue'),
+            "connect": stats['spans'].get('connect')}
+
+
+SUITE_CHARS = {"Letters+Digits+Punctuation": {"upper": string.ascii_uppercase,
+                                               "lower": string.ascii_lowercase,
+                                               "digits": string.digits,
+                                               "punctuation": string.punctuation}}
+
+
+def time_ms(func, repeat):
+    """Run func `repeat` times
+
+    Returns: (min, median) milliseconds per run
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def suite_runner(path, view):
+    """A DmenuRunner serving `view`, without reading the config or opening
+    the database again
+
+    """
+    runner = KM.DmenuRunner.__new__(KM.DmenuRunner)
+    runner.database = (path, '', PASSWORD)
+    runner.unlock_thread = None
+    runner.listing = None
+    runner.listing_shown = False
+    runner.hidden_groups = None
+    runner._view = view  # pylint: disable=protected-access
+    runner._kpo = None  # pylint: disable=protected-access
+    return runner
+
+
+def suite_error(prompt):
+    """dmenu_err() replacement for the suite"""
+    raise RuntimeError(prompt)
+
+
+def suite_database(entries, db_dir, **kwds):
+    """Return the path of a generated database, reusing it from db_dir"""
+    name = "{}-{}.kdbx".format(entries, "-".join(
+        "{}{}".format(key, value) for key, value in sorted(kwds.items())))
+    path = os.path.join(db_dir, name)
+    if not os.path.exists(path):
+        generate(path, entries=entries, **kwds)
+    return path
+
+
+def bench_suite(sizes, repeat, db_dir, **kwds):
+    """Time the steps of a request on generated databases of each size
+
+    Args: sizes - entry counts
+          repeat - runs per benchmark (the slow unlock runs fewer times)
+          db_dir - directory for the generated databases
+          kwds - generate() settings (group depth, history, attachments, KDF)
+    Returns: list of dicts {bench, entries, min_ms, median_ms, runs}, or
+             {bench, entries, error} if the database couldn't be opened
+
+    """
+    results = []
+
+    def add(name, entries, func, runs):
+        min_ms, median_ms = time_ms(func, runs)
+        results.append({"bench": name, "entries": entries, "min_ms": round(min_ms, 4),
+                        "median_ms": round(median_ms, 4), "runs": runs})
+
+    generator = KM.PasswordGenerator(SUITE_CHARS)
+    add("password_generation_x100", 0, lambda: [generator.generate(20) for _ in range(100)],
+        repeat)
+    sequence = SEQUENCES["default"][0]
+    add("tokenize_autotype", 0, lambda: list(KM.tokenize_autotype(sequence)), repeat * 100)
+    orig_dmenu_select, orig_dmenu_err = KM.dmenu_select, KM.dmenu_err
+    # select_group() picks the last group, without a menu
+    KM.dmenu_select = lambda num_lines, prompt, inp: inp.rsplit(b"\n", 1)[-1].decode()
+    KM.dmenu_err = suite_error
+    try:
+        for entries in sizes:
+            path = suite_database(entries, db_dir, **kwds)
+
+            def unlock(path=path):
+                KM.DB_LOADERS.clear()
+                return KM.get_entries((path, '', PASSWORD), readonly=True)
+
+            unlock_runs = max(1, repeat // 10)
+            add("unlock", entries, unlock, unlock_runs)
+            add("reload", entries, lambda path=path: KM.get_entries((path, '', PASSWORD),
+                                                                      readonly=True), unlock_runs)
+            view = KM.get_entries((path, '', PASSWORD), readonly=True)
+            runner = suite_runner(path, view)
+            add("get_entries_descriptions", entries, runner.get_entries_descriptions, repeat)
+            add("is_hidden", entries,
+                lambda runner=runner, view=view: [e for e in view.entries
+                                                  if not runner.is_hidden(e)], repeat)
+            descriptions = runner.get_entries_descriptions(include_hidden=True)
+            picks = [descriptions[i] for i in range(0, len(descriptions),
+                                                    max(1, len(descriptions) // 100))]
+            add("get_selected_entry_x100", entries,
+                lambda runner=runner, picks=picks: [runner.get_selected_entry(i)
+                                                    for i in picks], repeat)
+            runner.listing = KM.listing_records(view)
+            runner.listing_shown = True
+            KM.entry_index(view)
+            add("get_selected_entry_listing_x100", entries,
+                lambda runner=runner, picks=picks: [runner.get_selected_entry(i)
+                                                    for i in picks], repeat)
+            try:
+                kpo = KM.get_entries((path, '', PASSWORD))
+            except RuntimeError as err:
+                results.append({"bench": "select_group", "entries": entries, "error": str(err)})
+            else:
+                add("select_group", entries, lambda kpo=kpo: KM.select_group(kpo), repeat)
+            KM.ENTRY_INDEXES.clear()
+            KM.DB_LOADERS.clear()
+    finally:
+        KM.dmenu_select, KM.dmenu_err = orig_dmenu_select, orig_dmenu_err
+    return results
+
+
+def suite_metadata(sizes, repeat, **kwds):
+    """Where and with which settings the suite ran, to tell result files
+    apart
+
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "settings": dict(kwds, sizes=",".join(map(str, sizes)), repeat=repeat)}
+
+
+def compare_suite(old, new):
+    """Print the median times of two suite result files side by side"""
+    old_ms = {(i["bench"], i["entries"]): i.get("median_ms") for i in old["results"]}
+    print("{:<34} {:>8} {:>12} {:>12} {:>8}".format(
+        "bench", "entries", old["metadata"]["commit"] or "old",
+        new["metadata"]["commit"] or "new", "ratio"))
+    for res in new["results"]:
+        before = old_ms.get((res["bench"], res["entries"]))
+        if "error" in res:
+            print("{:<34} {:>8} {}".format(res["bench"], res["entries"], res["error"]))
+            continue
+        print("{:<34} {:>8} {:>10} {:>10.3f}ms {:>8}".format(
+            res["bench"], res["entries"],
+            "{:.3f}ms".format(before) if before is not None else "-", res["median_ms"],
+            "{:.2f}".format(res["median_ms"] / before) if before else "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmarks')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    parser.add_argument('--call-us', type=float,
+                        help="Modelled typing time per xdotool/ydotool command "
+                        "(default: measured time to run `true`)")
+    parser.add_argument('--key-us', type=float, default=0.0,
+                        help="Modelled typing time per pynput call")
+    parser.add_argument('--load', action='store_true',
+                        help="Benchmark opening a database instead of auto-type")
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--history', type=int, default=None,
+                        help="History items per entry (default 10 for --load, 2 for --suite)")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Benchmark the daemon memory and request latency instead")
+    parser.add_argument('--keepmenu', default='keepmenu',
+                        help="keepmenu script for --daemon, --e2e and --stress, "
+                        "e.g. an older version")
+    parser.add_argument('--e2e', action='store_true',
+                        help="Measure the hotkey to typed latency through the daemon instead")
+    parser.add_argument('--stress', type=int, metavar='CLIENTS',
+                        help="Send this many requests to the daemon at once instead")
+    parser.add_argument('--rounds', type=int, default=10, help="Bursts of --stress")
+    parser.add_argument('--backend', choices=("xdotool", "ydotool"), default="xdotool",
+                        help="Typing command faked for --e2e and --stress")
+    parser.add_argument('--delay', type=float, default=50,
+                        help="Milliseconds until the fake dmenu answers")
+    parser.add_argument('--suite', action='store_true',
+                        help="Run the microbenchmarks on generated databases instead")
+    parser.add_argument('--sizes', default="1000,10000,100000",
+                        help="Entry counts of the generated databases")
+    parser.add_argument('--depth', type=int, default=3, help="Group tree depth")
+    parser.add_argument('--attachment-size', type=int, default=0)
+    parser.add_argument('--kdbx', type=int, choices=(3, 4), default=4)
+    parser.add_argument('--db-dir', help="Keep the generated databases here for the next run")
+    parser.add_argument('--output', '-o', help="Write the suite results to this JSON file")
+    parser.add_argument('--compare', help="Suite results JSON file to compare with")
+    args = parser.parse_args()
+
+    if args.suite:
+        db_dir = args.db_dir or tempfile.mkdtemp()
+        os.makedirs(db_dir, exist_ok=True)
+        KM.CONF_FILE = os.path.join(db_dir, "keepmenu-config.ini")
+        KM.process_config()
+        KM.SETTINGS = KM.SETTINGS._replace(hide_groups=("Group 1",))
+        sizes = [int(i) for i in args.sizes.split(',')]
+        repeat = max(1, args.iterations // 10)
+        settings = {"kdbx": args.kdbx, "depth": args.depth,
+                    "history": 2 if args.history is None else args.history,
+                    "attachment_size": args.attachment_size}
+        try:
+            results = bench_suite(sizes, repeat, db_dir, **settings)
+        finally:
+            if not args.db_dir:
+                rmtree(db_dir)
+        res = {"metadata": suite_metadata(sizes, repeat, **settings), "results": results}
+        if args.output:
+            with open(args.output, 'w') as fout:
+                json.dump(res, fout, indent=2)
+        if args.compare:
+            with open(args.compare) as fin:
+                compare_suite(json.load(fin), res)
+        elif args.json or not args.output:
+            print(json.dumps(res, indent=2))
+        return
+
+    if args.stress:
+        res = bench_stress(args.keepmenu, args.backend, args.delay / 1000, args.stress,
+                           args.rounds)
+        if args.json:
+            print(json.dumps(res, indent=2))
+        else:
+            print("{keepmenu}: {sent} requests in {burst_ms:.1f}ms, {requests[served]} served, "
+                  "{requests[merged]} merged, {requests[cancelled]} cancelled, "
+                  "{lost} lost, {nerrors} errors, "
+                  "queue p50 {queue[p50_ms]:.1f}ms p99 {queue[p99_ms]:.1f}ms".format(
+                      nerrors=len(res["errors"]), **res))
+            for err in res["errors"]:
+                print(err["error"])
+        if res["lost"] or res["errors"]:
+            sys.exit(1)
+        return
+
+    if args.e2e:
+        res = bench_e2e(args.keepmenu, args.backend, args.delay / 1000, args.iterations)
+        if args.json:
+            print(json.dumps(res, indent=2))
+        else:
+            print("{keepmenu} ({backend}, menu answered after {delay_ms:.0f}ms): "
+                  "first request {first_ms:.1f}ms, {wrongly_typed} of {iterations} "
+                  "wrongly typed".format(**res))
+            for name, span in res["latency"].items():
+                print("{:<16} p50 {p50_ms:>8.1f}ms p95 {p95_ms:>8.1f}ms "
+                      "p99 {p99_ms:>8.1f}ms".format(name, **span))
+        if res["wrongly_typed"]:
+            sys.exit(1)
+        return
+
+    if args.daemon:
+        res = bench_daemon(args.keepmenu, max(1, args.iterations // 10))
+        if args.json:
+            print(json.dumps(res, indent=2))
+            return
+        print("{keepmenu}: {processes} processes, RSS {rss_kb} kB, PSS {pss_kb} kB, "
+              "client {client_ms:.1f}ms, request p50 {p50_ms:.1f}ms "
+              "p95 {p95_ms:.1f}ms".format(**res))
+        return
+
+    if args.load:
+        results = bench_load(args.entries, 10 if args.history is None else args.history, max(1, args.iterations // 100))
+        if args.json:
+            print(json.dumps(results, indent=2))
+            return
+        print("{:<10} {:>8} {:>8} {:>10} {:>10} {:>10}".format(
+            "loader", "entries", "history", "load", "plaintext", "reveal"))
+        for res in results:
+            print("{loader:<10} {entries:>8} {history:>8} {load_ms:>8.1f}ms "
+                  "{plaintext_values:>10} {reveal}".format(
+                      reveal="{:>8.1f}us".format(res["reveal_us"]) if "reveal_us" in res
+                      else "{:>10}".format("-"), **res))
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    KM.CONF_FILE = os.path.join(tmpdir, "keepmenu-config.ini")
+    KM.process_config()
+    rmtree(tmpdir)
+    timer = IOTimer(command_cost_us() if args.call_us is None else args.call_us, args.key_us)
+    KM.call = timer.call
+    KM.keyboard.Controller = timer.controller
+    KM.time = types.SimpleNamespace(sleep=timer.sleep, time=time.time)
+    KM.shutil = types.SimpleNamespace(which=lambda name: name)
+    KM.dmenu_err = lambda prompt: sys.exit("Error: {}".format(prompt))
+
+    results = []
+    for seq_name, (sequence, notes) in SEQUENCES.items():
+        entry = FakeEntry(notes)
+        tok_time, num_tokens = bench_tokenize(sequence, args.iterations)
+        for name in BACKENDS:
+            backend = KM.TYPE_BACKENDS[name]()
+            res = bench_backend(backend, sequence, entry, args.iterations, timer)
+            res.update({"sequence": seq_name, "tokens": num_tokens,
+                        "tokenize_ms": tok_time * 1000})
+            results.append(res)
+    if args.json:
+        print(json.dumps({"call_us": timer.call_us, "key_us": timer.key_us,
+                          "results": results}, indent=2))
+        return
+    print("Modelled typing time: {:.1f}us per command, {:.1f}us per pynput call".format(
+        timer.call_us, timer.key_us))
+    print("{:<10} {:<10} {:>7} {:>10} {:>10} {:>10} {:>10} {:>8} {:>12}".format(
+        "sequence", "backend", "tokens", "tokenize", "run", "typing", "delay",
+        "ops", "us/op"))
+    for res in results:
+        print("{sequence:<10} {backend:<10} {tokens:>7} {tokenize_ms:>8.3f}ms "
+              "{run_ms:>8.3f}ms {typing_ms:>8.3f}ms {delay_ms:>8.1f}ms {ops:>8.0f} "
+              "{overhead_us_per_op:>12.2f}".format(**res))
+
+
+if __name__ == "__main__":
+    main()
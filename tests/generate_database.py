@@ -0,0 +1,194 @@
+"""Generate synthetic Keepass databases for benchmarks
+
+Run from the repository root, e.g. `python tests/generate_database.py
+/tmp/10k.kdbx --entries 10000 --depth 3 --history 5`. The password is
+'password'.
+
+KDBX 4 databases use Argon2 (`--argon2-memory`, `--argon2-iterations`,
+`--argon2-parallelism`), KDBX 3 databases AES-KDF (`--rounds`). The defaults
+are cheap, so the KDF doesn't dominate the benchmarks.
+
+"""
+import argparse
+import base64
+import copy
+import importlib.machinery
+import os
+import random
+import sys
+import uuid
+
+from lxml import etree
+from pykeepass.kdbx_parsing.common import UnprotectedStream
+from pykeepass.pykeepass import BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD
+
+KM = importlib.machinery.SourceFileLoader('*', 'keepmenu').load_module()
+
+PASSWORD = "password"
+
+WORDS = ("mail", "bank", "shop", "forum", "cloud", "work", "home", "router",
+         "server", "wiki", "git", "chat", "news", "game", "travel", "tax")
+
+
+def protect_values(kpo):
+    """Encrypt the protected values with the inner stream cipher before
+    saving. pykeepass 3.2 encrypts a copy of the tree and writes the values
+    in plain text.
+
+    """
+    if kpo.version[0] == 3:
+        stream = kpo.kdbx.header.value.dynamic_header
+    else:
+        stream = kpo.kdbx.body.payload.inner_header
+    stream = KM.ProtectedStream(stream.protected_stream_id.data,
+                                stream.protected_stream_key.data)
+    cipher = (KM.Salsa20 if stream.stream_id == 'salsa20' else KM.ChaCha20).new(
+        key=stream.key, nonce=stream.nonce)
+    for value in kpo.tree.iter('Value'):
+        if value.get('Protected') != 'False':
+            continue
+        if value.text:
+            value.text = base64.b64encode(cipher.encrypt(value.text.encode('utf-8'))).decode()
+        value.set('Protected', 'True')
+
+
+def empty_database(kdbx, rounds, argon2_memory, argon2_iterations, argon2_parallelism):
+    """Return a PyKeePass object of an empty database with the given KDF
+    settings: tests/test.kdbx for KDBX 3, the pykeepass blank database for
+    KDBX 4
+
+    """
+    if kdbx == 3:
+        kpo = KM.PyKeePass("tests/test.kdbx", PASSWORD)
+        for entry in kpo.entries:
+            entry.delete()
+        kpo.kdbx.header.value.dynamic_header.transform_rounds.data = rounds
+    else:
+        kpo = KM.PyKeePass(BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD)
+        params = kpo.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+        params['M'].value = argon2_memory * 1024
+        params['I'].value = argon2_iterations
+        params['P'].value = argon2_parallelism
+    # Build the header from the changed values instead of the raw bytes read
+    del kpo.kdbx.header.data
+    kpo.password = PASSWORD
+    return kpo
+
+
+def make_groups(kpo, depth, fanout):
+    """Add `fanout` groups per level, `depth` levels deep
+
+    Returns: list of all group elements, the root group included
+
+    """
+    groups = [kpo.root_group]
+    level = [(kpo.root_group, "Group")]
+    for _ in range(depth):
+        next_level = []
+        for parent, prefix in level:
+            for idx in range(fanout):
+                name = "{} {}".format(prefix, idx + 1)
+                next_level.append((kpo.add_group(parent, name), name))
+        groups.extend(i[0] for i in next_level)
+        level = next_level
+    return [i._element for i in groups]
+
+
+def generate(path, entries=1000, depth=2, fanout=4, history=0, attachment_size=0,
+             attachment_every=10, kdbx=4, rounds=6000, argon2_memory=1024,
+             argon2_iterations=2, argon2_parallelism=1, seed=0):
+    """Write a database with `entries` entries spread over a group tree
+
+    Args: path - output file
+          entries - number of entries
+          depth, fanout - levels and groups per level of the group tree
+          history - history items per entry
+          attachment_size - bytes of random data attached to every
+                            `attachment_every`-th entry, 0 for none
+          kdbx - 3 (AES-KDF with `rounds`) or 4 (Argon2, `argon2_memory` in
+                 KiB)
+          seed - seed for the titles, usernames and group placement
+    Returns: PyKeePass object as saved
+
+    """
+    rand = random.Random(seed)
+    kpo = empty_database(kdbx, rounds, argon2_memory, argon2_iterations, argon2_parallelism)
+    groups = make_groups(kpo, depth, fanout)
+    template = kpo.add_entry(kpo.root_group, "template", "user", "password")._element
+    kpo.root_group._element.remove(template)
+    password = template.xpath("String[Key='Password']/Value")[0]
+    password.attrib.clear()
+    password.set('Protected', 'False')
+    for idx in range(entries):
+        elem = copy.deepcopy(template)
+        elem.find('UUID').text = base64.b64encode(
+            uuid.UUID(int=rand.getrandbits(128)).bytes).decode()
+        word = rand.choice(WORDS)
+        values = {'Title': "{} {}".format(word, idx),
+                  'UserName': "user{}@{}.example.com".format(idx, word),
+                  'URL': "https://{}.example.com/{}".format(word, idx)}
+        for key, value in values.items():
+            field = elem.xpath("String[Key='{}']/Value".format(key))
+            if field:
+                field[0].text = value
+            else:
+                string = etree.SubElement(elem, 'String')
+                etree.SubElement(string, 'Key').text = key
+                etree.SubElement(string, 'Value').text = value
+        hist = etree.SubElement(elem, 'History')
+        for version in range(history + 1):
+            elem.xpath("String[Key='Password']/Value")[0].text = \
+                "pw-{}-{}-{:016x}".format(idx, version, rand.getrandbits(64))
+            if version < history:
+                old = copy.deepcopy(elem)
+                old.remove(old.find('History'))
+                hist.append(old)
+        if attachment_size and idx % attachment_every == 0:
+            binary = etree.SubElement(elem, 'Binary')
+            etree.SubElement(binary, 'Key').text = "file{}.bin".format(idx)
+            etree.SubElement(binary, 'Value').set(
+                'Ref', str(kpo.add_binary(rand.getrandbits(8 * attachment_size).to_bytes(
+                    attachment_size, 'little'))))
+        rand.choice(groups).append(elem)
+    protect_values(kpo)
+    # Skip the useless encryption pass of pykeepass, its XPath fails on
+    # trees with more than 10M nodes (libxml2 limit)
+    unprotected_xpath = UnprotectedStream.unprotected_xpath
+    UnprotectedStream.unprotected_xpath = '/*[false()]'
+    try:
+        data = KM.KDBX.build(kpo.kdbx, password=PASSWORD, keyfile=None, transformed_key=None)
+    finally:
+        UnprotectedStream.unprotected_xpath = unprotected_xpath
+    with open(path + ".tmp", 'wb') as dbfile:
+        dbfile.write(data)
+    os.replace(path + ".tmp", path)
+    kpo.filename = path
+    return kpo
+
+
+def main():
+    parser = argparse.ArgumentParser('generate_database')
+    parser.add_argument('path')
+    parser.add_argument('--entries', '-n', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=2, help="Levels of groups")
+    parser.add_argument('--fanout', type=int, default=4, help="Groups per level")
+    parser.add_argument('--history', type=int, default=0, help="History items per entry")
+    parser.add_argument('--attachment-size', type=int, default=0,
+                        help="Attachment bytes, 0 for no attachments")
+    parser.add_argument('--attachment-every', type=int, default=10,
+                        help="Attach to every Nth entry")
+    parser.add_argument('--kdbx', type=int, choices=(3, 4), default=4)
+    parser.add_argument('--rounds', type=int, default=6000, help="AES-KDF rounds (KDBX 3)")
+    parser.add_argument('--argon2-memory', type=int, default=1024, help="KiB (KDBX 4)")
+    parser.add_argument('--argon2-iterations', type=int, default=2)
+    parser.add_argument('--argon2-parallelism', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        sys.exit("{} exists".format(args.path))
+    kwds = vars(args)
+    generate(kwds.pop('path'), **kwds)
+
+
+if __name__ == "__main__":
+    main()
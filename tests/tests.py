@@ -1,21 +1,24 @@
 """Unit tests for keepmenu
 
 """
+import contextlib
 import importlib
-from multiprocessing.managers import BaseManager
+import io
 import os
 from shutil import copyfile, rmtree
 import socket
 import string
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 KM = importlib.machinery.SourceFileLoader('*', 'keepmenu').load_module()
 
 
 class TestServer(unittest.TestCase):
-    """Test various BaseManager server functions
+    """Test the daemon Server and client functions
 
     """
     def setUp(self):
@@ -44,28 +47,90 @@ class TestServer(unittest.TestCase):
         """Ensure client raises an error with no server running
 
         """
-        self.assertRaises(socket.error, KM.client)
+        self.assertRaises(OSError, KM.client, {'cmd': 'show'})
 
-    def test_server(self):
-        """Ensure BaseManager server starts
+    def test_client_with_server(self):
+        """Ensure client() requests are answered by the Server on its event
+        loop and clients with the wrong authkey are rejected
 
         """
         server = KM.Server()
-        server.start()
-        self.assertTrue(server.is_alive())
-        server.terminate()
+        requests = []
 
-    def test_client_with_server(self):
-        """Ensure client() function can connect with a BaseManager server
-        instance
+        def show(request):
+            requests.append(request)
+            return {'ok': True}
+
+        loop = KM.asyncio.new_event_loop()
+        loop.run_until_complete(server.start({'show': show}))
+        thread = KM.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            self.assertEqual(KM.client({'cmd': 'show', 'option': 'TypeEntry'}), {'ok': True})
+            self.assertEqual([(i['cmd'], i['option']) for i in requests], [('show', 'TypeEntry')])
+            self.assertEqual(KM.client({'cmd': 'stats'}), {'error': 'unknown request'})
+            with open(KM.AUTH_FILE, 'w') as fout:
+                fout.write("[DEFAULT]\nport = {}\nauthkey = wrong\n".format(server.port))
+            self.assertRaises(ValueError, KM.client, {'cmd': 'show'})
+            self.assertEqual(len(requests), 1)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.close()
+
+
+    def test_socket_activation(self):
+        """Ensure the daemon adopts a listening socket inherited through
+        LISTEN_FDS and client() uses it, and otherwise opens its own
 
         """
-        port, key = KM.get_auth()
-        mgr = BaseManager(address=('127.0.0.1', port), authkey=key)
-        mgr.get_server()
-        mgr.start()
-        self.assertIsInstance(KM.client(), BaseManager)
-        mgr.shutdown()
+        old = KM.SD_LISTEN_FDS_START, KM.SOCKET_FILE, os.environ.copy()
+        pair = socket.socketpair()
+        try:
+            KM.SD_LISTEN_FDS_START = pair[0].fileno()
+            os.environ.update(LISTEN_PID=str(os.getpid() + 1), LISTEN_FDS='1')
+            self.assertEqual(KM.listen_fds(), [])
+            os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='1')
+            socks = KM.listen_fds()
+            self.assertEqual([sock.fileno() for sock in socks], [pair[0].fileno()])
+            self.assertNotIn('LISTEN_FDS', os.environ)
+            self.assertFalse(os.get_inheritable(pair[0].fileno()))
+            socks[0].detach()
+
+            KM.SOCKET_FILE = os.path.join(self.tmpdir, "keepmenu.sock")
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(KM.SOCKET_FILE)
+            listener.listen()
+            KM.SD_LISTEN_FDS_START = listener.fileno()
+            os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='1')
+            server = KM.Server()
+            self.assertTrue(server.activated)
+            self.assertIs(server.sock.family, socket.AF_UNIX)
+            listener.detach()
+            loop = KM.asyncio.new_event_loop()
+            loop.run_until_complete(server.start({'show': lambda request: {'ok': True}}))
+            thread = KM.Thread(target=loop.run_forever)
+            thread.start()
+            try:
+                self.assertEqual(KM.client({'cmd': 'show'}), {'ok': True})
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                server.close()
+                loop.close()
+            # Stale socket file: fall back to the port, then start a daemon
+            self.assertRaises(ConnectionRefusedError, KM.client, {'cmd': 'show'})
+            server = KM.Server()
+            self.assertFalse(server.activated)
+            self.assertIs(server.sock.family, socket.AF_INET)
+            server.close()
+        finally:
+            KM.SD_LISTEN_FDS_START, KM.SOCKET_FILE = old[:2]
+            os.environ.clear()
+            os.environ.update(old[2])
+            for sock in pair:
+                sock.close()
 
 
 class TestFunctions(unittest.TestCase):
@@ -127,6 +192,58 @@ class TestFunctions(unittest.TestCase):
         self.assertTrue(pword.isdisjoint(set(string.ascii_lowercase)))
         self.assertTrue(pword.isdisjoint(set('   ')))
 
+    def test_password_generator(self):
+        """Test the alphabet is the union of the character sets, the entropy
+        calculation and the fallback used when redrawing takes too long
+
+        """
+        chars = {'Min Punc': {'min punc': '!@#$%',
+                              'upper': string.ascii_uppercase},
+                 'Upper': {'ABC': 'ABC'}}
+        gen = KM.PasswordGenerator(chars)
+        self.assertEqual(len(gen.sampler), 31)
+        self.assertAlmostEqual(KM.PasswordGenerator({'D': {'d': string.digits}}).entropy(4),
+                               4 * KM.math.log2(10))
+        # Strings of length 2 over 'ab' containing both an 'a' and a 'b'
+        self.assertAlmostEqual(KM.PasswordGenerator({'x': {'a': 'a', 'b': 'b'}}).entropy(2), 1)
+        gen.max_attempts = 0
+        pword = gen.generate(3)
+        self.assertEqual(len(pword), 3)
+        self.assertFalse(set(pword).isdisjoint(set('ABC')))
+        self.assertFalse(set(pword).isdisjoint(set('!@#$%')))
+        self.assertFalse(gen.generate(2))
+        pool = KM.RandomPool(size=16)
+        self.assertTrue(all(0 <= pool.randbelow(300) < 300 for _ in range(1000)))
+        self.assertEqual(set(pool.randbelow(3) for _ in range(1000)), {0, 1, 2})
+
+    def test_passphrase_generator(self):
+        """Test the memory-mapped word list and passphrase generation
+
+        """
+        KM.process_config()
+        wl_name = os.path.join(self.tmpdir, "words.txt")
+        with open(wl_name, 'w') as wl_file:
+            wl_file.write("11111\tabacus\n11112\tabdomen\n\n11113 abdominal\n11114\tabide")
+        wordlist = KM.get_wordlist(wl_name)
+        self.assertEqual(len(wordlist), 4)
+        self.assertEqual([wordlist[i] for i in range(4)],
+                         ["abacus", "abdomen", "abdominal", "abide"])
+        self.assertIs(KM.get_wordlist(wl_name), wordlist)
+        KM.CONF.add_section('passphrase')
+        KM.CONF.set('passphrase', 'wordlist', wl_name)
+        KM.CONF.set('passphrase', 'separator', '.')
+        KM.CONF.set('passphrase', 'capitalize', 'first')
+        KM.CONF.set('passphrase', 'words', '5')
+        gen = KM.get_passphrase_generator()
+        words = gen.generate().split('.')
+        self.assertEqual(len(words), 5)
+        self.assertTrue(all(i.lower() in ("abacus", "abdomen", "abdominal", "abide") and
+                            i[0].isupper() for i in words))
+        self.assertEqual(gen.entropy(), 10)
+        self.assertFalse(gen.generate(0))
+        open(wl_name, 'w').close()
+        self.assertRaises(ValueError, KM.get_wordlist, wl_name)
+
     def test_conf(self):
         """Test generating config file when none exists
 
@@ -148,6 +265,36 @@ class TestFunctions(unittest.TestCase):
                         KM.CONF.get("database", "pw_cache_period_min") ==
                         str(KM.CACHE_PERIOD_DEFAULT_MIN))
 
+    def test_settings(self):
+        """Test config.ini is parsed into an immutable Settings object and
+        reloaded when the file changes
+
+        """
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        settings = KM.SETTINGS
+        self.assertEqual(settings.hide_groups, ("Recycle Bin", "Test"))
+        self.assertEqual(settings.type_library, "xdotool")
+        self.assertEqual(settings.cache_period_min, 10)
+        self.assertEqual(settings.editor, ("gvim", "-f"))
+        with self.assertRaises(AttributeError):
+            settings.type_library = "pynput"
+        self.assertIsNone(KM.reload_config())
+        with open(KM.CONF_FILE, 'w') as conf_file:
+            KM.CONF.set('database', 'type_library', 'null')
+            KM.CONF.set('database', 'transfer_mode_view_entry', 'clipboard')
+            KM.CONF.write(conf_file)
+        os.utime(KM.CONF_FILE, ns=(settings.mtime_ns + 10**9,) * 2)
+        self.assertIs(KM.reload_config(), settings)
+        self.assertEqual(KM.SETTINGS.type_library, "null")
+        self.assertEqual(KM.transfer_mode('view_entry'), 'clipboard')
+        self.assertIsNone(KM.reload_config())
+        KM.CONF.set('database', 'pw_cache_period_min', 'ten')
+        self.assertRaises(ValueError, KM.load_settings)
+        KM.CONF.set('database', 'pw_cache_period_min', '10')
+        KM.CONF.set('database', 'clipboard_selection', 'secondary')
+        self.assertRaises(ValueError, KM.load_settings)
+
     def test_dmenu_cmd(self):
         """Test proper reading of dmenu command string from config.ini
 
@@ -188,6 +335,659 @@ class TestFunctions(unittest.TestCase):
         kpo = KM.get_entries(database)
         self.assertIsInstance(kpo, KM.PyKeePass)
 
+    def test_password_cmd(self):
+        """Test password commands only run for the selected database and are
+        killed on timeout
+
+        """
+        KM.process_config()
+        slow = KM.PasswordCommand("sleep 10")
+        self.assertRaises(KM.TimeoutExpired, slow.result, 0.1)
+        self.assertIsNotNone(slow.proc.poll())
+        marker = os.path.join(self.tmpdir, "finished")
+        KM.CONF.set('database', 'database_1', 'one.kdbx')
+        KM.CONF.set('database', 'password_cmd_1', 'echo secret')
+        KM.CONF.set('database', 'database_2', 'two.kdbx')
+        KM.CONF.set('database', 'password_cmd_2', "sh -c 'sleep 10; touch {}'".format(marker))
+        dmenu_select = KM.dmenu_select
+        KM.dmenu_select = lambda *args, **kwds: 'one.kdbx'
+        try:
+            start = KM.time.time()
+            self.assertEqual(KM.get_database(), ('one.kdbx', '', 'secret'))
+            self.assertLess(KM.time.time() - start, 5)
+        finally:
+            KM.dmenu_select = dmenu_select
+        self.assertFalse(os.path.exists(marker))
+
+    def test_database_loader(self):
+        """Test opening a database with the prefetching loader gives the
+        same result as PyKeePass, and keyfiles are hashed like pykeepass
+
+        """
+        from pykeepass.kdbx_parsing.common import compute_key_composite
+        KM.process_config()
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        loader = KM.DatabaseLoader(db_name, '')
+        loader.thread.join()
+        io_open = KM.io.open
+        KM.io.open = None  # The prefetched contents are parsed, not the file
+        try:
+            kpo = loader.open('password')
+        finally:
+            KM.io.open = io_open
+        ref = KM.PyKeePass(db_name, 'password')
+        self.assertIsInstance(kpo, KM.PrefetchedKeePass)
+        self.assertEqual(set(vars(kpo)), set(vars(ref)) | {'file_mtime'})
+        self.assertEqual(kpo.filename, db_name)
+        self.assertEqual([(e.path, e.password) for e in kpo.entries],
+                         [(e.path, e.password) for e in ref.entries])
+        kpo.entries[1].password = 'changed'
+        kpo.save()
+        self.assertEqual(KM.get_entries((db_name, '', 'password')).entries[1].password,
+                         'changed')
+        self.assertRaises(KM.CredentialsError, KM.DatabaseLoader(db_name, '').open, 'wrong')
+        # A KDF not supported by the loader is left to pykeepass
+        loader = KM.DatabaseLoader(db_name, '')
+        loader._kdf = lambda header, composite: None
+        view = loader.open('password', readonly=True)
+        self.assertIsInstance(view, KM.DatabaseView)
+        self.assertEqual(view.file_mtime, os.stat(db_name).st_mtime_ns)
+        self.assertEqual([(e.path, e.password) for e in view.entries],
+                         [(e.path, e.password) for e in KM.PyKeePass(db_name, 'password').entries])
+        errors = []
+        self.addCleanup(setattr, KM, 'dmenu_err', KM.dmenu_err)
+        KM.dmenu_err = errors.append
+        self.assertIsNone(KM.get_entries((db_name, '', 'wrong')))
+        self.assertEqual(errors, ["Invalid Password or keyfile"])
+        keyfile = os.path.join(self.tmpdir, "keyfile")
+        for key in (b"k" * 32, b"ab" * 32, b"any other keyfile",
+                    b'<KeyFile><Key><Data>' + KM.base64.b64encode(b"x" * 32) +
+                    b'</Data></Key></KeyFile>'):
+            with open(keyfile, 'wb') as kfile:
+                kfile.write(key)
+            self.assertEqual(
+                KM.hashlib.sha256(KM.hashlib.sha256(b'pw').digest() +
+                                  KM.keyfile_composite(keyfile)).digest(),
+                compute_key_composite('pw', keyfile))
+
+    def test_read_database(self):
+        """Test the streaming reader gives the same entries as PyKeePass,
+        without the history, and the runner only loads the full database to
+        edit it
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.load_settings()
+        ref = KM.PyKeePass(db_name, 'password')
+        view = KM.get_entries((db_name, '', 'password'), readonly=True)
+        self.assertIsInstance(view, KM.DatabaseView)
+        self.assertTrue(any(e.history for e in ref.entries))
+
+        def fields(entry):
+            return (entry.uuid, entry.path, entry.title, entry.username, entry.password,
+                    entry.url, entry.notes, entry.custom_properties,
+                    entry.autotype_enabled, entry.autotype_sequence)
+        self.assertEqual([fields(e) for e in view.entries], [fields(e) for e in ref.entries])
+        self.assertEqual(view.group_names, {g.name for g in ref.groups})
+        # Protected values stay encrypted, but can be searched by references
+        self.assertIsInstance(view.entries[1].strings['Password'], KM.ProtectedValue)
+        self.assertIs(KM.entry_index(view).find('P', ref.entries[1].password), view.entries[1])
+        ref.entries[0].set_custom_property('ref', '{REF:P@I:%s}' % ref.entries[1].uuid.hex)
+        ref.entries[0].autotype_sequence = '{USERNAME}{ENTER}'
+        ref.save()
+        view = KM.get_entries((db_name, '', 'password'), readonly=True)
+        self.assertEqual([fields(e) for e in view.entries], [fields(e) for e in ref.entries])
+        self.assertEqual(KM.resolve_field(view.entries[0], 'S:ref'), ref.entries[1].password)
+        self.assertRaises(KM.construct.core.ChecksumError,
+                          KM.DatabaseLoader(db_name, '').open, 'wrong', True)
+        server = KM.argparse.Namespace(kill_flag=KM.Event())
+        runner = KM.DmenuRunner(server)
+        self.assertIsNone(runner._kpo)
+        entry = runner.get_selected_entry(runner.get_entries_descriptions()[1])
+        self.assertIsInstance(entry, KM.CompactEntry)
+        self.assertIsInstance(runner.full_entry(entry), KM.Entry)
+        self.assertEqual(runner.full_entry(entry).uuid, entry.uuid)
+        runner.reload_db()
+        self.assertIsNone(runner._kpo)
+
+    def test_protected_stream(self):
+        """Test protected values are decrypted at any keystream position like
+        the sequential Salsa20 and ChaCha20 ciphers do
+
+        """
+        for stream_id, new in (('salsa20', KM.Salsa20.new), ('chacha20', KM.ChaCha20.new)):
+            stream = KM.ProtectedStream(stream_id, b"stream key")
+            keystream = new(key=stream.key, nonce=stream.nonce).encrypt(bytes(1000))
+            for position, length in ((0, 10), (60, 8), (64, 64), (130, 300), (999, 1)):
+                self.assertEqual(stream.decrypt(position, bytes(length)),
+                                 keystream[position:position + length])
+        value = KM.ProtectedValue(stream, 100, stream.decrypt(100, "sécret".encode()))
+        self.assertEqual(value.reveal(), "sécret")
+        self.assertFalse(KM.ProtectedValue(stream, 0, b''))
+        self.assertRaises(ValueError, KM.ProtectedStream, 'arcfourvariant', b'')
+
+    def test_attachments(self):
+        """Test attachments are kept compressed in the read-only view and
+        streamed into a memory-backed file for the opener
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.load_settings()
+        content = os.urandom(1000) + b"attachment " * 20000
+        ref = KM.PyKeePass(db_name, 'password')
+        ref.entries[1].add_attachment(ref.add_binary(content), "file.bin")
+        ref.entries[1].add_attachment(ref.add_binary(b"plain", compressed=False), "plain.txt")
+        ref.save()
+        view = KM.get_entries((db_name, '', 'password'), readonly=True)
+        entry = view.entries[1]
+        self.assertEqual([i.filename for i in entry.attachments], ["file.bin", "plain.txt"])
+        self.assertFalse(view.entries[0].attachments)
+        self.assertLess(len(view.binaries[entry.attachments[0].id].data), len(content) // 10)
+        self.assertEqual(view.attachment_reader(entry.attachments[0]).read(), content)
+        self.assertEqual(view.attachment_reader(entry.attachments[1]).read(), b"plain")
+        # Cipher padding after the compressed stream is ignored
+        padded = KM.gzip_chunks([content]) + bytes(3 * KM.InflatingReader.chunk_size)
+        self.assertEqual(KM.InflatingReader(padded).read(), content)
+        out = os.path.join(self.tmpdir, "out")
+        KM.SETTINGS = KM.SETTINGS._replace(
+            attachment_opener=('sh', '-c', 'cat "$0" > {0}; echo "$0" > {0}.path; '
+                                           'stat -c %a "$0" >> {0}.path'.format(out)),
+            attachment_keep_sec=0)
+        thread = KM.open_attachment("file.bin", view.attachment_reader(entry.attachments[0]))
+        thread.join(10)
+        with open(out, 'rb') as fout:
+            self.assertEqual(fout.read(), content)
+        with open(out + ".path") as fout:
+            path, mode = fout.read().split()
+        self.assertEqual(os.path.basename(path), "file.bin")
+        self.assertEqual(mode, "600")
+        self.assertFalse(os.path.exists(path))
+
+    def test_listing_cache(self):
+        """Test the encrypted listing cache is shown while the database is
+        unlocked, selections resolve by UUID and a changed header discards it
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.CONF.set('database', 'listing_cache', 'True')
+        KM.load_settings()
+        KM.BINARIES['keyctl'] = None
+        KM.LISTING_CACHE_DIR = os.path.join(self.tmpdir, "cache")
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        self.addCleanup(lambda: os.environ.update(XDG_RUNTIME_DIR=runtime_dir) if runtime_dir
+                        else os.environ.pop('XDG_RUNTIME_DIR', None))
+        os.environ['XDG_RUNTIME_DIR'] = self.tmpdir
+        self.assertIsNone(KM.load_listing_cache(db_name))
+        kpo = KM.get_entries((db_name, '', 'password'))
+        KM.save_listing_cache(db_name, kpo)
+        with open(KM.listing_cache_file(db_name), 'rb') as cfile:
+            self.assertNotIn(b"Test Title", cfile.read())
+        listing = KM.load_listing_cache(db_name)
+        self.assertEqual([(i.path, i.username) for i in listing],
+                         [(e.path, e.username) for e in kpo.entries])
+        server = KM.argparse.Namespace(kill_flag=KM.Event())
+        runner = KM.DmenuRunner(server)
+        self.assertEqual(runner.listing, listing)
+        gate = KM.Event()
+        runner.unlock_thread = KM.Thread(target=lambda: gate.wait() and runner.unlock())
+        runner.unlock_thread.start()
+        descriptions = runner.get_entries_descriptions()
+        self.assertTrue(runner.listing_shown)
+        gate.set()
+        entry = runner.get_selected_entry(descriptions[-1])
+        self.assertEqual(entry.uuid.hex, listing[KM._description_idx(descriptions[-1])].uuid)
+        self.assertIsInstance(runner.view, KM.DatabaseView)
+        self.assertIsInstance(runner.kpo, KM.PyKeePass)
+        # Changed header (new master seed) discards the cache
+        with open(db_name, 'rb') as dbfile:
+            data = dbfile.read()
+        seed = KM.KDBX.subcons[0].parse(data).value.dynamic_header.master_seed.data
+        with open(db_name, 'wb') as dbfile:
+            dbfile.write(data.replace(seed, bytes(len(seed)), 1))
+        self.assertIsNone(KM.load_listing_cache(db_name))
+        self.assertFalse(os.path.exists(KM.listing_cache_file(db_name)))
+
+    def test_keyring_cache(self):
+        """Test the composite key is cached in the kernel keyring with a
+        timeout, unlocks the database without the passphrase, is removed
+        when invalid and is skipped without keyctl
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.CONF.remove_option('database', 'password_1')
+        KM.CONF.set('database', 'keyring_cache_min', '5')
+        KM.load_settings()
+        KM.BINARIES['keyctl'] = None
+        self.assertTrue(KM.get_entries((db_name, '', 'password')))
+        self.assertFalse(KM.DB_LOADERS[(db_name, '')].key_cached)
+        self.assertIsNone(KM.load_cached_key(db_name, ''))
+
+        keys = os.path.join(self.tmpdir, "keys")
+        os.mkdir(keys)
+        keyctl = os.path.join(self.tmpdir, "keyctl")
+        with open(keyctl, 'w') as fout:
+            fout.write('#!/bin/sh\nd={}\ncase "$1" in\n'
+                       'search) [ -f "$d/$4" ] && echo "$4" || exit 1;;\n'
+                       'pipe) cat "$d/$2";;\n'
+                       'padd) cat > "$d/$3"; echo "$3";;\n'
+                       'timeout) echo "$3" > "$d/$2.timeout";;\n'
+                       'unlink) rm "$d/$2";;\n'
+                       'esac\n'.format(keys))
+        os.chmod(keyctl, 0o700)
+        KM.BINARIES['keyctl'] = keyctl
+        KM.DB_LOADERS.clear()
+        self.assertTrue(KM.get_entries((db_name, '', 'password')))
+        name = KM.keyring_key_name(db_name, '')
+        with open(os.path.join(keys, name + ".timeout")) as fin:
+            self.assertEqual(fin.read().strip(), "300")
+        KM.DB_LOADERS.clear()
+        self.assertEqual(KM.get_database(), (db_name, '', KM.load_cached_key(db_name, '')))
+        kpo = KM.get_entries(KM.get_database(), readonly=True)
+        self.assertIsInstance(kpo, KM.DatabaseView)
+        self.assertTrue(kpo.entries)
+        self.assertFalse(KM.DB_LOADERS[(db_name, '')].key_cached)
+        errors = []
+        orig_dmenu_err = KM.dmenu_err
+        self.addCleanup(setattr, KM, 'dmenu_err', orig_dmenu_err)
+        KM.dmenu_err = errors.append
+        KM.DB_LOADERS.clear()
+        self.assertIsNone(KM.get_entries((db_name, '', KM.CompositeKey(bytes(32)))))
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(os.path.exists(os.path.join(keys, name)))
+
+    def test_shed_memory(self):
+        """Test the idle runner drops the database objects but keeps the
+        listing, and the next request reads the database again without
+        running the KDF
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.load_settings()
+        server = KM.argparse.Namespace(kill_flag=KM.Event())
+        runner = KM.DmenuRunner(server)
+        self.assertIsInstance(runner.kpo, KM.PyKeePass)
+        KM.entry_index(runner.view)
+        listing = KM.listing_records(runner.view)
+        with runner.busy:
+            self.assertIsNone(runner.shed_memory())
+        rss = runner.shed_memory()
+        self.assertEqual(len(rss), 2)
+        self.assertIsNone(runner._view)
+        self.assertIsNone(runner._kpo)
+        self.assertEqual(len(KM.ENTRY_INDEXES), 0)
+        self.assertEqual(runner.listing, listing)
+        self.assertIsNone(runner.shed_memory())
+        kdf = KM.aes_kdf
+        self.addCleanup(setattr, KM, 'aes_kdf', kdf)
+        KM.aes_kdf = None
+        served = []
+
+        def dmenu_run(option):
+            descriptions = runner.get_entries_descriptions()
+            served.append((option, runner.get_selected_entry(descriptions[1])))
+
+        runner.dmenu_run = dmenu_run
+        runner.serve(KM.MenuOption.TypeEntry)
+        self.assertEqual([i[0] for i in served], [KM.MenuOption.TypeEntry])
+        self.assertEqual(served[0][1].uuid.hex, listing[1].uuid)
+        self.assertIsInstance(runner.view, KM.DatabaseView)
+        self.assertFalse(server.kill_flag.is_set())
+
+        def broken():
+            raise OSError("broken")
+
+        runner.shed_memory = broken
+        runner.loop = KM.asyncio.new_event_loop()
+        self.addCleanup(runner.loop.close)
+        runner.worker = KM.ThreadPoolExecutor(1)
+        self.addCleanup(runner.worker.shutdown)
+        with self.assertLogs(KM.LOG, 'WARNING') as logs:
+            future = runner.shed_idle()
+            runner.loop.run_until_complete(KM.asyncio.wait([future]))
+            runner.loop.run_until_complete(KM.asyncio.sleep(0))
+        self.assertIn("Can't release memory: broken", logs.output[0])
+        self.assertIsNotNone(runner.shed_timer)
+        runner.shed_timer.cancel()
+
+    def test_edit_journal(self):
+        """Test edits are journaled instead of saved, replayed after a crash
+        (also with a torn final record) and compacted into the database
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'journal', 'True')
+        KM.load_settings()
+        dbo = (db_name, '', 'password')
+        journal_name = db_name + KM.JOURNAL_SUFFIX
+        with open(db_name, 'rb') as dbfile:
+            original = dbfile.read()
+
+        def restart():
+            """Forget the daemon state, like after a crash"""
+            KM.JOURNALS.clear()
+            KM.DB_LOADERS.clear()
+            return KM.get_entries(dbo)
+
+        kpo = KM.get_entries(dbo)
+        entry = kpo.entries[1]
+        KM.record_edit(kpo, 'set', entry, field='title', value="Journaled")
+        group = KM.record_edit(kpo, 'add_group', group=kpo.root_group, name="New group")
+        added = KM.record_edit(kpo, 'add_entry', group=group, title="Added", username="u",
+                               password="secret")
+        KM.record_edit(kpo, 'move_entry', kpo.entries[0], group=group)
+        KM.record_edit(kpo, 'delete_entry', kpo.entries[2])
+        self.assertFalse(KM.save_database(kpo))
+        with open(db_name, 'rb') as dbfile:
+            self.assertEqual(dbfile.read(), original)
+        with open(journal_name, 'rb') as jfile:
+            self.assertNotIn(b"secret", jfile.read())
+        expected = sorted((e.uuid, e.path, e.password) for e in kpo.entries)
+
+        kpo = restart()
+        self.assertEqual(sorted((e.uuid, e.path, e.password) for e in kpo.entries), expected)
+        self.assertEqual(kpo.journal.count, 5)
+        view = KM.get_entries(dbo, readonly=True)
+        self.assertEqual(sorted((e.uuid, e.path, e.password) for e in view.entries), expected)
+        # Torn final record: the edit is lost, the earlier ones are kept
+        size = os.path.getsize(journal_name)
+        group = kpo.find_groups(name="New group", first=True)
+        KM.record_edit(kpo, 'rename_group', group, name="Renamed")
+        with open(journal_name, 'r+b') as jfile:
+            jfile.truncate(os.path.getsize(journal_name) - 5)
+        kpo = restart()
+        self.assertEqual(kpo.journal.count, 5)
+        self.assertEqual(os.path.getsize(journal_name), size)
+        group = kpo.find_groups(name="New group", first=True)
+        KM.record_edit(kpo, 'rename_group', group, name="Renamed")
+        self.assertEqual(len(restart().journal.read()), 6)
+        # Compaction writes the edits into the database and empties the journal
+        with open(journal_name, 'rb') as jfile:
+            old_journal = jfile.read()
+        self.assertEqual(KM.compact_journal(*dbo), 6)
+        self.assertFalse(os.path.exists(journal_name))
+        ref = KM.PyKeePass(db_name, 'password')
+        self.assertEqual(sorted((e.uuid, e.password) for e in ref.entries),
+                         sorted(i[::2] for i in expected))
+        self.assertIsNotNone(ref.find_groups(name="Renamed", first=True))
+        # A crash before the journal was emptied replays it over the new database
+        with open(journal_name, 'wb') as jfile:
+            jfile.write(old_journal)
+        kpo = restart()
+        self.assertEqual(sorted((e.uuid, e.password) for e in kpo.entries),
+                         sorted(i[::2] for i in expected))
+        self.assertEqual(len(kpo.groups), len(ref.groups))
+
+    def test_merge_database(self):
+        """Test saving merges a copy of the database changed by another program
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.load_settings()
+        now = int(time.time())
+        ours = KM.get_entries((db_name, '', 'password'))
+        theirs = KM.PyKeePass(db_name, 'password')
+        uuids = {e.title: e.uuid for e in theirs.entries}
+        moved = theirs.find_entries(path="ȧƈƈḗƞŧḗḓ ŧḗẋŧ ƒǿř ŧḗşŧīƞɠ/ȧƈƈḗƞŧḗḓ ŧḗẋŧ", first=True)
+        test1 = theirs.find_groups(name="Test1", first=True)
+
+        def their_edit(op, uuid, seconds, **args):
+            KM.apply_edit(theirs, dict(args, op=op, uuid=uuid.hex, time=seconds),
+                          KM.uuid_elements(theirs))
+
+        def entry(kpo, title):
+            return kpo.find_entries(uuid=uuids[title], first=True)
+
+        KM.record_edit(ours, 'set', entry(ours, "Test Title 1"), field='title', value="Ours")
+        KM.record_edit(ours, 'set', entry(ours, "Test Title"), field='password', value="ours")
+        KM.record_edit(ours, 'delete_entry', ours.entries[0])
+        KM.record_edit(ours, 'add_entry', group=ours.root_group, title="Local added",
+                       username="u", password="p")
+        # Older and newer edits of the same entries
+        their_edit('set', uuids["Test Title 1"], now - 100, field='username', value="theirs")
+        their_edit('set', uuids["Test Title"], now + 100, field='password', value="theirs")
+        their_edit('set', theirs.entries[0].uuid, now - 100, field='notes', value="old")
+        their_edit('delete_entry', uuids["Test Title 2"], now)
+        their_edit('move_entry', moved.uuid, now, group=test1.uuid.hex)
+        group = theirs.add_group(theirs.root_group, "Remote group")
+        added = theirs.add_entry(group, "Remote added", "u", "p")
+        added.add_attachment(theirs.add_binary(b"attachment"), "file.txt")
+        theirs.save()
+        os.utime(db_name, ns=(ours.file_mtime, ours.file_mtime + 10**9))
+
+        self.assertTrue(KM.save_database(ours))
+        merged = KM.PyKeePass(db_name, 'password')
+        first = entry(merged, "Test Title 1")
+        self.assertEqual((first.title, first.username), ("Ours", entry(theirs, "Test Title 1")
+                                                         .history[0].username))
+        self.assertEqual(len(first.history), 5)
+        self.assertEqual(first.history[-1].username, "theirs")
+        last = entry(merged, "Test Title")
+        self.assertEqual(last.password, "theirs")
+        self.assertEqual(last.history[-1].password, "ours")
+        self.assertIsNone(entry(merged, "like the € sign..."))
+        self.assertIsNone(entry(merged, "Test Title 2"))
+        self.assertEqual(merged.find_entries(uuid=moved.uuid, first=True).parentgroup.name,
+                         "Test1")
+        self.assertIsNotNone(merged.find_entries(title="Local added", first=True))
+        remote = merged.find_entries(title="Remote added", first=True)
+        self.assertEqual(remote.parentgroup.name, "Remote group")
+        self.assertEqual(remote.attachments[0].data, b"attachment")
+        deleted = {i.text for i in merged.tree.iterfind('Root/DeletedObjects/DeletedObject/UUID')}
+        self.assertTrue({KM.base64.b64encode(uuids[i].bytes).decode()
+                         for i in ("like the € sign...", "Test Title 2")} <= deleted)
+        # Merging the same copies again changes nothing
+        self.assertEqual(KM.merge_database(merged, KM.PyKeePass(db_name, 'password')), 0)
+        self.assertEqual(KM.merge_database(merged, theirs), 0)
+
+    def test_scheduler(self):
+        """Test a new request closes the open menu, identical queued
+        requests are merged, unfinished actions loop without recursion and
+        the cache timeout stops the scheduler
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.load_settings()
+        dmenu = os.path.join(self.tmpdir, "dmenu")
+        with open(dmenu, 'w') as fout:
+            fout.write("#!/bin/sh\ncat > /dev/null\nexec sleep 30\n")
+        os.chmod(dmenu, 0o700)
+        KM.SETTINGS = KM.SETTINGS._replace(dmenu_command=(dmenu,), cache_period_min=0.01,
+                                           memory_shed_min=0, trace=True,
+                                           mtime_ns=os.stat(KM.CONF_FILE).st_mtime_ns)
+        self.addCleanup(setattr, KM, 'TRACE', KM.TRACE)
+        KM.TRACE = KM.Tracer()
+        KM.TRACE.enabled = True
+        start = time.time()
+
+        def serving():
+            KM.MENUS.track()
+            self.assertRaises(KM.MenuCancelled, KM.dmenu_select, 1)
+            self.assertRaises(KM.MenuCancelled, KM.dmenu_select, 1)
+
+        menu = KM.Thread(target=serving)
+        menu.start()
+        while KM.MENUS.proc is None:
+            time.sleep(0.01)
+        KM.MENUS.cancel()
+        menu.join()
+        self.assertLess(time.time() - start, 10)
+        # Menus of other threads (unlock errors) aren't tracked or cancelled
+        quick = os.path.join(self.tmpdir, "quick-dmenu")
+        with open(quick, 'w') as fout:
+            fout.write("#!/bin/sh\ncat > /dev/null\necho selected\n")
+        os.chmod(quick, 0o700)
+        KM.SETTINGS = KM.SETTINGS._replace(dmenu_command=(quick,))
+        self.assertEqual(KM.dmenu_select(1), "selected")
+        self.assertIsNone(KM.MENUS.proc)
+        KM.MENUS.reset()
+        KM.SETTINGS = KM.SETTINGS._replace(dmenu_command=(dmenu,))
+        # A cancelled menu of the unlock still stops the daemon
+        unlocker = KM.DmenuRunner(KM.argparse.Namespace(kill_flag=KM.Event()))
+        get_entries = KM.get_entries
+
+        def cancelled(*args, **kwds):
+            raise KM.MenuCancelled()
+
+        KM.get_entries = cancelled
+        try:
+            unlocker.unlock()
+        finally:
+            KM.get_entries = get_entries
+        self.assertTrue(unlocker.server.kill_flag.is_set())
+        self.assertIsNone(unlocker._view)
+
+        KM.AUTH_FILE = os.path.join(self.tmpdir, "keepmenu-auth")
+        server = KM.Server()
+        runner = KM.DmenuRunner(server)
+        served = []
+
+        def stale(prompt):
+            served.append(prompt)
+            for _ in range(3):
+                self.assertEqual(KM.client({'cmd': 'show', 'option': 'TypePassword'}),
+                                 {'ok': True})
+            self.assertTrue(KM.MENUS.cancelled)
+            time.sleep(0.2)
+            KM.dmenu_select(1, prompt)
+
+        def unfinished(prompt):
+            served.append(prompt)
+            return len(served) > 2 * sys.getrecursionlimit()
+
+        runner.actions = {KM.MenuOption.TypeEntry: stale,
+                          KM.MenuOption.TypePassword: unfinished}
+        runner.dmenu_select_option = lambda: KM.MenuOption.TypePassword
+        runner.pending.append(KM.MenuOption.TypeEntry)
+        KM.asyncio.run(runner.schedule())
+        self.assertEqual(served[0], KM.MenuOption.TypeEntry.description())
+        self.assertEqual(len(served), 2 * sys.getrecursionlimit() + 1)
+        self.assertTrue(server.kill_flag.is_set())
+        self.assertFalse(runner.pending)
+        stats = runner.stats({})
+        self.assertEqual(stats['entries'], len(runner.view.entries))
+        self.assertGreater(stats['rss_kb'], 0)
+        self.assertEqual(stats['spans']['queue']['count'], 1)
+        self.assertEqual(stats['spans']['connect']['count'], 3)
+        self.assertIn('menu_user', stats['spans'])
+
+    def test_concurrent_requests(self):
+        """Test many clients at once are all answered, and every request is
+        either served or merged into an identical queued request
+
+        """
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.load_settings()
+        KM.SETTINGS = KM.SETTINGS._replace(memory_shed_min=0,
+                                           mtime_ns=os.stat(KM.CONF_FILE).st_mtime_ns)
+        KM.AUTH_FILE = os.path.join(self.tmpdir, "keepmenu-auth")
+        server = KM.Server()
+        runner = KM.DmenuRunner(server)
+        served = []
+
+        def action(prompt):
+            served.append(prompt)
+            time.sleep(0.01)
+            return True
+
+        options = [KM.MenuOption.TypeEntry, KM.MenuOption.TypePassword,
+                   KM.MenuOption.TypeUsername]
+        runner.actions = dict.fromkeys(options, action)
+        scheduler = KM.Thread(target=KM.asyncio.run, args=(runner.schedule(),))
+        scheduler.start()
+        while runner.server.server is None:
+            time.sleep(0.01)
+        barrier = threading.Barrier(30)
+        responses = []
+
+        def send(option):
+            barrier.wait()
+            responses.append(KM.client({'cmd': 'show', 'option': option.name}))
+
+        clients = [KM.Thread(target=send, args=(options[i % 3],)) for i in range(30)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        try:
+            self.assertEqual(responses, [{'ok': True}] * 30)
+            deadline = time.time() + 10
+            counts = KM.client({'cmd': 'stats'})['requests']
+            while counts['pending'] or runner.running is not None:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+                counts = KM.client({'cmd': 'stats'})['requests']
+            self.assertEqual(counts['received'], 30)
+            self.assertEqual(counts['merged'] + counts['served'], 30)
+            self.assertEqual(counts['served'], len(served))
+            self.assertEqual((counts['cancelled'], counts['dropped']), (0, 0))
+            self.assertEqual(set(served), {i.description() for i in options})
+        finally:
+            server.kill_flag.set()
+            runner.loop.call_soon_threadsafe(runner.wakeup.set)
+            scheduler.join()
+
+    def test_tracer(self):
+        """Test the span percentiles and cache hit rates, and that nothing is
+        recorded when tracing is disabled
+
+        """
+        tracer = KM.Tracer()
+        self.assertIs(tracer.span('menu_user'), KM.Tracer.NULL_SPAN)
+        with tracer.span('menu_user'):
+            pass
+        tracer.add('queue', 1)
+        self.assertEqual(tracer.stats()['spans'], {})
+        tracer.enabled = True
+        for i in range(1, 101):
+            tracer.add('queue', i / 1000)
+        with tracer.span('menu_user'):
+            pass
+        tracer.cache('kdf', False)
+        for _ in range(3):
+            tracer.cache('kdf', True)
+        stats = tracer.stats()
+        self.assertEqual(stats['spans']['queue'],
+                         {'count': 100, 'p50_ms': 50, 'p95_ms': 95, 'p99_ms': 99})
+        self.assertEqual(stats['spans']['menu_user']['count'], 1)
+        self.assertEqual(stats['caches']['kdf'], {'hits': 3, 'misses': 1, 'hit_rate': 0.75})
+        for i in range(KM.TRACE_WINDOW):
+            tracer.add('queue', 1)
+        self.assertEqual(tracer.stats()['spans']['queue']['p50_ms'], 1000)
+
     def test_tokenize_autotype(self):
         """Test tokenizing autotype strings
         """
@@ -229,6 +1029,265 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(tokens[6], ("@", True))
         self.assertEqual(tokens[7], ("{}}", True))
 
+    def test_transfer_mode(self):
+        """Test transfer mode priority: entry, then action, then default
+
+        """
+        KM.process_config()
+        self.assertEqual(KM.transfer_mode('type_password'), 'type')
+        KM.CONF.set('database', 'transfer_mode', 'clipboard')
+        KM.CONF.set('database', 'transfer_mode_view_entry', 'paste')
+        KM.load_settings()
+        self.assertEqual(KM.transfer_mode('type_password'), 'clipboard')
+        self.assertEqual(KM.transfer_mode('view_entry'), 'paste')
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        kpo = KM.get_entries((db_name, '', 'password'))
+        entry = kpo.entries[0]
+        entry.set_custom_property('keepmenu_transfer', 'type')
+        self.assertEqual(KM.transfer_mode('view_entry', entry), 'type')
+        entry.set_custom_property('keepmenu_transfer', 'bogus')
+        self.assertEqual(KM.transfer_mode('view_entry', entry), 'type')
+        KM.CONF.set('database', 'transfer_mode', 'bogus')
+        self.assertRaises(ValueError, KM.load_settings)
+
+    def test_clipboard_clear(self):
+        """Test the clipboard is only cleared if it still holds our value
+
+        """
+        KM.process_config()
+        clip = os.path.join(self.tmpdir, "clipboard")
+        KM.CLIPBOARD_TOOLS['stub'] = {"copy": ['sh', '-c', 'cat > {}'.format(clip)],
+                                      "paste": ['cat', clip],
+                                      "clear": ['sh', '-c', ': > {}'.format(clip)],
+                                      "selection": {"clipboard": [], "primary": []}}
+        KM.CONF.set('database', 'clipboard_cmd', 'stub')
+        KM.CONF.set('database', 'clipboard_clear_sec', '0')
+        KM.load_settings()
+        self.assertTrue(KM.copy_to_clipboard("secret"))
+        self.assertEqual(KM.read_clipboard(), b"secret")
+        digest = KM.hashlib.sha256(b"secret").digest()
+        KM.copy_to_clipboard("something else")
+        KM.clear_clipboard(digest)
+        self.assertEqual(KM.read_clipboard(), b"something else")
+        KM.copy_to_clipboard("secret")
+        KM.clear_clipboard(digest)
+        self.assertEqual(KM.read_clipboard(), b"")
+        del KM.CLIPBOARD_TOOLS['stub']
+
+    def test_type_entry_recording(self):
+        """Test the recording type_library captures each typing operation
+
+        """
+        KM.process_config()
+        KM.CONF.set('database', 'type_library', 'recording')
+        KM.load_settings()
+        self.assertIsInstance(KM.init_type_backend(), KM.RecordingBackend)
+        KM.RECORDED_OPS.clear()
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        entry = KM.get_entries((db_name, '', 'password')).entries[2]
+        KM.type_entry(entry)
+        ops = [i[1:] for i in KM.RECORDED_OPS]
+        self.assertEqual(ops, [('type', entry.username), ('key', '{TAB}'),
+                               ('type', entry.password), ('key', '{ENTER}')])
+        KM.type_text("abc")
+        self.assertEqual(KM.RECORDED_OPS[-1][1:], ('type', 'abc'))
+        KM.CONF.set('database', 'type_library', 'null')
+        KM.load_settings()
+        KM.init_type_backend()
+        KM.RECORDED_OPS.clear()
+        KM.type_entry(entry)
+        self.assertEqual(KM.RECORDED_OPS, [])
+
+    def test_type_backend_registry(self):
+        """Test the typing backend is created once, custom backends can be
+        registered and incomplete ones are rejected before typing
+
+        """
+        KM.process_config()
+
+        class Custom(KM.NullBackend):  # pylint: disable=too-few-public-methods
+            name = 'custom'
+
+        KM.register_type_backend(Custom)
+        KM.CONF.set('database', 'type_library', 'custom')
+        KM.load_settings()
+        backend = KM.init_type_backend()
+        self.assertIsInstance(backend, Custom)
+        self.assertIs(KM.get_type_backend(), backend)
+        self.assertIsNone(KM.type_backend_class('does-not-exist'))
+        del KM.TYPE_BACKENDS['custom']
+        KM.TYPE_BACKEND = None
+
+        class Incomplete(KM.TypeBackend):  # pylint: disable=too-few-public-methods
+            name = 'incomplete'
+
+            def type_string(self, text):
+                return True
+
+        KM.register_type_backend(Incomplete)
+        self.addCleanup(KM.TYPE_BACKENDS.pop, 'incomplete')
+        self.assertRaises(TypeError, Incomplete)
+        errors = []
+        self.addCleanup(setattr, KM, 'dmenu_err', KM.dmenu_err)
+        KM.dmenu_err = errors.append
+        KM.CONF.set('database', 'type_library', 'incomplete')
+        KM.load_settings()
+        self.assertRaises(SystemExit, KM.init_type_backend)
+        self.assertEqual(errors, ["type_library 'incomplete' doesn't implement key, paste"])
+        self.assertIsNone(KM.TYPE_BACKEND)
+
+    def test_field_references(self):
+        """Test resolving {REF:...} and {S:...} placeholders, including cycles
+
+        """
+        KM.process_config()
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        kpo = KM.get_entries((db_name, '', 'password'))
+        target, entry, other = kpo.entries[2], kpo.entries[4], kpo.entries[1]
+        entry.password = target.ref('password')
+        entry.url = '{REF:U@T:test title 2}/{S:PIN}'
+        entry.set_custom_property('PIN', '1234')
+        resolver = KM.field_resolver(entry)
+        self.assertEqual(resolver.field(entry, 'P'), 'MkBHbBCozc')
+        self.assertEqual(resolver.field(entry, 'A'), 'fred60/1234')
+        self.assertEqual(resolver.resolve(entry, '{S:UserName}{S:Missing}'),
+                         'joe20{S:Missing}')
+        self.assertEqual(KM.resolve_field(entry, 'S:PIN'), '1234')
+        # Cycle: entry -> other -> entry
+        other.password = entry.ref('password')
+        entry.password = other.ref('password')
+        self.assertEqual(KM.resolve_field(entry, 'P'), entry.ref('password'))
+        # Auto-type with references
+        KM.CONF.set('database', 'type_library', 'recording')
+        KM.load_settings()
+        KM.init_type_backend()
+        KM.RECORDED_OPS.clear()
+        entry.autotype_sequence = '{S:PIN}{TAB}{URL}'
+        KM.type_entry(entry)
+        self.assertEqual([i[1:] for i in KM.RECORDED_OPS],
+                         [('type', '1234'), ('key', '{TAB}'), ('type', 'fred60/1234')])
+
+    def test_audit(self):
+        """Test password strength scoring and the reuse/weakness/age audit
+
+        """
+        KM.process_config()
+        self.assertEqual(KM.password_strength("Password"), 0)
+        self.assertLess(KM.password_strength("abcdefgh"), KM.password_strength("agkbqzdm"))
+        self.assertLess(KM.password_strength("asdfghjk"), KM.password_strength("agkbqzdm"))
+        self.assertLess(KM.password_strength("agkbqzdm"), KM.password_strength("agKbq3d!"))
+        passwords = ["".join(KM.PasswordGenerator({'a': {'lower': string.ascii_lowercase}})
+                             .generate(i)) for i in range(1, 30)]
+        serial = KM.score_passwords(passwords, workers=0)
+        self.assertEqual(KM.score_passwords(passwords, workers=2), serial)
+        self.assertFalse(KM.AUDIT_POOLS)
+        # Forkserver workers can't import this test's keepmenu module by name
+        pool_start, KM.AUDIT_POOL_START = KM.AUDIT_POOL_START, 'fork'
+        try:
+            self.assertEqual(KM.score_passwords(passwords, workers=2, pool_min=1), serial)
+            self.assertIn(2, KM.AUDIT_POOLS)
+        finally:
+            KM.AUDIT_POOL_START = pool_start
+            KM.shutdown_audit_pools()
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        kpo = KM.get_entries((db_name, '', 'password'))
+        kpo.entries[4].password = kpo.entries[2].password
+        kpo.entries[1].password = "qwerty"
+        kpo.entries[3].password = kpo.entries[2].ref('password')
+        results = KM.audit_entries(kpo, max_age_days=0, weak_bits=10)
+        self.assertEqual([(i.idx, i.reuse_group, i.reuse_count, i.weak) for i in results],
+                         [(2, 1, 2, False), (4, 1, 2, False), (1, 0, 1, True)])
+        self.assertEqual(results[0].path, kpo.entries[2].path)
+        self.assertEqual(KM._description_idx(KM.audit_description(results[2], 2)), 1)
+        weak = kpo.entries[1]
+        kpo.move_entry(weak, kpo.add_group(kpo.root_group, "Hidden"))
+        results = KM.audit_entries(kpo, max_age_days=0, weak_bits=10)
+        self.assertIn(weak.path, [i.path for i in results])
+        results = KM.audit_entries(kpo, max_age_days=0, weak_bits=10, hidden_groups=["Hidden"])
+        self.assertNotIn(weak.path, [i.path for i in results])
+        old = KM.audit_entries(kpo, max_age_days=1, weak_bits=0)
+        self.assertTrue(all(i.old for i in old if not i.reuse_group))
+        # `keepmenu audit` skips the hide_groups too
+        kpo.save()
+        self.addCleanup(setattr, KM, 'get_database', KM.get_database)
+        KM.get_database = lambda: (db_name, '', 'password')
+        for hide_groups in ('', 'Hidden'):
+            KM.CONF.set('database', 'hide_groups', hide_groups)
+            KM.load_settings()
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+                KM.audit_passwords()
+            self.assertEqual(weak.path in stdout.getvalue(), not hide_groups)
+        # The daemon's Audit menu runs in a worker thread and scores in the
+        # forkserver pool
+        copyfile("tests/keepmenu-config.ini", KM.CONF_FILE)
+        KM.process_config()
+        KM.CONF.set('database', 'database_1', db_name)
+        KM.CONF.add_section('audit')
+        KM.CONF.set('audit', 'workers', '2')
+        KM.CONF.set('audit', 'pool_min', '1')
+        KM.load_settings()
+        started = []
+
+        class Pool(KM.ThreadPoolExecutor):
+            """Thread pool recording how the audit pool was started"""
+            def __init__(self, workers, mp_context):
+                super().__init__(workers)
+                started.append((workers, mp_context.get_start_method()))
+
+        self.addCleanup(setattr, KM, 'ProcessPoolExecutor', KM.ProcessPoolExecutor)
+        self.addCleanup(setattr, KM, 'dmenu_select', KM.dmenu_select)
+        KM.ProcessPoolExecutor = Pool
+        KM.dmenu_select = lambda *args, **kwds: ""
+        runner = KM.DmenuRunner(KM.argparse.Namespace(kill_flag=KM.Event()))
+        menu = KM.Thread(target=runner.audit)
+        menu.start()
+        menu.join()
+        self.assertEqual(started, [(2, 'forkserver')])
+        self.assertIsInstance(KM.AUDIT_POOLS[2], Pool)
+        KM.shutdown_audit_pools()
+        self.assertFalse(KM.AUDIT_POOLS)
+
+    def test_breach_corpus(self):
+        """Test breached password lookups in a sorted SHA-1 file, with and
+        without the prefix index, and in the audit
+
+        """
+        KM.process_config()
+        breached = {"password": 100, "MkBHbBCozc": 3, "hunter2": 17}
+        lines = ["{}:{}".format(KM.hashlib.sha1(k.encode()).hexdigest().upper(), v)
+                 for k, v in breached.items()]
+        lines += ["{}:1".format(KM.hashlib.sha1(str(i).encode()).hexdigest().upper())
+                  for i in range(2000)]
+        corpus_name = os.path.join(self.tmpdir, "pwned.txt")
+        with open(corpus_name, 'w') as fobj:
+            fobj.write("\r\n".join(sorted(lines)) + "\r\n")
+        index_name = corpus_name + ".idx"
+        corpus = KM.BreachCorpus(corpus_name)
+        corpus.build_index(index_name)
+        indexed = KM.BreachCorpus(corpus_name, index_name)
+        self.assertIsNotNone(indexed.index)
+        for corp in (corpus, indexed):
+            for password, count in breached.items():
+                self.assertEqual(corp.count(password), count)
+            self.assertEqual(corp.count("not breached"), 0)
+            self.assertEqual(corp.count("1999"), 1)
+            digests = [KM.hashlib.sha1(str(i).encode()).hexdigest().upper()
+                       for i in range(1990, 2010)]
+            self.assertEqual(sum(corp.lookup(digests).values()), 10)
+        with open(corpus_name, 'a') as fobj:
+            fobj.write("F" * 40 + ":1\r\n")
+        self.assertIsNone(KM.BreachCorpus(corpus_name, index_name).index)
+        db_name = os.path.join(self.tmpdir, "test.kdbx")
+        copyfile("tests/test.kdbx", db_name)
+        kpo = KM.get_entries((db_name, '', 'password'))
+        results = KM.audit_entries(kpo, max_age_days=0, weak_bits=0, corpus=corpus)
+        self.assertEqual([(i.idx, i.breached) for i in results], [(2, 3)])
+
     def test_token_command(self):
         self.assertTrue(callable(KM.token_command('{DELAY 5}')))
         self.assertFalse(callable(KM.token_command('{DELAY 5 }')))